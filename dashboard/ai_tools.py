@@ -1,102 +1,111 @@
-from collections import defaultdict, Counter
-from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from django.conf import settings
-from django.utils import timezone
-
-from .models import Lorry, Transaction
-from .timeutils import parse_delivery_time, python_aggregate, get_period_key, NOW, TRIAL_START, TRIAL_END
-
-try:
-    import pymongo  # type: ignore
-except Exception:  # pragma: no cover
-    pymongo = None
+from . import caching, engine, metrics, mongo, schema
+from .timeutils import grouped_rows, resolve_window
 
 
 def list_collections() -> List[str]:
     """List MongoDB collections using PyMongo if available, else fallback."""
-    url = settings.DATABASES["default"].get("CLIENT", {}).get("host")
-    name = settings.DATABASES["default"].get("NAME")
-    if not pymongo or not url or not name:
+    db = mongo.get_db()
+    if db is None:
         # Fallback to common known collections
         return ["deliveries", "lorries"]
-    client = pymongo.MongoClient(url)
-    db = client[name]
-    try:
-        cols = sorted(db.list_collection_names())
-    finally:
-        client.close()
-    return cols
-
-
-def describe_collection(coll: str, sample: int = 50) -> Dict:
-    """Return a simple field/type summary for a collection."""
-    url = settings.DATABASES["default"].get("CLIENT", {}).get("host")
-    name = settings.DATABASES["default"].get("NAME")
-    if not pymongo or not url or not name:
+    return sorted(db.list_collection_names())
+
+
+def describe_collection(coll: str, sample: int = 50, incremental: bool = False) -> Dict:
+    """Return a field/BSON type summary for a collection from a random sample.
+
+    Profiles are sampled server-side and cached (see schema.py).
+    """
+    with metrics.span("tool.describe_collection"):
+        prof = schema.profile(coll, sample=sample, incremental=incremental)
+    if prof is None:
         return {"collection": coll, "fields": {}}
-    client = pymongo.MongoClient(url)
-    db = client[name]
-    fields: Dict[str, Counter] = {}
-    try:
-        for doc in db[coll].find({}, projection=None).limit(sample):
-            for k, v in doc.items():
-                t = type(v).__name__
-                fields.setdefault(k, Counter())[t] += 1
-    finally:
-        client.close()
-    # convert counters to simple dicts
     return {
         "collection": coll,
-        "fields": {k: dict(c) for k, c in fields.items()},
-        "sampled": sample,
+        "fields": {k: dict(c) for k, c in prof.fields.items()},
+        "sampled": prof.sampled,
     }
 
 
-def _window_for(period: str) -> Tuple[datetime, datetime]:
-    end = min(NOW, TRIAL_END)
-    if period == "hourly":
-        start = end.replace(hour=0, minute=0, second=0, microsecond=0)
-        return start, end
-    return TRIAL_START, end
-
-
-def totals(period: str) -> Dict:
-    since, until = _window_for(period)
-    qs = Transaction.objects.all()
-    txs = []
-    for tx in qs:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt and since <= dt <= until:
-            txs.append(tx)
-    total_deliveries = len(txs)
-    total_weight_kg = sum((float(getattr(t, "weight", 0) or 0) for t in txs), 0.0)
-    unique_lorries = len({t.lorry_id for t in txs})
+def _period(period: str) -> str:
+    period = (period or "").lower()
+    return period if period in engine.PERIODS else "daily"
+
+
+def _scope(period: str, since, until, lorry_type, client_id) -> Tuple:
+    """Answer cache scope: () for the period's default window, else the
+    resolved bounds and filters."""
+    if not (since or until or lorry_type or client_id):
+        return ()
+    start, end = resolve_window(period, since, until)
+    return (start.isoformat(), end.isoformat(), lorry_type or "", client_id or "")
+
+
+def totals(
+    period: str,
+    since=None,
+    until=None,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Dict:
+    period = _period(period)
+    scope = _scope(period, since, until, lorry_type, client_id)
+    with metrics.span("tool.totals"):
+        return caching.cached_answer(
+            "totals", period, lambda: _totals(period, since, until, lorry_type, client_id), scope
+        )
+
+
+def by_period(
+    period: str,
+    since=None,
+    until=None,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> List[Dict]:
+    period = _period(period)
+    scope = _scope(period, since, until, lorry_type, client_id)
+    with metrics.span("tool.by_period"):
+        return caching.cached_answer(
+            "by_period", period, lambda: _by_period(period, since, until, lorry_type, client_id), scope
+        )
+
+
+def by_lorry_type(
+    period: str,
+    since=None,
+    until=None,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> List[Tuple[str, float]]:
+    period = _period(period)
+    scope = _scope(period, since, until, lorry_type, client_id)
+    with metrics.span("tool.by_lorry_type"):
+        return caching.cached_answer(
+            "by_lorry_type", period, lambda: _by_lorry_type(period, since, until, lorry_type, client_id), scope
+        )
+
+
+def _totals(period: str, since=None, until=None, lorry_type=None, client_id=None) -> Dict:
+    since, until = resolve_window(period, since, until)
+    summary = engine.totals(since, until, lorry_type, client_id)
     return {
         "since": since,
         "until": until,
-        "deliveries": total_deliveries,
-        "weight_kg": total_weight_kg,
-        "weight_tons": total_weight_kg / 1000.0,
-        "unique_lorries": unique_lorries,
+        "deliveries": summary["deliveries"],
+        "weight_kg": summary["weight_kg"],
+        "weight_tons": summary["weight_kg"] / 1000.0,
+        "unique_lorries": summary["unique_lorries"],
     }
 
 
-def by_period(period: str) -> List[Dict]:
-    since, until = _window_for(period)
-    qs = Transaction.objects.all()
-    txs = []
-    for tx in qs:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt and since <= dt <= until:
-            txs.append(tx)
-    return python_aggregate(txs, period)
+def _by_period(period: str, since=None, until=None, lorry_type=None, client_id=None) -> List[Dict]:
+    since, until = resolve_window(period, since, until)
+    return grouped_rows(engine.by_period(since, until, period, lorry_type, client_id))
 
 
-def by_lorry_type(period: str) -> List[Tuple[str, float]]:
-    data = by_period(period)
-    acc = defaultdict(float)
-    for row in data:
-        acc[row["lorry__lorry_type"]] += float(row["total_weight"])
-    return sorted(acc.items(), key=lambda x: (-x[1], x[0]))
+def _by_lorry_type(period: str, since=None, until=None, lorry_type=None, client_id=None) -> List[Tuple[str, float]]:
+    since, until = resolve_window(period, since, until)
+    return engine.by_lorry_type(since, until, lorry_type, client_id)
@@ -4,3 +4,16 @@ from django.apps import AppConfig
 class DashboardConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dashboard'
+
+    def ready(self):
+        from django.conf import settings
+
+        from . import signals  # noqa: F401
+        from . import warmup
+
+        if getattr(settings, "DASHBOARD_VERTEX_EAGER_INIT", False):
+            from . import gemini
+
+            gemini.get_runtime()
+
+        warmup.start()
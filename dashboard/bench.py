@@ -0,0 +1,122 @@
+"""Measurement helpers for the bench_dashboard command.
+
+``measure`` runs a callable and records wall time, ORM queries (Django's
+query capture), MongoDB commands (a PyMongo command listener, which also
+sees the direct PyMongo paths) and peak resident memory sampled from
+``/proc/self/statm`` while it runs.
+"""
+
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+try:
+    from pymongo import monitoring  # type: ignore
+except Exception:  # pragma: no cover
+    monitoring = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# Connection handshakes and session cleanup are not work done for a request.
+_IGNORED_COMMANDS = {"ismaster", "isMaster", "hello", "endSessions", "saslStart", "saslContinue", "ping"}
+
+
+def rss_bytes() -> int:
+    """Current resident set size; falls back to the lifetime peak off Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    """Track peak RSS in a background thread while the block runs."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        self.start = self.peak = rss_bytes()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class CommandCounter(monitoring.CommandListener if monitoring else object):
+    """Counts MongoDB commands sent by every client in the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name not in _IGNORED_COMMANDS:
+            with self._lock:
+                self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+commands = CommandCounter()
+
+
+def install() -> None:
+    """Register the command counter; only clients created afterwards see it."""
+    if monitoring is not None:
+        monitoring.register(commands)
+
+
+def measure(fn: Callable, repeat: int = 1, before: Callable = None) -> Dict:
+    """Run ``fn`` ``repeat`` times (calling ``before`` first each time)."""
+    timings: List[float] = []
+    queries = mongo_commands = 0
+    peak = delta = 0
+    for _ in range(max(1, repeat)):
+        if before is not None:
+            before()
+        start_commands = commands.count
+        with CaptureQueriesContext(connection) as ctx, RssSampler() as rss:
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+        queries = max(queries, len(ctx.captured_queries))
+        mongo_commands = max(mongo_commands, commands.count - start_commands)
+        peak = max(peak, rss.peak)
+        delta = max(delta, rss.peak - rss.start)
+    return {
+        "latency_ms": {
+            "p50": statistics.median(timings) * 1000,
+            "min": min(timings) * 1000,
+            "max": max(timings) * 1000,
+            "runs": len(timings),
+        },
+        "peak_rss_mb": peak / 2**20,
+        "rss_growth_mb": delta / 2**20,
+        "orm_queries": queries,
+        "mongo_commands": mongo_commands,
+    }
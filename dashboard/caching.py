@@ -0,0 +1,231 @@
+"""Versioned cache for aggregated endpoints.
+
+The data version is read from the database, so every process sees writes
+made elsewhere (ingest_csv, other workers, direct MongoDB writes). It is a
+digest of a ``dashboard_meta`` counter, which writes through Django (see
+signals.py), ingest_csv, backfill_delivery_at and rebuild_rollups
+increment, and of the ``deliveries``/``lorries`` document counts and the
+newest ``DELIVERY_AT`` (read from the DELIVERY_AT_1 index). Each process
+re-reads it at most every ``DASHBOARD_DATA_VERSION_TTL`` seconds. Without
+a MongoDB connection it falls back to a version stored in the Django cache.
+
+Cached aggregate rows and rendered fragments are keyed by (endpoint, period,
+window, filters, data version), so they never need explicit invalidation,
+and the same version drives the ETag/Last-Modified headers that let polling
+clients revalidate with a 304.
+
+Chat tool results (totals/by_period/by_lorry_type) are kept in a small
+in-process LRU keyed by (tool, period, scope, data version), shared by the NLQ
+rules and the Gemini tool dispatch. Entries also expire after
+``DASHBOARD_ANSWER_CACHE_TTL`` seconds, which bounds how long an answer can
+outlive a write the version does not reflect.
+"""
+
+from collections import Counter, OrderedDict
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from . import mongo
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "dashboard:data_version"
+META_COLLECTION = "dashboard_meta"
+VERSION_ID = "data_version"
+
+_lock = threading.Lock()
+_version_lock = threading.Lock()
+# Last version read from the database by this process.
+_observed: Dict = {"version": None, "checked": 0.0}
+_hits: Counter = Counter()
+_misses: Counter = Counter()
+_answers: "OrderedDict[Tuple[str, str, Tuple, str], Tuple[float, object]]" = OrderedDict()
+
+
+def _ttl() -> int:
+    return int(getattr(settings, "DASHBOARD_RESPONSE_CACHE_TTL", 300))
+
+
+def _version_ttl() -> float:
+    return float(getattr(settings, "DASHBOARD_DATA_VERSION_TTL", 2))
+
+
+def _cached_version() -> Tuple[str, float]:
+    current = cache.get(VERSION_KEY)
+    if current is None:
+        current = (uuid.uuid4().hex, time.time())
+        cache.set(VERSION_KEY, current, None)
+    return current
+
+
+def _database_version(db) -> Tuple[str, float]:
+    meta = db[META_COLLECTION].find_one({"_id": VERSION_ID}) or {}
+    deliveries = db["deliveries"]
+    newest = deliveries.find_one({}, {"DELIVERY_AT": 1, "_id": 0}, sort=[("DELIVERY_AT", -1)]) or {}
+    newest_at = newest.get("DELIVERY_AT")
+    raw = "|".join(str(part) for part in (
+        meta.get("version", 0),
+        deliveries.estimated_document_count(),
+        db["lorries"].estimated_document_count(),
+        newest_at.isoformat() if newest_at else "",
+    ))
+    modified = float(meta.get("modified") or 0.0)
+    if newest_at is not None:
+        modified = max(modified, newest_at.timestamp())
+    return hashlib.sha1(raw.encode()).hexdigest(), modified
+
+
+def data_version() -> Tuple[str, float]:
+    """Current (version token, last-modified epoch seconds)."""
+    db = mongo.get_db()
+    if db is None:
+        return _cached_version()
+    now = time.monotonic()
+    with _version_lock:
+        current = _observed["version"]
+        if current is not None and now - _observed["checked"] < _version_ttl():
+            return current
+    try:
+        token, modified = _database_version(db)
+    except Exception as e:
+        logger.warning("Could not read the data version from MongoDB: %s", e)
+        return _cached_version()
+    with _version_lock:
+        if current is not None and current[0] == token:
+            modified = max(modified, current[1])
+        elif not modified:
+            modified = time.time()
+        _observed.update(version=(token, modified), checked=now)
+    return token, modified
+
+
+def bump_data_version() -> Tuple[str, float]:
+    """Record a write; every process sees the new version within
+    ``DASHBOARD_DATA_VERSION_TTL`` seconds (this one immediately)."""
+    current = (uuid.uuid4().hex, time.time())
+    cache.set(VERSION_KEY, current, None)
+    db = mongo.get_db()
+    if db is None:
+        return current
+    try:
+        db[META_COLLECTION].update_one(
+            {"_id": VERSION_ID}, {"$inc": {"version": 1}, "$set": {"modified": current[1]}}, upsert=True
+        )
+    except Exception as e:
+        logger.warning("Could not bump the data version in MongoDB: %s", e)
+    with _version_lock:
+        _observed["checked"] = float("-inf")
+    return data_version()
+
+
+def _key(kind: str, endpoint: str, period: str, since, until, version: str, filters: Tuple = ()) -> str:
+    raw = f"{endpoint}|{period}|{since.isoformat()}|{until.isoformat()}|{version}"
+    if filters:
+        raw += f"|{filters!r}"
+    return f"dashboard:{kind}:{hashlib.sha1(raw.encode()).hexdigest()}"
+
+
+def cached(kind: str, endpoint: str, period: str, since, until, build: Callable, filters: Tuple = ()):
+    """Return the cached value for this endpoint/window/filters at the
+    current data version, calling ``build()`` and storing the result on a miss.
+    """
+    version, _ = data_version()
+    key = _key(kind, endpoint, period, since, until, version, filters)
+    value = cache.get(key)
+    label = f"{endpoint}:{kind}"
+    with _lock:
+        if value is None:
+            _misses[label] += 1
+        else:
+            _hits[label] += 1
+    if value is None:
+        value = build()
+        cache.set(key, value, _ttl())
+    return value
+
+
+def _answer_cache_size() -> int:
+    return int(getattr(settings, "DASHBOARD_ANSWER_CACHE_SIZE", 256))
+
+
+def _answer_cache_ttl() -> float:
+    return float(getattr(settings, "DASHBOARD_ANSWER_CACHE_TTL", 60))
+
+
+def cached_answer(tool: str, period: str, build: Callable, scope: Tuple = ()):
+    """Return a chat tool result for (tool, period, scope) at the current data
+    version, computing it with ``build()`` on a miss or once the entry is
+    older than ``DASHBOARD_ANSWER_CACHE_TTL`` seconds. Least recently used
+    entries are evicted beyond ``DASHBOARD_ANSWER_CACHE_SIZE``; entries for
+    older versions are never hit again and age out the same way.
+
+    Results are shared between callers and must be treated as read-only.
+    """
+    version, _ = data_version()
+    key = (tool, period, scope, version)
+    label = f"answers:{tool}"
+    now = time.monotonic()
+    with _lock:
+        entry = _answers.get(key)
+        if entry is not None and now - entry[0] < _answer_cache_ttl():
+            _answers.move_to_end(key)
+            _hits[label] += 1
+            return entry[1]
+        _misses[label] += 1
+    value = build()
+    with _lock:
+        _answers[key] = (now, value)
+        _answers.move_to_end(key)
+        while len(_answers) > _answer_cache_size():
+            _answers.popitem(last=False)
+    return value
+
+
+def clear_answers() -> None:
+    with _lock:
+        _answers.clear()
+
+
+def etag_for(endpoint: str, period: str, since, until, filters: Tuple = ()) -> Tuple[str, float]:
+    version, modified = data_version()
+    return quote_etag(_key("etag", endpoint, period, since, until, version, filters).rsplit(":", 1)[1]), modified
+
+
+def not_modified(request, etag: str, modified: float):
+    """A 304 response if the client's validators are current, else None."""
+    response = get_conditional_response(request, etag=etag, last_modified=int(modified))
+    if response is not None:
+        stamp(response, etag, modified)
+    return response
+
+
+def stamp(response, etag: str, modified: float):
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(modified)
+    # Clients keep the copy but revalidate each time (cheap 304s).
+    patch_cache_control(response, no_cache=True)
+    patch_vary_headers(response, ["HX-Request"])
+    return response
+
+
+def stats() -> Dict[str, Dict]:
+    with _lock:
+        labels = set(_hits) | set(_misses)
+        out = {}
+        for label in sorted(labels):
+            hits, misses = _hits[label], _misses[label]
+            out[label] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            }
+        return out
@@ -0,0 +1,93 @@
+"""Compact, pre-pivoted payload for the dashboard charts (``/api/chart/``).
+
+Aggregated rows (one per period bucket and lorry type) become a matrix:
+
+- ``periods``: bucket labels, newest first (the table's order);
+- ``types``: lorry types, sorted;
+- ``weights``: dense row-major weights, ``weights[i * len(types) + j]`` for
+  period ``i`` and type ``j`` (0 where there were no deliveries);
+- ``period_totals`` / ``type_totals`` / ``total``: the chart sums;
+- ``composition``: the waste composition split of ``total``.
+
+Key names appear once instead of once per row, so the JSON is a fraction of
+the size of the rows for long hourly windows, and the browser draws the
+charts without re-grouping. The encoded body is cached with its gzip form.
+"""
+
+import json
+import re
+from typing import Dict, List, Tuple
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+CONTENT_TYPE = "application/json"
+# Waste composition shares applied to the total weight.
+COMPOSITION = (
+    ("Leachate", 0.09),
+    ("Recycables", 0.11),
+    ("Organic", 0.45),
+    ("Inorganic", 0.20),
+    ("Others", 0.15),
+)
+# Smaller bodies are not worth compressing (as GZipMiddleware).
+MIN_GZIP_BYTES = 200
+
+_accepts_gzip = re.compile(r"\bgzip\b")
+
+
+def pivot(rows: List[Dict], period: str) -> Dict:
+    """Matrix form of ``build_aggregated_rows`` output."""
+    periods: List[str] = []
+    index: Dict[str, int] = {}
+    for row in rows:
+        label = row["period_display"]
+        if label not in index:
+            index[label] = len(periods)
+            periods.append(label)
+    types = sorted({row["lorry__lorry_type"] for row in rows})
+    column = {t: j for j, t in enumerate(types)}
+    width = len(types)
+    weights = [0.0] * (len(periods) * width)
+    period_totals = [0.0] * len(periods)
+    type_totals = [0.0] * width
+    for row in rows:
+        i, j = index[row["period_display"]], column[row["lorry__lorry_type"]]
+        weight = float(row["total_weight"])
+        weights[i * width + j] += weight
+        period_totals[i] += weight
+        type_totals[j] += weight
+    total = sum(period_totals)
+    return {
+        "period": period,
+        "periods": periods,
+        "types": types,
+        "weights": [round(w, 2) for w in weights],
+        "period_totals": [round(w, 2) for w in period_totals],
+        "type_totals": [round(w, 2) for w in type_totals],
+        "total": round(total, 2),
+        "composition": {
+            "labels": [f"{name} ({share:.0%})" for name, share in COMPOSITION],
+            "shares": [share for _, share in COMPOSITION],
+            "weights": [round(share * total) for _, share in COMPOSITION],
+        },
+    }
+
+
+def encode(payload: Dict) -> Tuple[bytes, bytes]:
+    """(JSON body, gzipped body or b"" when too small to be worth it)."""
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    return body, compress_string(body) if len(body) >= MIN_GZIP_BYTES else b""
+
+
+def response(request, body: bytes, gzipped: bytes) -> HttpResponse:
+    """The gzipped body if the client accepts it (and it is smaller)."""
+    use_gzip = gzipped and len(gzipped) < len(body) and _accepts_gzip.search(
+        request.META.get("HTTP_ACCEPT_ENCODING", "")
+    )
+    resp = HttpResponse(gzipped if use_gzip else body, content_type=CONTENT_TYPE)
+    if use_gzip:
+        resp["Content-Encoding"] = "gzip"
+    patch_vary_headers(resp, ["Accept-Encoding"])
+    return resp
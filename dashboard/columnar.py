@@ -0,0 +1,290 @@
+"""Optional in-memory columnar store of deliveries (requires numpy).
+
+Deliveries are kept as parallel column arrays -- int64 epoch-ms timestamps,
+float32 weights, int16 lorry-type codes and int32 lorry codes -- about 18
+bytes per delivery instead of a Django model instance. Period bucketing is
+vectorised with ``np.floor_divide``/``np.bincount`` and produces the same
+{period: {lorry_type: weight}} mapping as ``python_aggregate``.
+
+Enabled with ``DASHBOARD_AGGREGATION_BACKEND = "columnar"``. The store is
+loaded lazily per process, new deliveries saved in this process are
+appended, and the whole store is reloaded after
+``DASHBOARD_COLUMNAR_REFRESH`` seconds to pick up writes from elsewhere.
+Only the first load blocks; a stale store keeps serving while its
+replacement is built in a background thread and swapped in. Deliveries
+recorded during that reload are queued by transaction id, skipped by the
+reload and replayed into the new store before the swap, so they are
+neither lost nor counted twice. Buckets are computed in UTC.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import lorry_cache
+from .timeutils import parse_delivery_times
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+logger = logging.getLogger(__name__)
+
+HOUR_MS = 3_600_000
+DAY_MS = 86_400_000
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def enabled() -> bool:
+    return np is not None and getattr(settings, "DASHBOARD_AGGREGATION_BACKEND", "python") == "columnar"
+
+
+def _ms(dt: datetime) -> int:
+    return (dt - _EPOCH) // timedelta(milliseconds=1)
+
+
+class ColumnarDeliveries:
+    def __init__(self, capacity: int = 1024):
+        self._lock = threading.Lock()
+        self.size = 0
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.weight = np.empty(capacity, dtype=np.float32)
+        self.type_code = np.empty(capacity, dtype=np.int16)
+        self.lorry_code = np.empty(capacity, dtype=np.int32)
+        self.types = []
+        self.lorries = []
+        self._type_codes: Dict[str, int] = {}
+        self._lorry_codes: Dict[str, int] = {}
+        self.loaded_at = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a[: self.size].nbytes for a in (self.ts, self.weight, self.type_code, self.lorry_code))
+
+    def _code(self, codes: Dict[str, int], values: list, key: str) -> int:
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(values)
+            values.append(key)
+        return code
+
+    def _reserve(self, extra: int) -> None:
+        needed = self.size + extra
+        if needed <= len(self.ts):
+            return
+        capacity = max(needed, 2 * len(self.ts))
+        for name in ("ts", "weight", "type_code", "lorry_code"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+
+    def append(self, rows: Iterable[Tuple[object, str, object]]) -> int:
+        """Append (delivery time, lorry_id, weight) rows; returns rows kept.
+
+        Delivery times may be datetimes or raw DELIVERY_TIME values; rows
+        with an unparseable time or weight are skipped like python_aggregate.
+        """
+        rows = list(rows)
+        dts = parse_delivery_times([r[0] for r in rows])
+        lookup = lorry_cache.lorries.lookup()
+        ts, weights, types, lorries = [], [], [], []
+        with self._lock:
+            for dt, (_, lorry_id, weight) in zip(dts, rows):
+                if dt is None:
+                    continue
+                try:
+                    weight = float(weight)
+                except (TypeError, ValueError):
+                    continue
+                info = lookup.get(lorry_id)
+                ts.append(_ms(dt))
+                weights.append(weight)
+                types.append(self._code(self._type_codes, self.types, info.types_id if info else "Unknown"))
+                lorries.append(self._code(self._lorry_codes, self.lorries, lorry_id))
+            n = len(ts)
+            self._reserve(n)
+            end = self.size + n
+            self.ts[self.size:end] = ts
+            self.weight[self.size:end] = weights
+            self.type_code[self.size:end] = types
+            self.lorry_code[self.size:end] = lorries
+            self.size = end
+        return n
+
+    def _window(self, since: datetime, until: datetime, lorry_ids: Optional[List[str]] = None):
+        n = self.size
+        ts = self.ts[:n]
+        mask = (ts >= _ms(since)) & (ts <= _ms(until))
+        if lorry_ids is not None:
+            codes = [self._lorry_codes[i] for i in lorry_ids if i in self._lorry_codes]
+            mask &= np.isin(self.lorry_code[:n], np.asarray(codes, dtype=np.int32))
+        return ts[mask], self.weight[:n][mask], self.type_code[:n][mask], self.lorry_code[:n][mask]
+
+    def _buckets(self, ts, period: str):
+        """Bucket ids per row plus a function turning a bucket id into its period key."""
+        if period == "hourly":
+            return np.floor_divide(ts, HOUR_MS), lambda b: _EPOCH + timedelta(hours=int(b))
+        if period == "monthly":
+            months = ts.astype("datetime64[ms]").astype("datetime64[M]").astype(np.int64)
+            return months, lambda b: _EPOCH.replace(year=1970 + int(b) // 12, month=int(b) % 12 + 1)
+        days = np.floor_divide(ts, DAY_MS)
+        if period == "weekly":
+            # 1970-01-01 was a Thursday; shift so weeks start on Monday.
+            def week_key(b):
+                year, week, _ = (_EPOCH + timedelta(days=int(b) * 7 - 3)).isocalendar()
+                return f"{year}-W{week:02d}"
+            return np.floor_divide(days + 3, 7), week_key
+        return days, lambda b: _EPOCH + timedelta(days=int(b))
+
+    def aggregate(
+        self, since: datetime, until: datetime, period: str, lorry_ids: Optional[List[str]] = None
+    ) -> Dict:
+        ts, weight, type_code, _ = self._window(since, until, lorry_ids)
+        agg = defaultdict(lambda: defaultdict(float))
+        if not len(ts):
+            return agg
+        buckets, key_for = self._buckets(ts, period)
+        unique, inverse = np.unique(buckets, return_inverse=True)
+        ntypes = len(self.types)
+        cell = inverse * ntypes + type_code
+        sums = np.bincount(cell, weights=weight.astype(np.float64), minlength=len(unique) * ntypes)
+        counts = np.bincount(cell, minlength=len(unique) * ntypes)
+        for idx in np.flatnonzero(counts):
+            b, t = divmod(int(idx), ntypes)
+            agg[key_for(unique[b])][self.types[t]] += float(sums[idx])
+        return agg
+
+    def totals(self, since: datetime, until: datetime, lorry_ids: Optional[List[str]] = None) -> Dict:
+        _, weight, _, lorry_code = self._window(since, until, lorry_ids)
+        return {
+            "deliveries": int(len(weight)),
+            "weight_kg": float(weight.astype(np.float64).sum()),
+            "unique_lorries": int(len(np.unique(lorry_code))),
+        }
+
+    @classmethod
+    def load(cls, batch_size: int = 50_000, skip: Optional[Container[str]] = None) -> "ColumnarDeliveries":
+        """Bulk-load every delivery in fixed-size batches, except transaction
+        ids in ``skip``."""
+        from .models import Transaction
+
+        store = cls()
+        rows = (
+            Transaction.objects.order_by()
+            .values_list("transaction_id", "delivery_at", "delivery_time", "lorry_id", "weight")
+            .iterator(chunk_size=batch_size)
+        )
+        batch = []
+        for transaction_id, delivery_at, delivery_time, lorry_id, weight in rows:
+            if skip and transaction_id in skip:
+                continue
+            batch.append((delivery_at or delivery_time, lorry_id, weight))
+            if len(batch) >= batch_size:
+                store.append(batch)
+                batch = []
+        if batch:
+            store.append(batch)
+        return store
+
+
+_store: Optional[ColumnarDeliveries] = None
+_store_lock = threading.Lock()
+_refresher: Optional[threading.Thread] = None
+# Bumped by invalidate(), so a reload started before it is not swapped in.
+_generation = 0
+# {transaction id: row} recorded while a background reload runs.
+_pending: Optional[Dict[str, Tuple[object, str, object]]] = None
+_pending_lock = threading.Lock()
+
+
+def _refresh(generation: int) -> None:
+    global _store, _pending
+    pending: Dict[str, Tuple[object, str, object]] = {}
+    with _pending_lock:
+        _pending = pending
+    try:
+        store = ColumnarDeliveries.load(skip=pending)
+    except Exception:
+        logger.exception("Columnar store refresh failed; serving the previous store")
+        with _pending_lock:
+            _pending = None
+        return
+    with _store_lock, _pending_lock:
+        if generation == _generation and _store is not None:
+            if pending:
+                store.append(pending.values())
+            _store = store
+        _pending = None
+
+
+def get_store() -> ColumnarDeliveries:
+    """The loaded store; the first call loads it, later calls never wait
+    for a reload."""
+    global _store, _refresher
+    store = _store
+    if store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ColumnarDeliveries.load()
+            return _store
+    refresh = float(getattr(settings, "DASHBOARD_COLUMNAR_REFRESH", 300))
+    if time.monotonic() - store.loaded_at > refresh:
+        with _store_lock:
+            if _refresher is None or not _refresher.is_alive():
+                _refresher = threading.Thread(
+                    target=_refresh, args=(_generation,), name="columnar-refresh", daemon=True
+                )
+                _refresher.start()
+    return store
+
+
+def invalidate() -> None:
+    """Drop the loaded store; the next read reloads it."""
+    global _store, _generation
+    with _store_lock:
+        _store = None
+        _generation += 1
+
+
+def record(rows: Iterable[Tuple[str, object, str, object]]) -> None:
+    """Append new deliveries, as (transaction id, time, lorry id, weight),
+    to the loaded store (no-op until first load)."""
+    rows = [(transaction_id, (when, lorry_id, weight)) for transaction_id, when, lorry_id, weight in rows]
+    with _pending_lock:
+        store = _store
+        if _pending is not None:
+            _pending.update(rows)
+    if store is not None:
+        store.append(row for _, row in rows)
+
+
+def aggregate(
+    since: datetime,
+    until: datetime,
+    period: str,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Optional[Dict]:
+    if np is None:
+        return None
+    lorry_ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+    return get_store().aggregate(since, until, period, lorry_ids)
+
+
+def totals(
+    since: datetime,
+    until: datetime,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Optional[Dict]:
+    if np is None:
+        return None
+    return get_store().totals(since, until, lorry_cache.lorries.matching_ids(lorry_type, client_id))
@@ -0,0 +1,264 @@
+"""Aggregation engines: one interface, interchangeable backends.
+
+Every engine answers the same four questions for a window and optional
+lorry_type/client_id filters:
+
+- ``by_period``: {period key: {lorry type: weight}} (see get_period_key);
+- ``totals``: {"deliveries", "weight_kg", "unique_lorries"};
+- ``by_lorry_type``: [(lorry type, weight)], heaviest first;
+- ``latest``: the newest deliveries as template rows, newest first.
+
+Backends, selected with ``DASHBOARD_AGGREGATION_BACKEND``:
+
+- ``python`` (default): ORM window query, grouped in Python;
+- ``mongo``: MongoDB aggregation pipelines (pipeline.py);
+- ``rollup``: pre-aggregated hourly rollups (rollups.py);
+- ``columnar``: the in-memory numpy column store (columnar.py).
+
+A backend returns None for anything it cannot answer (MongoDB unreachable,
+numpy missing, no row-level data for ``latest``), and the module-level
+functions then fall back to the Python engine. Rows with no parseable time
+or weight are skipped by every engine. ``compare`` runs several engines on
+the same window and reports where they disagree (see the check_engines
+command and the parity tests).
+"""
+
+from collections import defaultdict
+import heapq
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from . import columnar, lorry_cache, metrics, pipeline, rollups
+from .timeutils import group_entries, window_entries, window_latest
+
+PERIODS = ("hourly", "daily", "weekly", "monthly")
+LATEST_ROWS = 20
+
+
+def summarize(entries) -> Dict:
+    """Totals over (datetime, transaction) pairs."""
+    deliveries = 0
+    weight_kg = 0.0
+    lorries = set()
+    for dt, tx in entries:
+        if dt is None:
+            continue
+        try:
+            weight = float(tx.weight)
+        except (TypeError, ValueError):
+            continue
+        deliveries += 1
+        weight_kg += weight
+        lorries.add(tx.lorry_id)
+    return {"deliveries": deliveries, "weight_kg": weight_kg, "unique_lorries": len(lorries)}
+
+
+def latest_rows(entries, lorry_lookup=None, n: int = LATEST_ROWS) -> List[Dict]:
+    """Top-n most recent deliveries, enriched with lorry type (no DB FK)."""
+    if lorry_lookup is None:
+        lorry_lookup = lorry_cache.lorries.lookup()
+    top = heapq.nlargest(n, (e for e in entries if e[0] is not None), key=lambda e: e[0])
+    return [_row(tx.transaction_id, tx.lorry_id, tx.weight, tx.delivery_time, lorry_lookup) for _, tx in top]
+
+
+def _row(transaction_id, lorry_id, weight, delivery_time, lorry_lookup) -> Dict:
+    lorry = lorry_lookup.get(lorry_id)
+    return {
+        'transaction_id': transaction_id,
+        'lorry_id': lorry_id,
+        'lorry_types_id': getattr(lorry, 'types_id', 'Unknown') if lorry else 'Unknown',
+        'weight': weight,
+        'delivery_time': delivery_time,
+    }
+
+
+def by_type(grouped: Dict) -> List[Tuple[str, float]]:
+    acc = defaultdict(float)
+    for types in grouped.values():
+        for lorry_type, weight in types.items():
+            acc[lorry_type] += float(weight)
+    return sorted(acc.items(), key=lambda x: (-x[1], x[0]))
+
+
+class Engine:
+    name = "base"
+
+    def by_period(self, since, until, period, lorry_type=None, client_id=None) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def totals(self, since, until, lorry_type=None, client_id=None) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def by_lorry_type(self, since, until, lorry_type=None, client_id=None) -> Optional[List[Tuple[str, float]]]:
+        # Any bucketing gives the same per-type sums; monthly has the fewest buckets.
+        grouped = self.by_period(since, until, "monthly", lorry_type, client_id)
+        return None if grouped is None else by_type(grouped)
+
+    def latest(self, since, until, n=LATEST_ROWS, lorry_type=None, client_id=None) -> Optional[List[Dict]]:
+        return None
+
+
+class PythonEngine(Engine):
+    name = "python"
+
+    def entries(self, since, until, lorry_type=None, client_id=None):
+        return window_entries(since, until, lorry_cache.lorries.matching_ids(lorry_type, client_id))
+
+    def by_period(self, since, until, period, lorry_type=None, client_id=None):
+        entries = self.entries(since, until, lorry_type, client_id)
+        with metrics.span("aggregate"):
+            return group_entries(entries, period)
+
+    def totals(self, since, until, lorry_type=None, client_id=None):
+        return summarize(self.entries(since, until, lorry_type, client_id))
+
+    def latest(self, since, until, n=LATEST_ROWS, lorry_type=None, client_id=None):
+        # Indexed top-n, not the whole window: rollup/columnar fall back here.
+        ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+        return latest_rows(window_latest(since, until, n, ids), n=n)
+
+
+class MongoEngine(Engine):
+    name = "mongo"
+
+    def by_period(self, since, until, period, lorry_type=None, client_id=None):
+        return pipeline.aggregate(since, until, period, lorry_type, client_id)
+
+    def totals(self, since, until, lorry_type=None, client_id=None):
+        return pipeline.totals(since, until, lorry_type, client_id)
+
+    def latest(self, since, until, n=LATEST_ROWS, lorry_type=None, client_id=None):
+        docs = pipeline.latest(since, until, n, lorry_type, client_id)
+        if docs is None:
+            return None
+        lookup = lorry_cache.lorries.lookup()
+        return [
+            _row(d.get("Transaction_ID"), d.get("LORRY_ID"), d.get("WEIGHT"), d.get("DELIVERY_TIME"), lookup)
+            for d in docs
+        ]
+
+
+class RollupEngine(Engine):
+    """Windows resolve to whole hours (see rollups.py)."""
+
+    name = "rollup"
+
+    def by_period(self, since, until, period, lorry_type=None, client_id=None):
+        return rollups.aggregate(since, until, period, lorry_type, client_id)
+
+    def totals(self, since, until, lorry_type=None, client_id=None):
+        return rollups.totals(since, until, lorry_type, client_id)
+
+
+class ColumnarEngine(Engine):
+    name = "columnar"
+
+    def by_period(self, since, until, period, lorry_type=None, client_id=None):
+        return columnar.aggregate(since, until, period, lorry_type, client_id)
+
+    def totals(self, since, until, lorry_type=None, client_id=None):
+        return columnar.totals(since, until, lorry_type, client_id)
+
+
+ENGINES: Dict[str, Engine] = {e.name: e for e in (PythonEngine(), MongoEngine(), RollupEngine(), ColumnarEngine())}
+python_engine = ENGINES["python"]
+
+
+def get_engine(name: Optional[str] = None) -> Engine:
+    """The engine named ``name`` or selected by DASHBOARD_AGGREGATION_BACKEND."""
+    name = name or getattr(settings, "DASHBOARD_AGGREGATION_BACKEND", "python")
+    return ENGINES.get(name, python_engine)
+
+
+def _dispatch(method: str, *args, **kwargs):
+    engine = get_engine()
+    if engine is not python_engine:
+        with metrics.span(f"agg_{engine.name}"):
+            result = getattr(engine, method)(*args, **kwargs)
+        if result is not None:
+            return result
+    return getattr(python_engine, method)(*args, **kwargs)
+
+
+def by_period(since, until, period, lorry_type=None, client_id=None) -> Dict:
+    return _dispatch("by_period", since, until, period, lorry_type, client_id)
+
+
+def totals(since, until, lorry_type=None, client_id=None) -> Dict:
+    return _dispatch("totals", since, until, lorry_type, client_id)
+
+
+def by_lorry_type(since, until, lorry_type=None, client_id=None) -> List[Tuple[str, float]]:
+    return _dispatch("by_lorry_type", since, until, lorry_type, client_id)
+
+
+def latest(since, until, n=LATEST_ROWS, lorry_type=None, client_id=None) -> List[Dict]:
+    return _dispatch("latest", since, until, n, lorry_type, client_id)
+
+
+# -- parity ----------------------------------------------------------------
+
+def _close(a: float, b: float) -> bool:
+    # The columnar store keeps float32 weights.
+    return math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-3)
+
+
+def _diff_grouped(a: Dict, b: Dict) -> List[str]:
+    out = []
+    for key in sorted(set(a) | set(b), key=str):
+        types_a, types_b = a.get(key, {}), b.get(key, {})
+        for lorry_type in sorted(set(types_a) | set(types_b)):
+            wa, wb = types_a.get(lorry_type, 0.0), types_b.get(lorry_type, 0.0)
+            if not _close(wa, wb):
+                out.append(f"{key} {lorry_type}: {wa} != {wb}")
+    return out
+
+
+def compare(
+    engines: Sequence[Engine],
+    since,
+    until,
+    periods: Sequence[str] = PERIODS,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> List[str]:
+    """Differences between the first engine and each of the others.
+
+    Answers an engine cannot give (None) are skipped. Returns human-readable
+    lines, empty when all engines agree.
+    """
+    base, others = engines[0], engines[1:]
+    problems = []
+
+    def check(label, engine, expected, actual, diff):
+        if expected is None or actual is None:
+            return
+        for line in diff(expected, actual):
+            problems.append(f"{engine.name} vs {base.name} {label}: {line}")
+
+    for period in periods:
+        expected = base.by_period(since, until, period, lorry_type, client_id)
+        for engine in others:
+            check(f"by_period[{period}]", engine, expected,
+                  engine.by_period(since, until, period, lorry_type, client_id), _diff_grouped)
+
+    expected = base.totals(since, until, lorry_type, client_id)
+    for engine in others:
+        check("totals", engine, expected, engine.totals(since, until, lorry_type, client_id), lambda a, b: [
+            f"{k}: {a[k]} != {b[k]}" for k in ("deliveries", "weight_kg", "unique_lorries") if not _close(a[k], b[k])
+        ])
+
+    expected = base.by_lorry_type(since, until, lorry_type, client_id)
+    for engine in others:
+        check("by_lorry_type", engine, expected, engine.by_lorry_type(since, until, lorry_type, client_id),
+              lambda a, b: _diff_grouped({"all": dict(a)}, {"all": dict(b)}))
+
+    expected = base.latest(since, until, LATEST_ROWS, lorry_type, client_id)
+    for engine in others:
+        # Deliveries with equal times may come back in any order.
+        check("latest", engine, expected, engine.latest(since, until, LATEST_ROWS, lorry_type, client_id),
+              lambda a, b: [] if sorted(r["transaction_id"] for r in a) == sorted(r["transaction_id"] for r in b)
+              else [f"{[r['transaction_id'] for r in a]} != {[r['transaction_id'] for r in b]}"])
+    return problems
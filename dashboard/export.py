@@ -0,0 +1,119 @@
+"""Streaming delivery exports (CSV / NDJSON).
+
+Rows are read with a server-side cursor in ``DASHBOARD_EXPORT_BATCH_SIZE``
+chunks and written out batch by batch, so memory use does not depend on the
+size of the export. Lorry type and client are joined from the in-memory
+lorry dimension cache; filtering by them is pushed down to MongoDB as a
+``LORRY_ID $in`` on the matching lorries.
+
+Backfilled rows are range-scanned on DELIVERY_AT in time order; rows
+without the typed field follow, parsed and window-filtered per batch.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import lorry_cache
+from .models import Transaction
+from .timeutils import parse_delivery_times
+
+COLUMNS = ["transaction_id", "delivery_at", "delivery_time", "lorry_id", "lorry_type", "client_id", "weight"]
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+_FIELDS = ("transaction_id", "delivery_at", "delivery_time", "lorry_id", "weight")
+
+
+def _batch_size() -> int:
+    return int(getattr(settings, "DASHBOARD_EXPORT_BATCH_SIZE", 2000))
+
+
+def _batches(rows: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rows(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Iterator[List[Tuple]]:
+    """Yield batches of export rows (tuples in COLUMNS order)."""
+    size = _batch_size()
+    base = Transaction.objects.order_by()
+    lorry_ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+    if lorry_ids is not None:
+        if not lorry_ids:
+            return
+        base = base.filter(lorry_id__in=lorry_ids)
+
+    typed = base.filter(delivery_at__isnull=False)
+    if since is not None:
+        typed = typed.filter(delivery_at__gte=since)
+    if until is not None:
+        typed = typed.filter(delivery_at__lte=until)
+    typed = typed.order_by("delivery_at").values_list(*_FIELDS).iterator(chunk_size=size)
+    # Unparseable legacy rows are kept (with an empty delivery_at) only when
+    # no window is requested.
+    windowed = since is not None or until is not None
+    legacy = base.filter(delivery_at__isnull=True)
+    if windowed:
+        legacy = legacy.filter(delivery_at_invalid__isnull=True)
+    legacy = legacy.values_list(*_FIELDS).iterator(chunk_size=size)
+    for source, parse in ((typed, False), (legacy, True)):
+        for batch in _batches(source, size):
+            lookup = lorry_cache.lorries.lookup()
+            parsed = parse_delivery_times([r[2] for r in batch]) if parse else [r[1] for r in batch]
+            out = []
+            for (tx_id, _, raw, lorry_id, weight), dt in zip(batch, parsed):
+                if parse and windowed and (
+                    dt is None or (since is not None and dt < since) or (until is not None and dt > until)
+                ):
+                    continue
+                info = lookup.get(lorry_id)
+                out.append((
+                    tx_id,
+                    dt.isoformat() if dt else "",
+                    raw,
+                    lorry_id,
+                    info.types_id if info else "Unknown",
+                    info.client_id if info else "",
+                    weight,
+                ))
+            if out:
+                yield out
+
+
+def stream_csv(batches: Iterable[List[Tuple]]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    yield buf.getvalue()
+    for batch in batches:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(batch)
+        yield buf.getvalue()
+
+
+def stream_ndjson(batches: Iterable[List[Tuple]]) -> Iterator[str]:
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in batch)
+
+
+def stream(fmt: str, batches: Iterable[List[Tuple]]) -> Iterator[str]:
+    return stream_ndjson(batches) if fmt == "ndjson" else stream_csv(batches)
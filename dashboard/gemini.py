@@ -8,166 +8,337 @@ If Vertex AI credentials are provided later, we can route questions through
 Gemini and allow it to call the same tools for grounded answers.
 """
 
-from typing import Optional, Any, Dict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, Any, Dict, List, NamedTuple, Tuple
+import asyncio
+import contextvars
+import functools
+import json
+import logging
 import os
+import threading
+import time
 
+from django.conf import settings
 from django.utils.html import escape
 
-from . import ai_tools
+from . import ai_tools, metrics
 
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
 def _vertex_available() -> bool:
-    return (
-        os.getenv("GOOGLE_CLOUD_PROJECT")
-        and os.getenv("GEMINI_LOCATION")
-    ) is not None
+    """Whether Vertex AI is configured; read once per process."""
+    return bool(os.getenv("GOOGLE_CLOUD_PROJECT") and os.getenv("GEMINI_LOCATION"))
 
 
-def _vertex_call(question: str) -> Optional[str]:
-    """Attempt a single-turn Gemini call with function calling.
+class _VertexRuntime(NamedTuple):
+    model: Any
+    tool: Any
 
-    If the SDK or credentials are missing, return None to fall back to local NLQ.
+
+_runtime: Optional[_VertexRuntime] = None
+_runtime_error: Optional[BaseException] = None
+_runtime_lock = threading.Lock()
+_timings_lock = threading.Lock()
+_timings: Dict[str, float] = {"init_seconds": 0.0, "calls": 0, "model_seconds_total": 0.0, "model_seconds_max": 0.0}
+
+
+def _build_runtime() -> _VertexRuntime:
+    from vertexai import init as vertex_init
+    from vertexai.generative_models import (
+        GenerativeModel,
+        FunctionDeclaration,
+        Tool,
+    )
+
+    project = os.getenv("GOOGLE_CLOUD_PROJECT")
+    location = os.getenv("GEMINI_LOCATION", "us-central1")
+    vertex_init(project=project, location=location)
+
+    # Define tool functions Gemini can call
+    f_list = FunctionDeclaration(
+        name="list_collections",
+        description="List available MongoDB collections.",
+    )
+    f_describe = FunctionDeclaration(
+        name="describe_collection",
+        description="Describe a collection's fields and types from a small sample.",
+        parameters={
+            "type": "object",
+            "properties": {"collection": {"type": "string"}},
+            "required": ["collection"],
+        },
+    )
+    f_totals = FunctionDeclaration(
+        name="totals",
+        description="Return deliveries, weight (kg/tons), and unique lorries for a period.",
+        parameters={
+            "type": "object",
+            "properties": dict(SCOPE_PROPERTIES, period={"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}),
+            "required": ["period"],
+        },
+    )
+    f_by_period = FunctionDeclaration(
+        name="by_period",
+        description="Weight totals by period bucket and lorry type.",
+        parameters={
+            "type": "object",
+            "properties": dict(SCOPE_PROPERTIES, period={"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}),
+            "required": ["period"],
+        },
+    )
+    f_by_type = FunctionDeclaration(
+        name="by_lorry_type",
+        description="Weight totals aggregated by lorry type for a period.",
+        parameters={
+            "type": "object",
+            "properties": dict(SCOPE_PROPERTIES, period={"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}),
+            "required": ["period"],
+        },
+    )
+
+    tool = Tool(function_declarations=[f_list, f_describe, f_totals, f_by_period, f_by_type])
+    return _VertexRuntime(model=GenerativeModel("gemini-1.5-flash"), tool=tool)
+
+
+def get_runtime() -> Optional[_VertexRuntime]:
+    """The process-wide Vertex model and tool declarations, built on first use.
+
+    Returns None if Vertex is not configured or the SDK failed to load; a
+    failure is remembered so it is not retried on every question.
     """
-    try:
-        from vertexai import init as vertex_init
-        from vertexai.generative_models import (
-            GenerativeModel,
-            FunctionDeclaration,
-            Tool,
-        )
+    global _runtime, _runtime_error
+    if _runtime is not None or _runtime_error is not None:
+        return _runtime
+    if not _vertex_available():
+        return None
+    with _runtime_lock:
+        if _runtime is None and _runtime_error is None:
+            started = time.perf_counter()
+            try:
+                _runtime = _build_runtime()
+            except Exception as e:
+                logger.warning("Vertex AI unavailable; using local NLQ: %s", e)
+                _runtime_error = e
+            elapsed = time.perf_counter() - started
+            with _timings_lock:
+                _timings["init_seconds"] = elapsed
+            if _runtime is not None:
+                logger.info("Vertex AI runtime initialized in %.3fs", elapsed)
+    return _runtime
 
-        project = os.getenv("GOOGLE_CLOUD_PROJECT")
-        location = os.getenv("GEMINI_LOCATION", "us-central1")
-        vertex_init(project=project, location=location)
 
-        # Define tool functions Gemini can call
-        f_list = FunctionDeclaration(
-            name="list_collections",
-            description="List available MongoDB collections.",
-        )
-        f_describe = FunctionDeclaration(
-            name="describe_collection",
-            description="Describe a collection's fields and types from a small sample.",
-            parameters={
-                "type": "object",
-                "properties": {"collection": {"type": "string"}},
-                "required": ["collection"],
-            },
-        )
-        f_totals = FunctionDeclaration(
-            name="totals",
-            description="Return deliveries, weight (kg/tons), and unique lorries for a period.",
-            parameters={
-                "type": "object",
-                "properties": {"period": {"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}},
-                "required": ["period"],
-            },
-        )
-        f_by_period = FunctionDeclaration(
-            name="by_period",
-            description="Weight totals by period bucket and lorry type.",
-            parameters={
-                "type": "object",
-                "properties": {"period": {"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}},
-                "required": ["period"],
-            },
-        )
-        f_by_type = FunctionDeclaration(
-            name="by_lorry_type",
-            description="Weight totals aggregated by lorry type for a period.",
-            parameters={
-                "type": "object",
-                "properties": {"period": {"type": "string", "enum": ["hourly", "daily", "weekly", "monthly"]}},
-                "required": ["period"],
-            },
-        )
+def _record_model_latency(seconds: float) -> None:
+    with _timings_lock:
+        _timings["calls"] += 1
+        _timings["model_seconds_total"] += seconds
+        _timings["model_seconds_max"] = max(_timings["model_seconds_max"], seconds)
+
+
+def vertex_timings() -> Dict[str, float]:
+    """One-off init cost and cumulative/max model latency for this process."""
+    with _timings_lock:
+        out = dict(_timings)
+    out["initialized"] = _runtime is not None
+    out["model_seconds_avg"] = out["model_seconds_total"] / out["calls"] if out["calls"] else 0.0
+    return out
+
+
+# Optional window/filter arguments shared by the totals/by_period/by_lorry_type tools.
+SCOPE_PROPERTIES = {
+    "since": {"type": "string", "description": "ISO start date/time (UTC), e.g. 2025-01-06."},
+    "until": {"type": "string", "description": "ISO end date/time (UTC); a bare date includes the whole day."},
+    "lorry_type": {"type": "string", "description": "Only this lorry type, e.g. Tipper."},
+    "client_id": {"type": "string", "description": "Only lorries of this client, e.g. MBSP."},
+}
+
+
+def _scope_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: args[k] for k in SCOPE_PROPERTIES if args.get(k)}
+
+
+SYSTEM_PROMPT = (
+    "You are a data assistant for a waste management dashboard. "
+    "Use tools to produce grounded answers. Keep responses concise and in HTML."
+)
+
+
+def _render_collections(args: Dict[str, Any]):
+    cols = ai_tools.list_collections()
+    lis = "".join(f"<li class='list-disc ml-5'>{escape(c)}</li>" for c in cols)
+    return cols, f"<div><strong>Collections</strong><ul>{lis}</ul></div>"
+
+
+def _render_describe(args: Dict[str, Any]):
+    col = args.get("collection") or "deliveries"
+    d = ai_tools.describe_collection(col)
+    rows = []
+    for field, types in sorted(d.get("fields", {}).items()):
+        tstr = ", ".join(f"{escape(t)}: {cnt}" for t, cnt in sorted(types.items()))
+        rows.append(f"<tr><td class='px-2 py-1'>{escape(field)}</td><td class='px-2 py-1'>{tstr}</td></tr>")
+    body = "".join(rows) or "<tr><td colspan='2' class='px-2 py-1 text-gray-500'>No sample.</td></tr>"
+    return d, f"<div><strong>Schema for {escape(col)}</strong><table class='min-w-full border mt-1'><thead><tr><th class='text-left px-2 py-1'>Field</th><th class='text-left px-2 py-1'>Types</th></tr></thead><tbody>{body}</tbody></table></div>"
+
 
-        tool = Tool(function_declarations=[f_list, f_describe, f_totals, f_by_period, f_by_type])
-        model = GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(
-            [
-                {
-                    "role": "user",
-                    "parts": [
-                        {
-                            "text": (
-                                "You are a data assistant for a waste management dashboard. "
-                                "Use tools to produce grounded answers. Keep responses concise and in HTML."
-                            )
-                        }
-                    ],
-                },
-                {"role": "user", "parts": [{"text": question}]},
-            ],
-            tools=[tool],
+def _render_totals(args: Dict[str, Any]):
+    p = args.get("period", "daily")
+    t = ai_tools.totals(p, **_scope_args(args))
+    return t, (
+        f"<div><strong>Totals ({p.title()})</strong><br/>Deliveries: {t['deliveries']:,}<br/>"
+        f"Weight (Kg): {int(t['weight_kg']):,}<br/>Weight (Tons): {t['weight_tons']:.2f}<br/>"
+        f"Unique Lorries: {t['unique_lorries']:,}</div>"
+    )
+
+
+def _render_by_period(args: Dict[str, Any]):
+    p = args.get("period", "daily")
+    data = ai_tools.by_period(p, **_scope_args(args))
+    head = "<tr><th class='text-left px-2 py-1'>Period</th><th class='text-left px-2 py-1'>Lorry Type</th><th class='text-left px-2 py-1'>Total Weight</th></tr>"
+    rows = []
+    for r in data[:100]:
+        rows.append(
+            f"<tr><td class='px-2 py-1'>{escape(str(r.get('period_display', r.get('period'))))}</td>"
+            f"<td class='px-2 py-1'>{escape(str(r['lorry__lorry_type']))}</td>"
+            f"<td class='px-2 py-1'>{float(r['total_weight']):,.0f}</td></tr>"
         )
+    body = "".join(rows) or "<tr><td colspan='3' class='px-2 py-1 text-gray-500'>No data.</td></tr>"
+    return data[:100], f"<div><strong>By Period ({p.title()})</strong><table class='min-w-full border mt-1'><thead>{head}</thead><tbody>{body}</tbody></table></div>"
+
+
+def _render_by_type(args: Dict[str, Any]):
+    p = args.get("period", "daily")
+    data = ai_tools.by_lorry_type(p, **_scope_args(args))
+    rows = []
+    for tname, w in data:
+        rows.append(f"<tr><td class='px-2 py-1'>{escape(tname)}</td><td class='px-2 py-1'>{w:,.0f}</td></tr>")
+    body = "".join(rows) or "<tr><td colspan='2' class='px-2 py-1 text-gray-500'>No data.</td></tr>"
+    return data, f"<div><strong>By Lorry Type ({p.title()})</strong><table class='min-w-full border mt-1'><thead><tr><th class='text-left px-2 py-1'>Type</th><th class='text-left px-2 py-1'>Total Weight</th></tr></thead><tbody>{body}</tbody></table></div>"
+
+
+# Local tools Gemini can call: name -> function(args) returning (data, html).
+TOOLS = {
+    "list_collections": _render_collections,
+    "describe_collection": _render_describe,
+    "totals": _render_totals,
+    "by_period": _render_by_period,
+    "by_lorry_type": _render_by_type,
+}
+
+
+def _function_calls(resp) -> List[Dict[str, Any]]:
+    calls = []
+    for cand in getattr(resp, "candidates", []) or []:
+        for part in getattr(cand, "content", {}).parts or []:
+            fc = getattr(part, "function_call", None)
+            if fc and getattr(fc, "name", None):
+                calls.append({"name": fc.name, "args": dict(getattr(fc, "args", {}) or {})})
+    return calls
+
 
-        # Inspect tool calls in the response (single-turn handling)
-        calls = []
-        for cand in getattr(resp, "candidates", []) or []:
-            for part in getattr(cand, "content", {}).parts or []:
-                fc = getattr(part, "function_call", None)
-                if fc and getattr(fc, "name", None):
-                    calls.append({"name": fc.name, "args": dict(getattr(fc, "args", {}) or {})})
+def _run_tools(calls: List[Dict[str, Any]], timeout: float) -> List[Tuple[Dict[str, Any], Any, Optional[str]]]:
+    """Execute the requested tools concurrently on the chat tool pool.
 
-        if not calls:
-            # If the model returned text, use it
+    Returns (call, data, html) per call in request order; a tool that fails,
+    is unknown or misses the deadline yields an error payload and no HTML.
+    """
+    futures = []
+    for call in calls:
+        fn = TOOLS.get(call["name"])
+        # Copy the context so tool spans are attributed to the chat request.
+        futures.append(_tool_executor.submit(contextvars.copy_context().run, fn, call["args"]) if fn else None)
+    wait([f for f in futures if f is not None], timeout=max(0.0, timeout))
+    out = []
+    for call, future in zip(calls, futures):
+        if future is None:
+            out.append((call, {"error": f"unknown tool {call['name']}"}, None))
+        elif not future.done():
+            future.cancel()
+            out.append((call, {"error": "timed out"}, None))
+        elif future.exception() is not None:
+            out.append((call, {"error": str(future.exception())}, None))
+        else:
+            data, html = future.result()
+            out.append((call, data, html))
+    return out
+
+
+def _vertex_call(question: str, deadline: Optional[float] = None) -> Optional[str]:
+    """Answer with Gemini function calling.
+
+    Every function call in a model turn is executed concurrently and all
+    results go back to the model in a single follow-up turn, for at most
+    ``DASHBOARD_GEMINI_MAX_TURNS`` model calls and
+    ``DASHBOARD_GEMINI_MAX_SECONDS`` overall, or until ``deadline`` (a
+    ``time.monotonic()`` value, e.g. the chat timeout) if that is sooner. No
+    further model turn starts unless the last one would still fit, so the
+    tool results gathered so far are returned in time. The answer is the
+    rendered tool results followed by the model's final text, if any.
+
+    If the SDK or credentials are missing, return None to fall back to local NLQ.
+    """
+    try:
+        runtime = get_runtime()
+        if runtime is None:
+            return None
+        model, tool = runtime.model, runtime.tool
+        max_turns = int(getattr(settings, "DASHBOARD_GEMINI_MAX_TURNS", 3))
+        budget = time.monotonic() + float(getattr(settings, "DASHBOARD_GEMINI_MAX_SECONDS", 20))
+        deadline = budget if deadline is None else min(deadline, budget)
+        contents: List[Any] = [
+            {"role": "user", "parts": [{"text": SYSTEM_PROMPT}]},
+            {"role": "user", "parts": [{"text": question}]},
+        ]
+        rendered: List[str] = []
+        seen = set()
+        for _ in range(max_turns):
+            started = time.perf_counter()
             try:
-                return escape(resp.text)
-            except Exception:
-                return None
-
-        # Execute the first function call locally and render a simple HTML answer
-        call = calls[0]
-        name = call["name"]
-        args = call.get("args", {})
-        # Map to local tools
-        if name == "list_collections":
-            cols = ai_tools.list_collections()
-            lis = "".join(f"<li class='list-disc ml-5'>{escape(c)}</li>" for c in cols)
-            return f"<div><strong>Collections</strong><ul>{lis}</ul></div>"
-        if name == "describe_collection":
-            col = args.get("collection") or "deliveries"
-            d = ai_tools.describe_collection(col)
-            rows = []
-            for field, types in sorted(d.get("fields", {}).items()):
-                tstr = ", ".join(f"{escape(t)}: {cnt}" for t, cnt in sorted(types.items()))
-                rows.append(f"<tr><td class='px-2 py-1'>{escape(field)}</td><td class='px-2 py-1'>{tstr}</td></tr>")
-            body = "".join(rows) or "<tr><td colspan='2' class='px-2 py-1 text-gray-500'>No sample.</td></tr>"
-            return f"<div><strong>Schema for {escape(col)}</strong><table class='min-w-full border mt-1'><thead><tr><th class='text-left px-2 py-1'>Field</th><th class='text-left px-2 py-1'>Types</th></tr></thead><tbody>{body}</tbody></table></div>"
-        if name == "totals":
-            p = args.get("period", "daily")
-            t = ai_tools.totals(p)
-            return (
-                f"<div><strong>Totals ({p.title()})</strong><br/>Deliveries: {t['deliveries']:,}<br/>"
-                f"Weight (Kg): {int(t['weight_kg']):,}<br/>Weight (Tons): {t['weight_tons']:.2f}<br/>"
-                f"Unique Lorries: {t['unique_lorries']:,}</div>"
-            )
-        if name == "by_period":
-            p = args.get("period", "daily")
-            data = ai_tools.by_period(p)
-            head = "<tr><th class='text-left px-2 py-1'>Period</th><th class='text-left px-2 py-1'>Lorry Type</th><th class='text-left px-2 py-1'>Total Weight</th></tr>"
-            rows = []
-            for r in data[:100]:
-                rows.append(
-                    f"<tr><td class='px-2 py-1'>{escape(str(r.get('period_display', r.get('period'))))}</td>"
-                    f"<td class='px-2 py-1'>{escape(str(r['lorry__lorry_type']))}</td>"
-                    f"<td class='px-2 py-1'>{float(r['total_weight']):,.0f}</td></tr>"
-                )
-            body = "".join(rows) or "<tr><td colspan='3' class='px-2 py-1 text-gray-500'>No data.</td></tr>"
-            return f"<div><strong>By Period ({p.title()})</strong><table class='min-w-full border mt-1'><thead>{head}</thead><tbody>{body}</tbody></table></div>"
-        if name == "by_lorry_type":
-            p = args.get("period", "daily")
-            data = ai_tools.by_lorry_type(p)
-            rows = []
-            for tname, w in data:
-                rows.append(f"<tr><td class='px-2 py-1'>{escape(tname)}</td><td class='px-2 py-1'>{w:,.0f}</td></tr>")
-            body = "".join(rows) or "<tr><td colspan='2' class='px-2 py-1 text-gray-500'>No data.</td></tr>"
-            return f"<div><strong>By Lorry Type ({p.title()})</strong><table class='min-w-full border mt-1'><thead><tr><th class='text-left px-2 py-1'>Type</th><th class='text-left px-2 py-1'>Total Weight</th></tr></thead><tbody>{body}</tbody></table></div>"
+                with metrics.span("model"):
+                    resp = model.generate_content(contents, tools=[tool])
+            finally:
+                turn_seconds = time.perf_counter() - started
+                _record_model_latency(turn_seconds)
 
-        return None
+            calls = _function_calls(resp)
+            if not calls:
+                # If the model returned text, use it
+                try:
+                    text = escape(resp.text)
+                except Exception:
+                    text = ""
+                if rendered and text:
+                    rendered.append(f"<div class='mt-1'>{text}</div>")
+                elif text:
+                    rendered.append(text)
+                break
+            if time.monotonic() >= deadline:
+                break
+
+            results = _run_tools(calls, deadline - time.monotonic())
+            parts = []
+            for call, data, html in results:
+                key = (call["name"], json.dumps(call["args"], sort_keys=True, default=str))
+                if html and key not in seen:
+                    seen.add(key)
+                    rendered.append(html)
+                parts.append({
+                    "function_response": {
+                        "name": call["name"],
+                        "response": {"content": json.loads(json.dumps(data, default=str))},
+                    }
+                })
+            contents.append(resp.candidates[0].content)
+            contents.append({"role": "user", "parts": parts})
+            if time.monotonic() + turn_seconds >= deadline:
+                break
+        return "".join(rendered) or None
     except Exception:
+        logger.exception("Gemini call failed; falling back to local NLQ")
         return None
 
+
 def ask_gemini(question: str) -> str:
     """Answer a question using the local NLQ tools.
 
@@ -182,3 +353,53 @@ def ask_gemini(question: str) -> str:
         return answer_question(question)
     except Exception as e:
         return f"<span class='text-red-600'>[AI error: {escape(str(e))}]</span>"
+
+
+# Async chat path: model calls run on a small dedicated pool guarded by a
+# semaphore, local tools on another, so slow Vertex responses never block the
+# event loop and cannot take every thread serving dashboard requests.
+_MODEL_SLOTS = int(getattr(settings, "DASHBOARD_CHAT_MAX_MODEL_CALLS", 4))
+_model_slots = threading.BoundedSemaphore(_MODEL_SLOTS)
+_model_executor = ThreadPoolExecutor(max_workers=_MODEL_SLOTS, thread_name_prefix="chat-model")
+_tool_executor = ThreadPoolExecutor(
+    max_workers=int(getattr(settings, "DASHBOARD_CHAT_TOOL_WORKERS", 4)), thread_name_prefix="chat-tools"
+)
+
+
+def _local_answer(question: str) -> str:
+    try:
+        from .nlq import answer_question
+        return answer_question(question)
+    except Exception as e:
+        return f"<span class='text-red-600'>[AI error: {escape(str(e))}]</span>"
+
+
+async def ask_gemini_async(question: str) -> str:
+    """Async ``ask_gemini`` with a deadline on the model call.
+
+    If Vertex is not configured, every model slot is busy, or no answer
+    arrives within ``DASHBOARD_CHAT_TIMEOUT`` seconds, the question is
+    answered by the local NLQ tools instead. The model call gets the same
+    deadline, so multi-turn answers stop in time rather than being discarded;
+    a call that still overruns keeps its slot until it actually returns, so
+    the limit holds under sustained slowness.
+    """
+    loop = asyncio.get_running_loop()
+    if _vertex_available() and _model_slots.acquire(blocking=False):
+        timeout = float(getattr(settings, "DASHBOARD_CHAT_TIMEOUT", 8))
+        deadline = time.monotonic() + timeout
+        try:
+            future = _model_executor.submit(contextvars.copy_context().run, _vertex_call, question, deadline)
+        except Exception:
+            _model_slots.release()
+            raise
+        future.add_done_callback(lambda _: _model_slots.release())
+        try:
+            html = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Gemini call exceeded %.1fs; answering with local tools", timeout)
+            html = None
+        if html:
+            return html
+    return await loop.run_in_executor(_tool_executor, contextvars.copy_context().run, _local_answer, question)
+
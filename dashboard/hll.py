@@ -0,0 +1,87 @@
+"""HyperLogLog sketches for counting distinct lorries.
+
+A sketch has ``M = 2**PRECISION`` one-byte registers. Each value is hashed
+to 64 bits; the first ``PRECISION`` bits pick a register and the register
+keeps the highest rank (position of the first 1 bit in the rest) seen.
+Sketches merge by taking the register-wise maximum, so the distinct count
+of any union of hour buckets comes from merging their sketches.
+
+Error bound: the relative standard error is ``1.04 / sqrt(M)`` (1.6% at
+the precision used here), i.e. about 95% of estimates fall within 3.3% of
+the true count. Below ``2.5 * M`` distinct values the estimate switches to
+linear counting over the empty registers, which stays within about 1% for
+the lorry counts seen per client.
+
+Stored sketches are sparse: {register index (str): rank}, only the
+non-empty registers, so an hour bucket holds at most one entry per lorry
+and can be updated in place with MongoDB's ``$max`` (see rollups.py).
+Changing PRECISION requires rebuilding stored sketches.
+"""
+
+import hashlib
+import math
+from typing import Dict, Iterable, Mapping, Tuple
+
+PRECISION = 12
+M = 1 << PRECISION
+STANDARD_ERROR = 1.04 / math.sqrt(M)
+
+_REST_BITS = 64 - PRECISION
+_REST_MASK = (1 << _REST_BITS) - 1
+_ALPHA = 0.7213 / (1 + 1.079 / M)
+_INVERSE_POWERS = [2.0 ** -r for r in range(_REST_BITS + 2)]
+
+
+def position(value) -> Tuple[int, int]:
+    """(register index, rank) for a value."""
+    h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+    return h >> _REST_BITS, _REST_BITS - (h & _REST_MASK).bit_length() + 1
+
+
+def sparse(values: Iterable) -> Dict[str, int]:
+    """Sparse sketch of ``values``."""
+    out: Dict[str, int] = {}
+    for value in values:
+        index, rank = position(value)
+        key = str(index)
+        if rank > out.get(key, 0):
+            out[key] = rank
+    return out
+
+
+class HyperLogLog:
+    __slots__ = ("registers",)
+
+    def __init__(self):
+        self.registers = bytearray(M)
+
+    def add(self, value) -> None:
+        index, rank = position(value)
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, stored: Mapping[str, int]) -> None:
+        """Merge a sparse sketch."""
+        registers = self.registers
+        for key, rank in stored.items():
+            index = int(key)
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def sparse(self) -> Dict[str, int]:
+        return {str(i): r for i, r in enumerate(self.registers) if r}
+
+    def estimate(self) -> int:
+        registers = self.registers
+        raw = _ALPHA * M * M / sum(_INVERSE_POWERS[r] for r in registers)
+        if raw <= 2.5 * M:
+            zeros = registers.count(0)
+            if zeros:
+                return int(round(M * math.log(M / zeros)))
+        return int(round(raw))
+
+    def __len__(self) -> int:
+        return self.estimate()
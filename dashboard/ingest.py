@@ -0,0 +1,122 @@
+"""Bulk CSV ingest for ``deliveries`` and ``lorries`` (see ingest_csv).
+
+Rows are validated and turned into MongoDB documents in fixed-size chunks.
+The parse functions are plain module-level functions on lists so chunks
+can be shipped to a process pool. DELIVERY_TIME is normalized once here
+to a UTC ``YYYY-MM-DDTHH:MM:SS`` string plus the typed DELIVERY_AT date,
+so readers never have to parse it again.
+
+Writes are unordered ``bulk_write`` upserts keyed on ``Transaction_ID``
+(deliveries) or ``LORRY_ID`` (lorries), so re-running a file is
+idempotent.
+"""
+
+from typing import Dict, List, Sequence, Tuple
+
+from django.utils import timezone
+
+from .timeutils import parse_delivery_times
+
+try:
+    import pymongo  # type: ignore
+    from pymongo import UpdateOne  # type: ignore
+except Exception:  # pragma: no cover
+    pymongo = None
+
+DELIVERY_COLUMNS = ("Transaction_ID", "LORRY_ID", "WEIGHT", "DELIVERY_TIME")
+LORRY_COLUMNS = ("LORRY_ID", "TYPES_ID", "CLIENT_ID", "MAKE_ID")
+KEYS = {"deliveries": "Transaction_ID", "lorries": "LORRY_ID"}
+
+# (line number, reason, raw row)
+Reject = Tuple[int, str, List[str]]
+
+
+def detect_kind(header: Sequence[str]) -> str:
+    """'deliveries' or 'lorries' from a CSV header; ValueError otherwise."""
+    columns = {c.strip() for c in header}
+    if set(DELIVERY_COLUMNS) <= columns:
+        return "deliveries"
+    if set(LORRY_COLUMNS) <= columns:
+        return "lorries"
+    raise ValueError(f"unrecognised header: {', '.join(header)}")
+
+
+def _indexes(header: Sequence[str], columns: Sequence[str]) -> List[int]:
+    stripped = [c.strip() for c in header]
+    return [stripped.index(c) for c in columns]
+
+
+def parse_deliveries(header: Sequence[str], first_line: int, rows: List[List[str]]) -> Tuple[List[Dict], List[Reject]]:
+    """Validate a chunk of deliveries.csv rows into documents."""
+    idx_id, idx_lorry, idx_weight, idx_time = _indexes(header, DELIVERY_COLUMNS)
+    width = max(idx_id, idx_lorry, idx_weight, idx_time) + 1
+    docs, rejects, pending = [], [], []
+    for line, row in enumerate(rows, first_line):
+        if len(row) < width:
+            rejects.append((line, "missing columns", row))
+            continue
+        tx_id, lorry_id = row[idx_id].strip(), row[idx_lorry].strip()
+        if not tx_id or not lorry_id:
+            rejects.append((line, "missing Transaction_ID or LORRY_ID", row))
+            continue
+        try:
+            weight = float(row[idx_weight])
+        except ValueError:
+            rejects.append((line, "invalid WEIGHT", row))
+            continue
+        if weight != weight or weight < 0:
+            rejects.append((line, "invalid WEIGHT", row))
+            continue
+        pending.append((line, row, tx_id, lorry_id, weight))
+    parsed = parse_delivery_times([p[1][idx_time].strip() for p in pending])
+    for (line, row, tx_id, lorry_id, weight), dt in zip(pending, parsed):
+        if dt is None:
+            rejects.append((line, "invalid DELIVERY_TIME", row))
+            continue
+        dt = dt.astimezone(timezone.utc)
+        docs.append({
+            "Transaction_ID": tx_id,
+            "LORRY_ID": lorry_id,
+            "WEIGHT": weight,
+            "DELIVERY_TIME": dt.strftime("%Y-%m-%dT%H:%M:%S"),
+            "DELIVERY_AT": dt,
+        })
+    return docs, rejects
+
+
+def parse_lorries(header: Sequence[str], first_line: int, rows: List[List[str]]) -> Tuple[List[Dict], List[Reject]]:
+    """Validate a chunk of lorries.csv rows into documents."""
+    indexes = _indexes(header, LORRY_COLUMNS)
+    width = max(indexes) + 1
+    docs, rejects = [], []
+    for line, row in enumerate(rows, first_line):
+        if len(row) < width:
+            rejects.append((line, "missing columns", row))
+            continue
+        doc = {column: row[i].strip() for column, i in zip(LORRY_COLUMNS, indexes)}
+        if not doc["LORRY_ID"]:
+            rejects.append((line, "missing LORRY_ID", row))
+            continue
+        docs.append(doc)
+    return docs, rejects
+
+
+PARSERS = {"deliveries": parse_deliveries, "lorries": parse_lorries}
+
+
+def ensure_indexes(db) -> None:
+    # Upserts look documents up by these keys; without an index every
+    # upsert is a collection scan. Not unique: existing data may repeat ids.
+    db["deliveries"].create_index([("Transaction_ID", pymongo.ASCENDING)], name="Transaction_ID_1")
+    db["lorries"].create_index([("LORRY_ID", pymongo.ASCENDING)], name="LORRY_ID_1")
+
+
+def write(db, kind: str, docs: List[Dict]) -> Tuple[int, List[Dict]]:
+    """Upsert a chunk; returns (documents matched, documents newly inserted)."""
+    if not docs:
+        return 0, []
+    key = KEYS[kind]
+    ops = [UpdateOne({key: doc[key]}, {"$set": doc}, upsert=True) for doc in docs]
+    result = db[kind].bulk_write(ops, ordered=False)
+    inserted = [docs[i] for i in sorted(result.upserted_ids)]
+    return result.matched_count, inserted
@@ -0,0 +1,368 @@
+"""Server-Sent Events feed of new deliveries for the dashboard.
+
+One ``Publisher`` per process watches the data version (see caching.py).
+When it changes, the publisher reads only the deliveries past its
+``DELIVERY_AT`` cursor (an index range scan) and publishes one update to
+every connected screen:
+
+- ``kpis``: the KPI tiles, re-rendered with running totals and the deltas;
+- ``latest``: table rows for the new deliveries (newest first);
+- ``buckets``: JSON weight deltas per changed (period bucket, lorry type)
+  for each granularity, applied to the charts in the browser.
+
+The KPI baseline is computed once, when the first screen connects, so N
+screens cost one computation rather than N page renders. Deliveries saved in
+this process wake the publisher immediately (see signals.py); writes from
+other processes are seen within ``DASHBOARD_LIVE_POLL_SECONDS``. The feed
+covers the default (unfiltered) dashboard windows. Deliveries that arrive
+with a timestamp older than the cursor appear on the next full page load.
+
+Under WSGI the ``/live/`` view streams from a worker thread; under ASGI,
+``asgi_router`` serves the same feed natively, so waiting screens do not
+hold threads.
+"""
+
+import asyncio
+from collections import defaultdict, deque
+import json
+import logging
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+
+from . import caching, lorry_cache
+from .models import Transaction
+from .timeutils import delivery_datetime, get_period_key
+
+logger = logging.getLogger(__name__)
+
+PATH = "/live/"
+PERIODS = ("hourly", "daily", "weekly", "monthly")
+LATEST_ROWS = 20
+
+Event = Tuple[str, str]  # (event name, data)
+
+
+def _setting(name: str, default: float) -> float:
+    return float(getattr(settings, name, default))
+
+
+def format_event(event_id: str, name: str, data: str) -> str:
+    lines = [f"id: {event_id}", f"event: {name}"]
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+class Publisher:
+    def __init__(self):
+        self.token = uuid.uuid4().hex[:8]
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._backlog: deque = deque(maxlen=int(_setting("DASHBOARD_LIVE_BACKLOG", 100)))
+        self._async_waiters = set()
+        self._subscribers = 0
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._version: Optional[str] = None
+        self._cursor = None
+        self._at_cursor = set()
+        self._kpis: Optional[Dict] = None
+        self._lorries = set()
+
+    # -- subscribers -------------------------------------------------------
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> int:
+        """Register a screen; returns the sequence to read after.
+
+        A ``Last-Event-ID`` from this process resumes from the backlog.
+        """
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="dashboard-live", daemon=True)
+                self._thread.start()
+                self._wake.set()  # load the baseline now
+            token, _, seq = (last_event_id or "").partition("-")
+            if token == self.token and seq.isdigit() and self._backlog and int(seq) >= self._backlog[0][0] - 1:
+                return int(seq)
+            return self._seq
+
+    def unsubscribe(self) -> None:
+        with self._cond:
+            self._subscribers = max(0, self._subscribers - 1)
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def _pending(self, after: int) -> List[Tuple[int, List[Event]]]:
+        return [item for item in self._backlog if item[0] > after]
+
+    def wait(self, after: int, timeout: float) -> List[Tuple[int, List[Event]]]:
+        """Updates published after ``after``, waiting up to ``timeout`` seconds."""
+        with self._cond:
+            if not self._pending(after):
+                self._cond.wait(timeout)
+            return self._pending(after)
+
+    async def wait_async(self, after: int, timeout: float) -> List[Tuple[int, List[Event]]]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._cond:
+            pending = self._pending(after)
+            if pending:
+                return pending
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+        with self._cond:
+            return self._pending(after)
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.token}-{seq}"
+
+    # -- publishing --------------------------------------------------------
+
+    def publish(self, events: List[Event]) -> int:
+        with self._cond:
+            self._seq += 1
+            self._backlog.append((self._seq, events))
+            self._cond.notify_all()
+            for loop, future in list(self._async_waiters):
+                loop.call_soon_threadsafe(_resolve, future)
+            return self._seq
+
+    def notify(self) -> None:
+        """Check for new deliveries now instead of at the next poll."""
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(_setting("DASHBOARD_LIVE_POLL_SECONDS", 2))
+            self._wake.clear()
+            if not self._subscribers:
+                continue
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Live feed update failed")
+
+    def poll(self) -> Optional[int]:
+        """Publish an update if deliveries past the cursor exist or the data
+        version moved; returns its sequence."""
+        version, _ = caching.data_version()
+        if self._kpis is None:
+            self._version = version
+            self._load_baseline()
+            return None
+        if version == self._version and not self._has_new():
+            return None
+        self._version = version
+        events = self._update(self._new_entries())
+        return self.publish(events) if events else None
+
+    def _kpi_window(self):
+        from .views import kpi_window
+
+        return kpi_window()
+
+    def _load_baseline(self) -> None:
+        newest = Transaction.objects.filter(delivery_at__isnull=False).order_by("-delivery_at").first()
+        self._cursor = delivery_datetime(newest) if newest is not None else None
+        since, until = self._kpi_window()
+        if self._cursor is not None:
+            until = min(until, self._cursor)
+        from .views import DashboardSnapshot
+
+        snapshot = DashboardSnapshot((since, until))
+        self._kpis = snapshot.kpis(since, until)
+        self._lorries = {tx.lorry_id for _, tx in snapshot.entries}
+        self._at_cursor = set()
+        if newest is not None:
+            self._at_cursor = set(
+                Transaction.objects.filter(delivery_at=newest.delivery_at).values_list("transaction_id", flat=True)
+            )
+
+    def _has_new(self) -> bool:
+        # An indexed probe on DELIVERY_AT_1: sees inserts from any process.
+        qs = Transaction.objects.filter(delivery_at__isnull=False)
+        if self._cursor is not None:
+            qs = qs.filter(delivery_at__gt=self._cursor)
+        return qs.exists()
+
+    def _new_entries(self) -> List[Tuple]:
+        qs = Transaction.objects.filter(delivery_at__isnull=False)
+        if self._cursor is not None:
+            qs = qs.filter(delivery_at__gte=self._cursor)
+        entries = []
+        for tx in qs.order_by("delivery_at"):
+            dt = delivery_datetime(tx)
+            if dt == self._cursor and tx.transaction_id in self._at_cursor:
+                continue
+            entries.append((dt, tx))
+        if entries:
+            newest = entries[-1][0]
+            if newest != self._cursor:
+                self._cursor, self._at_cursor = newest, set()
+            self._at_cursor.update(tx.transaction_id for dt, tx in entries if dt == newest)
+        return entries
+
+    def _update(self, entries) -> List[Event]:
+        since, until = self._kpi_window()
+        entries = [(dt, tx) for dt, tx in entries if since <= dt <= until]
+        if not entries:
+            return []
+        lookup = lorry_cache.lorries.lookup()
+        weight = sum(float(tx.weight or 0) for _, tx in entries)
+        new_lorries = {tx.lorry_id for _, tx in entries} - self._lorries
+        self._lorries |= new_lorries
+        kpis = self._kpis
+        kpis["kpi_total_deliveries"] += len(entries)
+        kpis["kpi_total_weight_kg"] += weight
+        kpis["kpi_total_weight_tons"] = kpis["kpi_total_weight_kg"] / 1000.0
+        kpis["kpi_unique_lorries"] = len(self._lorries)
+        deltas = {
+            "delta_deliveries": len(entries),
+            "delta_weight_kg": weight,
+            "delta_weight_tons": weight / 1000.0,
+            "delta_unique_lorries": len(new_lorries),
+        }
+        rows = [
+            {
+                "transaction_id": tx.transaction_id,
+                "lorry_id": tx.lorry_id,
+                "lorry_types_id": getattr(lookup.get(tx.lorry_id), "types_id", "Unknown"),
+                "weight": tx.weight,
+                "delivery_time": tx.delivery_time,
+            }
+            for _, tx in reversed(entries[-LATEST_ROWS:])
+        ]
+        return [
+            ("kpis", render_to_string("dashboard/_kpis.html", dict(kpis, **deltas))),
+            ("latest", render_to_string("dashboard/_latest_rows.html", {"transactions": rows})),
+            ("buckets", json.dumps(_bucket_deltas(entries, lookup))),
+        ]
+
+
+def _resolve(future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+def _bucket_deltas(entries, lookup) -> Dict[str, List]:
+    """{period: [[bucket label, lorry type, weight delta], ...]} for each granularity."""
+    from .views import build_aggregated_rows, get_window
+
+    out = {}
+    for period in PERIODS:
+        since, until = get_window(period)
+        agg = defaultdict(lambda: defaultdict(float))
+        for dt, tx in entries:
+            if since <= dt <= until:
+                info = lookup.get(tx.lorry_id)
+                agg[get_period_key(dt, period)][info.types_id if info else "Unknown"] += float(tx.weight or 0)
+        out[period] = [
+            [r["period_display"], r["lorry__lorry_type"], r["total_weight"]]
+            for r in build_aggregated_rows(agg, period)
+        ]
+    return out
+
+
+publisher = Publisher()
+
+
+def _heartbeat() -> float:
+    return _setting("DASHBOARD_LIVE_HEARTBEAT_SECONDS", 15)
+
+
+def _stream(last_event_id: Optional[str]):
+    seq = publisher.subscribe(last_event_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            pending = publisher.wait(seq, _heartbeat())
+            if not pending:
+                yield ": keep-alive\n\n"
+                continue
+            for seq, events in pending:
+                for name, data in events:
+                    yield format_event(publisher.event_id(seq), name, data)
+    finally:
+        publisher.unsubscribe()
+
+
+def live_feed(request):
+    """SSE stream (WSGI). Each connected screen holds one worker thread."""
+    response = StreamingHttpResponse(
+        _stream(request.headers.get("Last-Event-ID")), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def sse_app(scope, receive, send) -> None:
+    """The same stream as ``live_feed`` as a native ASGI app."""
+    headers = dict(scope.get("headers") or [])
+    last_event_id = headers.get(b"last-event-id", b"").decode("latin-1") or None
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    seq = publisher.subscribe(last_event_id)
+    try:
+        await send({"type": "http.response.body", "body": b"retry: 5000\n\n", "more_body": True})
+        while not disconnected.done():
+            waiter = asyncio.ensure_future(publisher.wait_async(seq, _heartbeat()))
+            await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                break
+            pending = waiter.result()
+            if not pending:
+                chunk = ": keep-alive\n\n"
+            else:
+                chunk = "".join(
+                    format_event(publisher.event_id(s), name, data) for s, events in pending for name, data in events
+                )
+                seq = pending[-1][0]
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        publisher.unsubscribe()
+        disconnected.cancel()
+
+
+async def _wait_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def asgi_router(application):
+    """Serve ``PATH`` with ``sse_app`` and everything else with ``application``.
+
+    Django 3.2 iterates streaming responses synchronously on the event loop,
+    so a long-lived stream has to bypass it under ASGI.
+    """
+
+    async def router(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == PATH:
+            return await sse_app(scope, receive, send)
+        return await application(scope, receive, send)
+
+    return router
@@ -0,0 +1,95 @@
+"""Process-wide in-memory cache of the ``lorries`` dimension table.
+
+The table is tiny and rarely changes, so hot paths read it from here
+instead of querying Mongo on every request. Entries expire after
+``DASHBOARD_LORRY_CACHE_TTL`` seconds and are dropped immediately when a
+Lorry is saved or deleted in this process (see signals.py).
+"""
+
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+
+
+class LorryInfo(NamedTuple):
+    lorry_id: str
+    types_id: str
+    client_id: str
+    make_id: str
+
+
+class LorryCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Optional[Dict[str, LorryInfo]] = None
+        self._loaded_at = 0.0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl(self) -> float:
+        return float(getattr(settings, "DASHBOARD_LORRY_CACHE_TTL", 300))
+
+    def _current(self) -> Optional[Dict[str, LorryInfo]]:
+        data = self._data
+        if data is not None and time.monotonic() - self._loaded_at < self._ttl():
+            return data
+        return None
+
+    def lookup(self) -> Dict[str, LorryInfo]:
+        """Mapping of lorry_id -> LorryInfo, reloaded when stale."""
+        data = self._current()
+        if data is None:
+            with self._lock:
+                data = self._current()
+                if data is None:
+                    return self._load()
+        self.hits += 1
+        return data
+
+    def _load(self) -> Dict[str, LorryInfo]:
+        from .models import Lorry
+
+        self.misses += 1
+        data = {
+            l.lorry_id: LorryInfo(l.lorry_id, l.types_id, l.client_id, l.make_id)
+            for l in Lorry.objects.all()
+        }
+        self._data = data
+        self._loaded_at = time.monotonic()
+        return data
+
+    def get(self, lorry_id: str) -> Optional[LorryInfo]:
+        return self.lookup().get(lorry_id)
+
+    def matching_ids(self, lorry_type: Optional[str] = None, client_id: Optional[str] = None) -> Optional[List[str]]:
+        """Lorry ids matching the dimension filters, or None when unfiltered.
+
+        Lets delivery queries filter on LORRY_ID without a join.
+        """
+        if not lorry_type and not client_id:
+            return None
+        return sorted(
+            info.lorry_id
+            for info in self.lookup().values()
+            if (not lorry_type or info.types_id == lorry_type) and (not client_id or info.client_id == client_id)
+        )
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._data = None
+            self.version += 1
+
+    def stats(self) -> Dict:
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data) if self._data is not None else 0,
+            "ttl": self._ttl(),
+        }
+
+
+lorries = LorryCache()
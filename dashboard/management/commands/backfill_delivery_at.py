@@ -0,0 +1,87 @@
+"""Backfill the typed DELIVERY_AT field on ``deliveries`` in batches.
+
+Only documents without DELIVERY_AT are visited, so an interrupted run can
+simply be restarted and picks up where it stopped. Values that cannot be
+parsed are stored as null and flagged with DELIVERY_AT_INVALID, so neither
+this command nor the dashboard's window queries read them again.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import caching, mongo
+from dashboard.timeutils import parse_delivery_times
+
+try:
+    import pymongo  # type: ignore
+    from pymongo import UpdateOne  # type: ignore
+except Exception:  # pragma: no cover
+    pymongo = None
+
+
+class Command(BaseCommand):
+    help = "Backfill deliveries.DELIVERY_AT (BSON date) from DELIVERY_TIME and create its indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--limit", type=int, default=0, help="Stop after this many documents (0 = no limit)."
+        )
+
+    def handle(self, *args, **options):
+        db = mongo.get_db()
+        if db is None:
+            raise CommandError("MONGO_DB_URL / MONGO_DB_NAME must be set and pymongo installed.")
+        batch_size = max(1, options["batch_size"])
+        limit = options["limit"]
+
+        coll = db["deliveries"]
+        coll.create_index([("DELIVERY_AT", pymongo.ASCENDING)], name="DELIVERY_AT_1")
+        # /api/transactions/ pages with a keyset cursor on (DELIVERY_AT, Transaction_ID).
+        coll.create_index(
+            [("DELIVERY_AT", pymongo.ASCENDING), ("Transaction_ID", pymongo.ASCENDING)],
+            name="DELIVERY_AT_1_Transaction_ID_1",
+        )
+        # Missing or null DELIVERY_AT (the latter from runs before the flag existed).
+        pending = {"DELIVERY_AT": None, "DELIVERY_AT_INVALID": {"$exists": False}}
+        remaining = coll.count_documents(pending)
+        self.stdout.write(f"{remaining:,} documents to backfill")
+
+        done = unparsed = 0
+        last_id = None
+        started = time.monotonic()
+        while not limit or done < limit:
+            query = dict(pending)
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            size = batch_size if not limit else min(batch_size, limit - done)
+            docs = list(
+                coll.find(query, {"DELIVERY_TIME": 1})
+                .sort("_id", pymongo.ASCENDING)
+                .limit(size)
+            )
+            if not docs:
+                break
+            ops = []
+            parsed = parse_delivery_times([doc.get("DELIVERY_TIME") for doc in docs])
+            for doc, dt in zip(docs, parsed):
+                update = {"DELIVERY_AT": dt}
+                if dt is None:
+                    unparsed += 1
+                    update["DELIVERY_AT_INVALID"] = True
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+            coll.bulk_write(ops, ordered=False)
+            done += len(docs)
+            last_id = docs[-1]["_id"]
+            elapsed = time.monotonic() - started
+            rate = done / elapsed if elapsed else 0.0
+            self.stdout.write(f"{done:,}/{remaining:,} rows ({rate:,.0f} rows/sec)")
+
+        if done:
+            caching.bump_data_version()
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {done:,} rows in {elapsed:.1f}s ({rate:,.0f} rows/sec); {unparsed:,} unparseable"
+        ))
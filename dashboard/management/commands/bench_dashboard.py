@@ -0,0 +1,179 @@
+"""Benchmark dashboard endpoints and tools as the deliveries collection grows.
+
+Loads synthetic data (see dashboard/synthetic.py) into the configured
+database in increasing sizes and, at each size, times ``dashboard_view``,
+``/api/aggregated/``, ``ai_tools.totals`` and ``python_aggregate`` for every
+period with cold caches (plus one warm run), reporting latency, peak RSS,
+ORM queries and MongoDB commands. Results are saved as JSON.
+
+The target database is dropped and reloaded, so its name must contain
+"bench" (e.g. ``MONGO_DB_NAME=iswmc_bench``) unless ``--force`` is given.
+"""
+
+from datetime import datetime, timezone as dt_timezone
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import RequestFactory
+
+from dashboard import ai_tools, bench, caching, columnar, ingest, lorry_cache, mongo, rollups, synthetic, views
+from dashboard.timeutils import window_transactions
+
+try:
+    import pymongo  # type: ignore
+except Exception:  # pragma: no cover
+    pymongo = None
+
+PERIODS = ("hourly", "daily", "weekly", "monthly")
+
+
+def _cold():
+    cache.clear()
+    caching.clear_answers()
+    lorry_cache.lorries.invalidate()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark dashboard endpoints at 10k..10M synthetic deliveries and save JSON results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10k,100k,1M", help="Comma-separated, e.g. 10k,100k,1M,10M.")
+        parser.add_argument("--repeat", type=int, default=3, help="Cold runs per target.")
+        parser.add_argument("--periods", default=",".join(PERIODS))
+        parser.add_argument("--outliers", type=float, default=0.01)
+        parser.add_argument("--seed", type=int, default=7)
+        parser.add_argument("--batch-size", type=int, default=10000, help="Insert batch size.")
+        parser.add_argument("--out", help="JSON output path (default bench-results/<timestamp>.json).")
+        parser.add_argument("--force", action="store_true", help="Allow a database name without 'bench'.")
+
+    def handle(self, *args, **options):
+        name = settings.DATABASES["default"].get("NAME") or ""
+        if "bench" not in name and not options["force"]:
+            raise CommandError(f"Refusing to drop and reload {name!r}; use a *bench* database or --force.")
+        sizes = sorted(synthetic.parse_sizes(options["sizes"]))
+        periods = [p for p in options["periods"].split(",") if p in PERIODS]
+        if not sizes or not periods:
+            raise CommandError("Nothing to run: check --sizes and --periods.")
+
+        # Clients created from here on report their commands to the counter.
+        bench.install()
+        connections.close_all()
+        mongo.close()
+        db = mongo.get_db()
+        if db is None:
+            raise CommandError("MONGO_DB_URL / MONGO_DB_NAME must be set and pymongo installed.")
+
+        lorry_rows, delivery_rows = synthetic.dataset(
+            sizes[-1], seed=options["seed"], outliers=options["outliers"]
+        )
+        self._reset(db, lorry_rows)
+
+        started_at = datetime.now(dt_timezone.utc)
+        results = []
+        loaded = 0
+        for size in sizes:
+            t0 = time.monotonic()
+            loaded += self._load(db, itertools.islice(delivery_rows, size - loaded), loaded, options["batch_size"])
+            self._prepare()
+            self.stdout.write(f"== {size:,} deliveries (loaded in {time.monotonic() - t0:.1f}s)")
+            for period in periods:
+                for target, fn in self._targets(period):
+                    for mode, repeat in (("cold", options["repeat"]), ("warm", 1)):
+                        before = _cold if mode == "cold" else None
+                        row = {"size": size, "target": target, "period": period, "cache": mode}
+                        row.update(bench.measure(fn, repeat=repeat, before=before))
+                        results.append(row)
+                        self.stdout.write(
+                            f"{target:<16} {period:<8} {mode:<5} "
+                            f"p50 {row['latency_ms']['p50']:9.1f} ms  "
+                            f"rss {row['peak_rss_mb']:7.1f} MB (+{row['rss_growth_mb']:.1f})  "
+                            f"orm {row['orm_queries']:3d}  mongo {row['mongo_commands']:4d}"
+                        )
+
+        out = options["out"] or os.path.join(
+            "bench-results", f"bench-{started_at.strftime('%Y%m%dT%H%M%SZ')}.json"
+        )
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        with open(out, "w") as f:
+            json.dump({
+                "started_at": started_at.isoformat(),
+                "commit": _git_commit(),
+                "backend": getattr(settings, "DASHBOARD_AGGREGATION_BACKEND", "python"),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "sizes": sizes,
+                "repeat": options["repeat"],
+                "results": results,
+            }, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Saved {len(results)} results to {out}"))
+
+    def _reset(self, db, lorry_rows):
+        for coll in ("deliveries", "lorries", rollups.COLLECTION):
+            db[coll].drop()
+        docs, _ = ingest.parse_lorries(synthetic.LORRY_COLUMNS, 2, lorry_rows)
+        db["lorries"].insert_many(docs)
+        ingest.ensure_indexes(db)
+        db["deliveries"].create_index([("DELIVERY_AT", pymongo.ASCENDING)], name="DELIVERY_AT_1")
+        db["deliveries"].create_index(
+            [("DELIVERY_AT", pymongo.ASCENDING), ("Transaction_ID", pymongo.ASCENDING)],
+            name="DELIVERY_AT_1_Transaction_ID_1",
+        )
+
+    def _load(self, db, rows, first_line, batch_size):
+        loaded = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return loaded
+            docs, _ = ingest.parse_deliveries(synthetic.DELIVERY_COLUMNS, first_line + loaded, batch)
+            # Keep the generated DELIVERY_TIME formats; ingest would normalize them.
+            raw = {row[0]: row[3] for row in batch}
+            for doc in docs:
+                doc["DELIVERY_TIME"] = raw[doc["Transaction_ID"]]
+            db["deliveries"].insert_many(docs, ordered=False)
+            loaded += len(batch)
+
+    def _prepare(self):
+        caching.bump_data_version()
+        if rollups.enabled():
+            rollups.rebuild()
+        if columnar.enabled():
+            columnar.invalidate()
+
+    def _targets(self, period):
+        factory = RequestFactory()
+        api = views.AggregatedDataAPIView.as_view()
+        since, until = views.get_window(period)
+
+        def dashboard():
+            views.dashboard_view(factory.get("/", {"period": period}))
+
+        def aggregated_api():
+            api(factory.get("/api/aggregated/", {"period": period})).render()
+
+        txs = window_transactions(since, until)
+        return [
+            ("dashboard_view", dashboard),
+            ("aggregated_api", aggregated_api),
+            ("ai_tools.totals", lambda: ai_tools.totals(period)),
+            # Window already fetched: measures the in-process grouping alone.
+            ("python_aggregate", lambda: views.python_aggregate(txs, period)),
+        ]
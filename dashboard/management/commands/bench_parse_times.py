@@ -0,0 +1,41 @@
+"""Micro-benchmark: parse_delivery_time per value vs parse_delivery_times batch."""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from dashboard import synthetic, timeutils
+from dashboard.timeutils import parse_delivery_time, parse_delivery_times
+
+
+class Command(BaseCommand):
+    help = "Time the DELIVERY_TIME parsers on synthetic strings in the deliveries.csv format."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument(
+            "--outliers", type=float, default=0.0,
+            help="Fraction of rows in other formats (e.g. 0.01 for 1%%).",
+        )
+        parser.add_argument("--seed", type=int, default=7)
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        values = list(synthetic.delivery_times(rows, options["seed"], options["outliers"]))
+        self.stdout.write(f"{rows:,} values, {options['outliers']:.1%} outliers")
+
+        def run(label, fn):
+            started = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{label:<32} {elapsed:8.3f}s  {rows / elapsed:>12,.0f} rows/sec")
+            return elapsed, result
+
+        base, expected = run("parse_delivery_time (per value)", lambda: [parse_delivery_time(v) for v in values])
+        batch, got = run("parse_delivery_times", lambda: parse_delivery_times(values))
+        if got != expected:
+            self.stderr.write("batch results differ from parse_delivery_time")
+        self.stdout.write(f"speedup: {base / batch:.1f}x")
+        if timeutils.np is not None:
+            arr, _ = run("parse_delivery_times (numpy)", lambda: parse_delivery_times(values, as_numpy=True))
+            self.stdout.write(f"speedup: {base / arr:.1f}x")
@@ -0,0 +1,43 @@
+"""Compare aggregation engines on the configured database.
+
+Runs ``engine.compare`` with the Python engine as the reference for every
+period, optionally over a window and lorry filters, and lists the buckets
+where the other engines disagree. Run it before switching
+DASHBOARD_AGGREGATION_BACKEND (after ``rebuild_rollups`` for ``rollup``).
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import engine
+from dashboard.timeutils import TRIAL_END, TRIAL_START, parse_bound
+
+
+class Command(BaseCommand):
+    help = "Check that aggregation engines agree with the Python engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--engines", default="mongo,rollup,columnar", help="Engines to check against python.")
+        parser.add_argument("--since", help="Start, e.g. 2025-01-01 (default: trial start)")
+        parser.add_argument("--until", help="End, inclusive (default: trial end)")
+        parser.add_argument("--lorry-type")
+        parser.add_argument("--client-id")
+
+    def handle(self, *args, **options):
+        names = [n.strip() for n in options["engines"].split(",") if n.strip()]
+        unknown = [n for n in names if n not in engine.ENGINES]
+        if unknown:
+            raise CommandError(f"Unknown engines: {', '.join(unknown)}")
+        try:
+            since = parse_bound(options["since"]) or TRIAL_START
+            until = parse_bound(options["until"], end=True) or TRIAL_END
+        except ValueError as e:
+            raise CommandError(str(e))
+        engines = [engine.python_engine] + [engine.ENGINES[n] for n in names if n != "python"]
+        problems = engine.compare(
+            engines, since, until, lorry_type=options["lorry_type"], client_id=options["client_id"]
+        )
+        for line in problems:
+            self.stdout.write(line)
+        if problems:
+            raise CommandError(f"{len(problems)} differences")
+        self.stdout.write(self.style.SUCCESS(f"{', '.join(e.name for e in engines)} agree"))
@@ -0,0 +1,48 @@
+"""Write synthetic lories.csv / deliveries.csv files for load tests."""
+
+import csv
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import synthetic
+
+
+class Command(BaseCommand):
+    help = "Generate lories.csv and deliveries.csv in the guides/ schema (load with ingest_csv)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", default="100k", help="Deliveries to generate, e.g. 10k, 1M, 10M.")
+        parser.add_argument("--lorries", type=int, default=100)
+        parser.add_argument(
+            "--outliers", type=float, default=0.01,
+            help="Fraction of DELIVERY_TIME values in other formats (e.g. 0.01 for 1%%).",
+        )
+        parser.add_argument("--days", type=int, default=31, help="Spread deliveries over this many days.")
+        parser.add_argument("--seed", type=int, default=7)
+        parser.add_argument("--out", default="synthetic", help="Output directory.")
+
+    def handle(self, *args, **options):
+        sizes = synthetic.parse_sizes(options["rows"])
+        if len(sizes) != 1 or sizes[0] <= 0:
+            raise CommandError("--rows takes a single positive size, e.g. 1M")
+        rows = sizes[0]
+        os.makedirs(options["out"], exist_ok=True)
+        lorry_rows, delivery_rows = synthetic.dataset(
+            rows, options["lorries"], options["seed"], options["outliers"], options["days"]
+        )
+        started = time.monotonic()
+        with open(os.path.join(options["out"], "lories.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(synthetic.LORRY_COLUMNS)
+            writer.writerows(lorry_rows)
+        path = os.path.join(options["out"], "deliveries.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(synthetic.DELIVERY_COLUMNS)
+            writer.writerows(delivery_rows)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {len(lorry_rows):,} lorries and {rows:,} deliveries to {options['out']}/ in {elapsed:.1f}s"
+        ))
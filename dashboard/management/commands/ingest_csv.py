@@ -0,0 +1,146 @@
+"""Bulk-load deliveries.csv / lorries.csv files into MongoDB.
+
+Files are streamed in ``--batch-size`` chunks; each chunk is validated
+(optionally on a process pool) and written with one unordered bulk upsert,
+so memory stays bounded and re-runs are idempotent. Ingest lorries before
+the deliveries that reference them so rollups pick up their types. The
+dashboard caches are warmed afterwards (see dashboard/warmup.py).
+"""
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import caching, columnar, ingest, lorry_cache, mongo, rollups, warmup
+
+
+def _chunks(reader, size):
+    rows, first, line = [], 2, 1
+    for row in reader:
+        line += 1
+        if not row:
+            continue
+        if not rows:
+            first = line
+        rows.append(row)
+        if len(rows) >= size:
+            yield first, rows
+            rows = []
+    if rows:
+        yield first, rows
+
+
+def _parallel(pool, fn, header, chunks, depth):
+    """Like pool.map, but with at most ``depth`` chunks in flight."""
+    pending = deque()
+    for first, rows in chunks:
+        pending.append(pool.submit(fn, header, first, rows))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class Command(BaseCommand):
+    help = "Ingest deliveries/lorries CSV files with batched, idempotent upserts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="CSV files (kind detected from the header).")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--workers", type=int, default=0, help="Parse in this many processes (0 = in-process)."
+        )
+        parser.add_argument("--rejects", help="Write rejected rows here as CSV (file, line, reason, row...).")
+        parser.add_argument(
+            "--no-prewarm", action="store_true", help="Skip warming the dashboard caches afterwards."
+        )
+
+    def handle(self, *args, **options):
+        db = mongo.get_db()
+        if db is None:
+            raise CommandError("MONGO_DB_URL / MONGO_DB_NAME must be set and pymongo installed.")
+        batch_size = max(1, options["batch_size"])
+        workers = max(0, options["workers"])
+        ingest.ensure_indexes(db)
+
+        pool = None
+        if workers > 1:
+            # Fork so workers inherit the configured Django app registry.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork") if "fork" in methods else None
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        rejects_file = open(options["rejects"], "w", newline="") if options["rejects"] else None
+        rejects_writer = csv.writer(rejects_file) if rejects_file else None
+
+        total = inserted_total = 0
+        reasons: Counter = Counter()
+        started = time.monotonic()
+        try:
+            for path in options["paths"]:
+                with open(path, newline="", encoding="utf-8-sig") as f:
+                    reader = csv.reader(f)
+                    try:
+                        header = next(reader)
+                        kind = ingest.detect_kind(header)
+                    except (StopIteration, ValueError) as e:
+                        raise CommandError(f"{path}: {str(e) or 'empty file'}")
+                    parse = ingest.PARSERS[kind]
+                    chunks = _chunks(reader, batch_size)
+                    if pool is not None:
+                        results = _parallel(pool, parse, header, chunks, 2 * workers)
+                    else:
+                        results = (parse(header, first, rows) for first, rows in chunks)
+
+                    file_rows = 0
+                    last_report = started
+                    for docs, rejects in results:
+                        _, inserted = ingest.write(db, kind, docs)
+                        if kind == "deliveries" and inserted:
+                            self._fold_in(inserted)
+                        for line, reason, row in rejects:
+                            reasons[reason] += 1
+                            if rejects_writer:
+                                rejects_writer.writerow([path, line, reason, *row])
+                        file_rows += len(docs) + len(rejects)
+                        total += len(docs)
+                        inserted_total += len(inserted)
+                        now = time.monotonic()
+                        if now - last_report >= 5:
+                            last_report = now
+                            rate = total / (now - started)
+                            self.stdout.write(f"{path}: {file_rows:,} rows ({rate:,.0f} rows/sec)")
+                if kind == "lorries":
+                    lorry_cache.lorries.invalidate()
+                self.stdout.write(f"{path}: {file_rows:,} {kind} rows read")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if rejects_file:
+                rejects_file.close()
+            if total:
+                caching.bump_data_version()
+
+        elapsed = time.monotonic() - started
+        rate = total / elapsed if elapsed else 0.0
+        rejected = sum(reasons.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"Upserted {total:,} rows ({inserted_total:,} new) in {elapsed:.1f}s "
+            f"({rate:,.0f} rows/sec); {rejected:,} rejected"
+        ))
+        for reason, count in reasons.most_common():
+            self.stdout.write(f"  {reason}: {count:,}")
+        if total and warmup.enabled() and not options["no_prewarm"]:
+            state = warmup.prewarm()
+            self.stdout.write(f"Cache warm-up {state['status']} in {state['seconds']:.1f}s")
+
+    def _fold_in(self, docs):
+        # Only newly inserted deliveries: re-runs must not double-count.
+        entries = [(d["DELIVERY_AT"], d["LORRY_ID"], d["WEIGHT"]) for d in docs]
+        if rollups.enabled():
+            rollups.record(entries)
+        if columnar.enabled():
+            columnar.record((d["Transaction_ID"], *entry) for d, entry in zip(docs, entries))
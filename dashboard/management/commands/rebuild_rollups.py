@@ -0,0 +1,34 @@
+"""Rebuild hourly delivery_rollups from raw deliveries for a time range."""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard import caching, rollups
+from dashboard.timeutils import parse_delivery_time
+
+
+class Command(BaseCommand):
+    help = "Recompute delivery_rollups for [--since, --until) (whole collection if omitted)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="Start, e.g. 2025-01-01 or 2025-01-01T08:00:00")
+        parser.add_argument("--until", help="End (exclusive), same formats as --since")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        bounds = {}
+        for key in ("since", "until"):
+            raw = options[key]
+            if raw:
+                bounds[key] = parse_delivery_time(raw)
+                if bounds[key] is None:
+                    raise CommandError(f"Could not parse --{key} {raw!r}")
+        started = time.monotonic()
+        try:
+            written = rollups.rebuild(batch_size=options["batch_size"], **bounds)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        caching.bump_data_version()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written:,} rollup documents in {elapsed:.1f}s"))
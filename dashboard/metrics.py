@@ -0,0 +1,225 @@
+"""Lightweight request phase timing: spans, Server-Timing and /metrics.
+
+Hot paths wrap their phases in ``with metrics.span("db"):``. While a
+request runs (see ``MetricsMiddleware``) the phase durations are summed per
+request and sent back in a ``Server-Timing`` header; every span also feeds a
+rolling window of the last ``DASHBOARD_METRICS_WINDOW`` samples per
+(endpoint, phase), from which ``/metrics`` reports p50/p95/p99 in the
+Prometheus text format. Spans outside a request are recorded under the
+endpoint ``-``.
+
+A span costs two ``perf_counter`` calls, a dict update and a locked deque
+append, so it is cheap enough to leave on.
+"""
+
+import asyncio
+from collections import deque
+import contextvars
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current: contextvars.ContextVar = contextvars.ContextVar("dashboard_metrics_request", default=None)
+
+
+class _Request:
+    __slots__ = ("endpoint", "phases")
+
+    def __init__(self):
+        self.endpoint = "-"
+        self.phases: Dict[str, float] = {}
+
+
+class _Series:
+    __slots__ = ("samples", "count", "total")
+
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, str], _Series] = {}
+
+    def observe(self, endpoint: str, phase: str, seconds: float) -> None:
+        key = (endpoint, phase)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(int(getattr(settings, "DASHBOARD_METRICS_WINDOW", 1024)))
+            series.samples.append(seconds)
+            series.count += 1
+            series.total += seconds
+
+    def snapshot(self) -> Dict[Tuple[str, str], Dict]:
+        with self._lock:
+            items = [(k, list(s.samples), s.count, s.total) for k, s in self._series.items()]
+        out = {}
+        for key, samples, count, total in sorted(items):
+            samples.sort()
+            out[key] = {
+                "count": count,
+                "sum": total,
+                "quantiles": {q: _quantile(samples, q) for q in QUANTILES},
+            }
+        return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+def _quantile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+registry = Registry()
+
+
+@contextmanager
+def span(phase: str) -> Iterator[None]:
+    """Time a phase of the current request (or of background work)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        request = _current.get()
+        if request is not None:
+            request.phases[phase] = request.phases.get(phase, 0.0) + elapsed
+            registry.observe(request.endpoint, phase, elapsed)
+        else:
+            registry.observe("-", phase, elapsed)
+
+
+def server_timing(phases: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items())
+
+
+class MetricsMiddleware:
+    """Times each request and its spans; adds the Server-Timing header."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Lets Django 3.2 see this instance as a coroutine function.
+            self._is_coroutine = getattr(asyncio.coroutines, "_is_coroutine", None)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        state = _Request()
+        token = _current.set(state)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, state, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        state = _Request()
+        token = _current.set(state)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, state, time.perf_counter() - started)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # The URL is resolved now; label the spans that follow with it.
+        state = _current.get()
+        if state is not None:
+            state.endpoint = _endpoint(request)
+        return None
+
+    def _finish(self, request, response, state: _Request, elapsed: float):
+        registry.observe(_endpoint(request), "total", elapsed)
+        response["Server-Timing"] = server_timing(dict(state.phases, total=elapsed))
+        return response
+
+
+def _endpoint(request) -> str:
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.url_name or match.view_name or "-"
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(extra: Optional[List[str]] = None) -> str:
+    lines = [
+        "# HELP dashboard_phase_seconds Request phase durations (rolling window quantiles).",
+        "# TYPE dashboard_phase_seconds summary",
+    ]
+    for (endpoint, phase), data in registry.snapshot().items():
+        labels = f'endpoint="{_label(endpoint)}",phase="{_label(phase)}"'
+        for q, value in data["quantiles"].items():
+            lines.append(f'dashboard_phase_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+        lines.append(f"dashboard_phase_seconds_sum{{{labels}}} {data['sum']:.6f}")
+        lines.append(f"dashboard_phase_seconds_count{{{labels}}} {data['count']}")
+    lines.extend(extra or [])
+    return "\n".join(lines) + "\n"
+
+
+def _cache_lines() -> List[str]:
+    from . import caching, lorry_cache, mongo
+
+    lines = ["# TYPE dashboard_cache_requests_total counter"]
+    for label, s in caching.stats().items():
+        lines.append(f'dashboard_cache_requests_total{{cache="{_label(label)}",result="hit"}} {s["hits"]}')
+        lines.append(f'dashboard_cache_requests_total{{cache="{_label(label)}",result="miss"}} {s["misses"]}')
+    lorries = lorry_cache.lorries.stats()
+    lines.append(f'dashboard_cache_requests_total{{cache="lorries",result="hit"}} {lorries["hits"]}')
+    lines.append(f'dashboard_cache_requests_total{{cache="lorries",result="miss"}} {lorries["misses"]}')
+    pool = mongo.pool_stats()
+    lines.append("# TYPE dashboard_mongo_pool gauge")
+    for key in ("checked_out", "open_connections"):
+        lines.append(f'dashboard_mongo_pool{{stat="{key}"}} {pool[key]}')
+    lines.append("# TYPE dashboard_mongo_checkouts_total counter")
+    lines.append(f"dashboard_mongo_checkouts_total {pool['checkouts']}")
+    return lines
+
+
+def _metrics_allowed(request) -> bool:
+    token = getattr(settings, "DASHBOARD_METRICS_TOKEN", "")
+    if token:
+        auth = request.META.get("HTTP_AUTHORIZATION", "")
+        return hmac.compare_digest(auth.encode(), f"Bearer {token}".encode())
+    if getattr(settings, "DASHBOARD_METRICS_PUBLIC", False):
+        return True
+    # Behind a reverse proxy every client has the proxy's address; set
+    # DASHBOARD_METRICS_TOKEN there instead.
+    allowed = {"127.0.0.1", "::1", *getattr(settings, "INTERNAL_IPS", [])}
+    return request.META.get("REMOTE_ADDR") in allowed
+
+
+def metrics_view(request):
+    """Prometheus text exposition. With DASHBOARD_METRICS_TOKEN set, only
+    requests carrying ``Authorization: Bearer <token>`` are served;
+    otherwise local/INTERNAL_IPS clients only unless DASHBOARD_METRICS_PUBLIC
+    is set."""
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden("metrics require a token or a local client")
+    body = render_prometheus(_cache_lines())
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -17,6 +17,12 @@ class Transaction(models.Model):
     lorry_id = models.CharField(max_length=100, db_column='LORRY_ID')
     weight = models.FloatField(db_column='WEIGHT')
     delivery_time = models.CharField(max_length=64, db_column='DELIVERY_TIME')
+    # Typed copy of delivery_time (BSON date, indexed) filled on save and by
+    # the backfill_delivery_at command; window queries range-scan on it.
+    delivery_at = models.DateTimeField(db_column='DELIVERY_AT', null=True, blank=True, db_index=True)
+    # True when delivery_time could not be parsed, so such rows are not
+    # re-read and re-parsed as "not yet backfilled" on every window query.
+    delivery_at_invalid = models.BooleanField(db_column='DELIVERY_AT_INVALID', null=True, blank=True)
 
     def __str__(self):
         return f"Transaction {self.transaction_id} - {self.lorry_id} on {self.delivery_time}"
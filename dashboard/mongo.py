@@ -0,0 +1,166 @@
+"""Process-wide, fork-safe PyMongo client registry.
+
+Direct PyMongo code paths in the dashboard app share one ``MongoClient``
+per process instead of opening (and handshaking) a new one per call. The
+client connects lazily and is recreated in a forked child (e.g. gunicorn
+workers) so sockets are never shared across processes. Pool size and
+timeouts come from the ``DASHBOARD_MONGO_*`` settings, and connection pool
+events feed ``pool_stats()`` for monitoring.
+"""
+
+import os
+import threading
+import time
+from typing import Dict
+
+from django.conf import settings
+
+try:
+    import pymongo  # type: ignore
+    from pymongo import monitoring  # type: ignore
+except Exception:  # pragma: no cover
+    pymongo = None
+    monitoring = None
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+class _PoolStats(monitoring.ConnectionPoolListener if monitoring else object):
+    """Connection pool counters fed by PyMongo's CMAP events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.open_connections = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "open_connections": self.open_connections,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_avg": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+    # Check-out started/finished fire on the requesting thread.
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = time.monotonic() - getattr(self._local, "started", time.monotonic())
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections = max(0, self.open_connections - 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+stats = _PoolStats()
+
+
+def _options() -> Dict:
+    return {
+        "maxPoolSize": int(getattr(settings, "DASHBOARD_MONGO_MAX_POOL_SIZE", 20)),
+        "minPoolSize": int(getattr(settings, "DASHBOARD_MONGO_MIN_POOL_SIZE", 0)),
+        "connectTimeoutMS": int(getattr(settings, "DASHBOARD_MONGO_CONNECT_TIMEOUT_MS", 5000)),
+        "serverSelectionTimeoutMS": int(getattr(settings, "DASHBOARD_MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "waitQueueTimeoutMS": int(getattr(settings, "DASHBOARD_MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000)),
+        "connect": False,
+        "event_listeners": [stats],
+    }
+
+
+def get_client():
+    """The shared MongoClient for this process, or None if not configured."""
+    global _client, _client_pid
+    url = settings.DATABASES["default"].get("CLIENT", {}).get("host")
+    if not pymongo or not url:
+        return None
+    pid = os.getpid()
+    client = _client
+    if client is not None and _client_pid == pid:
+        return client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            # A client inherited from the parent is dropped, not closed: its
+            # sockets belong to the parent process.
+            stats.reset()
+            _client = pymongo.MongoClient(url, **_options())
+            _client_pid = pid
+        return _client
+
+
+def get_db():
+    """The configured database on the shared client, or None if not configured."""
+    name = settings.DATABASES["default"].get("NAME")
+    client = get_client()
+    if client is None or not name:
+        return None
+    return client[name]
+
+
+def close() -> None:
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def pool_stats() -> Dict:
+    return dict(stats.snapshot(), pid=os.getpid(), connected=_client is not None and _client_pid == os.getpid())
+
+
+def _after_fork_in_child() -> None:
+    global _client, _client_pid, _lock
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    stats.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class DeliveryCursorPagination(CursorPagination):
+    """Keyset pagination over deliveries, newest first.
+
+    Each page is a range query on the typed DELIVERY_AT continuing from the
+    last row of the previous page, so the cost per page stays constant
+    however deep a poller pages into the collection. Transaction_ID breaks
+    ties between deliveries with the same timestamp, so the order (and the
+    cursor's offset within a timestamp) is stable.
+    """
+
+    ordering = ('-delivery_at', '-transaction_id')
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -0,0 +1,264 @@
+"""Server-side period aggregation using a MongoDB aggregation pipeline.
+
+Mirrors ``python_aggregate``: the window match, the lookup of ``TYPES_ID``
+from ``lorries`` and the grouping by hourly/daily/weekly/monthly bucket all
+run inside MongoDB, so only one document per (bucket, lorry type) crosses
+the wire instead of the whole ``deliveries`` collection.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+import heapq
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.utils import timezone
+
+from . import lorry_cache, mongo
+
+logger = logging.getLogger(__name__)
+
+# $dateToString formats for each bucket; weekly uses the ISO year/week so it
+# matches get_period_key's "YYYY-Www" strings.
+BUCKET_FORMATS = {
+    "hourly": "%Y-%m-%dT%H",
+    "daily": "%Y-%m-%d",
+    "weekly": "%G-W%V",
+    "monthly": "%Y-%m",
+}
+
+
+def delivery_time_expr() -> Dict:
+    """Normalise DELIVERY_TIME (date, epoch number or string) into a BSON date.
+
+    Mirrors parse_delivery_time: numbers above 1e12 are epoch milliseconds,
+    smaller ones epoch seconds; unparseable strings become null.
+    """
+    value = "$DELIVERY_TIME"
+    return {
+        "$switch": {
+            "branches": [
+                {"case": {"$eq": [{"$type": value}, "date"]}, "then": value},
+                {
+                    "case": {"$in": [{"$type": value}, ["int", "long", "double", "decimal"]]},
+                    "then": {
+                        "$toDate": {
+                            "$cond": [
+                                {"$gt": [value, 1e12]},
+                                value,
+                                {"$multiply": [value, 1000]},
+                            ]
+                        }
+                    },
+                },
+                {
+                    "case": {"$eq": [{"$type": value}, "string"]},
+                    "then": {
+                        "$dateFromString": {"dateString": value, "onError": None, "onNull": None}
+                    },
+                },
+            ],
+            "default": None,
+        }
+    }
+
+
+# Rows not yet backfilled; those flagged unparseable are skipped.
+LEGACY_MATCH = {"DELIVERY_AT": None, "DELIVERY_AT_INVALID": None}
+
+
+def _weight_expr() -> Dict:
+    return {"$convert": {"input": "$WEIGHT", "to": "double", "onError": None, "onNull": None}}
+
+
+def window_stages(
+    since: datetime, until: datetime, lorry_ids: Optional[List[str]] = None, fields: Sequence[str] = ()
+) -> List[Dict]:
+    """Stages selecting deliveries in [since, until] as {LORRY_ID, _dt, _w}
+    (plus ``fields``), dropping rows with an unparseable time or weight."""
+    # Index range scan on the typed field; rows not yet backfilled
+    # (DELIVERY_AT missing/null) are parsed from DELIVERY_TIME below.
+    match = {"$or": [{"DELIVERY_AT": {"$gte": since, "$lte": until}}, LEGACY_MATCH]}
+    if lorry_ids is not None:
+        match["LORRY_ID"] = {"$in": lorry_ids}
+    project = {
+        "_id": 0,
+        "LORRY_ID": 1,
+        "_dt": {"$ifNull": ["$DELIVERY_AT", delivery_time_expr()]},
+        "_w": _weight_expr(),
+    }
+    project.update((f, 1) for f in fields)
+    return [
+        {"$match": match},
+        {"$project": project},
+        {"$match": {"_dt": {"$gte": since, "$lte": until}, "_w": {"$ne": None}}},
+    ]
+
+
+def build_pipeline(
+    since: datetime, until: datetime, period: str, lorry_ids: Optional[List[str]] = None
+) -> List[Dict]:
+    fmt = BUCKET_FORMATS.get(period, BUCKET_FORMATS["daily"])
+    return window_stages(since, until, lorry_ids) + [
+        {
+            "$lookup": {
+                "from": "lorries",
+                "localField": "LORRY_ID",
+                "foreignField": "LORRY_ID",
+                "as": "_lorry",
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "period": {"$dateToString": {"format": fmt, "date": "$_dt"}},
+                    "type": {"$ifNull": [{"$arrayElemAt": ["$_lorry.TYPES_ID", 0]}, "Unknown"]},
+                },
+                "total_weight": {"$sum": "$_w"},
+            }
+        },
+    ]
+
+
+LATEST_FIELDS = ("LORRY_ID", "Transaction_ID", "WEIGHT", "DELIVERY_TIME")
+
+
+def build_latest_pipelines(
+    since: datetime, until: datetime, n: int, lorry_ids: Optional[List[str]] = None
+) -> Tuple[List[Dict], List[Dict]]:
+    """(typed, legacy) pipelines for the ``n`` newest deliveries in the window.
+
+    The typed one matches, sorts and limits on DELIVERY_AT before any
+    ``$project``, so it walks DELIVERY_AT_1 backwards and reads ``n``
+    documents. The legacy one parses only the rows not yet backfilled.
+    """
+    typed = {"DELIVERY_AT": {"$gte": since, "$lte": until}}
+    legacy = dict(LEGACY_MATCH)
+    if lorry_ids is not None:
+        typed["LORRY_ID"] = legacy["LORRY_ID"] = {"$in": lorry_ids}
+    fields = {f: 1 for f in LATEST_FIELDS}
+    return (
+        [
+            {"$match": typed},
+            {"$sort": {"DELIVERY_AT": -1}},
+            {"$limit": n},
+            {"$project": dict(fields, _id=0, _dt="$DELIVERY_AT")},
+        ],
+        [
+            {"$match": legacy},
+            {"$project": dict(fields, _id=0, _dt=delivery_time_expr())},
+            {"$match": {"_dt": {"$gte": since, "$lte": until}}},
+            {"$sort": {"_dt": -1}},
+            {"$limit": n},
+        ],
+    )
+
+
+def build_totals_pipeline(since: datetime, until: datetime, lorry_ids: Optional[List[str]] = None) -> List[Dict]:
+    return window_stages(since, until, lorry_ids) + [
+        {
+            "$group": {
+                "_id": None,
+                "deliveries": {"$sum": 1},
+                "weight_kg": {"$sum": "$_w"},
+                "lorries": {"$addToSet": "$LORRY_ID"},
+            }
+        },
+        {"$project": {"_id": 0, "deliveries": 1, "weight_kg": 1, "unique_lorries": {"$size": "$lorries"}}},
+    ]
+
+
+def period_value(key: str, period: str):
+    """Convert a $dateToString bucket back into get_period_key's value."""
+    if period == "weekly":
+        return key
+    if period == "hourly":
+        dt = datetime.strptime(key, "%Y-%m-%dT%H")
+    elif period == "monthly":
+        dt = datetime.strptime(key, "%Y-%m")
+    else:
+        dt = datetime.strptime(key, "%Y-%m-%d")
+    return timezone.make_aware(dt, timezone.utc)
+
+
+def group_results(docs, period: str) -> Dict:
+    """Fold $group output into the {period: {lorry_type: weight}} mapping."""
+    agg = defaultdict(lambda: defaultdict(float))
+    for doc in docs:
+        key = doc["_id"]
+        agg[period_value(key["period"], period)][key["type"]] += float(doc["total_weight"])
+    return agg
+
+
+def _run(stages: List[Dict]):
+    """Run a pipeline on deliveries; None when MongoDB is unreachable."""
+    db = mongo.get_db()
+    if db is None:
+        return None
+    try:
+        return list(db["deliveries"].aggregate(stages, allowDiskUse=True))
+    except Exception:
+        logger.exception("Mongo aggregation failed; falling back to Python")
+        return None
+
+
+def aggregate(
+    since: datetime,
+    until: datetime,
+    period: str,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Optional[Dict]:
+    """Run the pipeline; return None when MongoDB is not reachable so callers
+    can fall back to in-process aggregation. Lorry type/client filters become
+    a ``LORRY_ID $in`` in the first ``$match``.
+    """
+    if mongo.get_db() is None:
+        return None
+    lorry_ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+    if lorry_ids == []:
+        return defaultdict(lambda: defaultdict(float))
+    docs = _run(build_pipeline(since, until, period, lorry_ids))
+    return None if docs is None else group_results(docs, period)
+
+
+def totals(
+    since: datetime,
+    until: datetime,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Optional[Dict]:
+    """Deliveries, weight and distinct lorries over the window, or None if unavailable."""
+    if mongo.get_db() is None:
+        return None
+    empty = {"deliveries": 0, "weight_kg": 0.0, "unique_lorries": 0}
+    lorry_ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+    if lorry_ids == []:
+        return empty
+    docs = _run(build_totals_pipeline(since, until, lorry_ids))
+    if docs is None:
+        return None
+    return dict(docs[0], weight_kg=float(docs[0]["weight_kg"])) if docs else empty
+
+
+def latest(
+    since: datetime,
+    until: datetime,
+    n: int = 20,
+    lorry_type: Optional[str] = None,
+    client_id: Optional[str] = None,
+) -> Optional[List[Dict]]:
+    """The ``n`` most recent deliveries in the window (raw documents with
+    ``_dt``), newest first, or None if unavailable."""
+    if mongo.get_db() is None:
+        return None
+    lorry_ids = lorry_cache.lorries.matching_ids(lorry_type, client_id)
+    if lorry_ids == []:
+        return []
+    docs = []
+    for stages in build_latest_pipelines(since, until, n, lorry_ids):
+        found = _run(stages)
+        if found is None:
+            return None
+        docs.extend(found)
+    return heapq.nlargest(n, docs, key=lambda d: d["_dt"])
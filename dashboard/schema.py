@@ -0,0 +1,108 @@
+"""Schema profiles for the chat's ``describe_collection`` tool.
+
+Profiles are built server-side: ``$sample`` picks random documents (so the
+result is not biased towards the oldest data in natural order) and each
+document is reduced to its (field, ``$type``) pairs before being counted in
+a ``$group``. Only one small document per (field, BSON type) crosses the
+wire, whatever the document size.
+
+Profiles are cached per collection for ``DASHBOARD_SCHEMA_CACHE_TTL``
+seconds. In incremental mode a stale profile is not replaced: a fresh
+sample is merged into it, so the type counts converge over time.
+"""
+
+from collections import Counter
+import logging
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+from django.conf import settings
+
+from . import mongo
+
+logger = logging.getLogger(__name__)
+
+
+class Profile(NamedTuple):
+    fields: Dict[str, Counter]
+    sampled: int
+    profiled_at: float
+
+
+_lock = threading.Lock()
+_profiles: Dict[str, Profile] = {}
+
+
+def _ttl() -> float:
+    return float(getattr(settings, "DASHBOARD_SCHEMA_CACHE_TTL", 600))
+
+
+def sample_pipeline(sample: int):
+    return [
+        {"$sample": {"size": sample}},
+        {"$project": {
+            "_id": 0,
+            "f": {"$map": {
+                "input": {"$objectToArray": "$$ROOT"},
+                "as": "kv",
+                "in": {"k": "$$kv.k", "t": {"$type": "$$kv.v"}},
+            }},
+        }},
+        {"$unwind": "$f"},
+        {"$group": {"_id": {"k": "$f.k", "t": "$f.t"}, "n": {"$sum": 1}}},
+    ]
+
+
+def _sample(coll: str, sample: int) -> Optional[Profile]:
+    db = mongo.get_db()
+    if db is None:
+        return None
+    max_time_ms = int(getattr(settings, "DASHBOARD_SCHEMA_MAX_TIME_MS", 2000))
+    fields: Dict[str, Counter] = {}
+    try:
+        for doc in db[coll].aggregate(sample_pipeline(sample), maxTimeMS=max_time_ms):
+            key = doc["_id"]
+            fields.setdefault(key["k"], Counter())[key["t"]] += doc["n"]
+    except Exception:
+        logger.exception("Sampling %s failed", coll)
+        return None
+    # Every document has an _id, so its count is the number of documents sampled.
+    sampled = sum(fields.get("_id", Counter()).values())
+    return Profile(fields, sampled, time.monotonic())
+
+
+def _merge(old: Profile, new: Profile) -> Profile:
+    fields = {k: Counter(c) for k, c in old.fields.items()}
+    for k, c in new.fields.items():
+        fields.setdefault(k, Counter()).update(c)
+    return Profile(fields, old.sampled + new.sampled, new.profiled_at)
+
+
+def profile(coll: str, sample: int = 50, incremental: bool = False, refresh: bool = False) -> Optional[Profile]:
+    """Cached schema profile for ``coll``, or None if MongoDB is unavailable.
+
+    A stale (or ``refresh``-ed) profile is resampled; with ``incremental``
+    the new sample is merged into the stored counts instead of replacing
+    them. If sampling fails the previous profile is returned as-is.
+    """
+    cached = _profiles.get(coll)
+    if cached is not None and not refresh and time.monotonic() - cached.profiled_at < _ttl():
+        return cached
+    fresh = _sample(coll, sample)
+    if fresh is None:
+        return cached
+    with _lock:
+        cached = _profiles.get(coll)
+        if incremental and cached is not None:
+            fresh = _merge(cached, fresh)
+        _profiles[coll] = fresh
+    return fresh
+
+
+def invalidate(coll: Optional[str] = None) -> None:
+    with _lock:
+        if coll is None:
+            _profiles.clear()
+        else:
+            _profiles.pop(coll, None)
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from . import lorry_cache
 from .models import Lorry, Transaction
 
 class LorrySerializer(serializers.ModelSerializer):
@@ -6,6 +7,16 @@ class LorrySerializer(serializers.ModelSerializer):
         model = Lorry
         fields = '__all__'
 
+class TransactionListSerializer(serializers.ListSerializer):
+    """Resolve lorry types for the whole page from the lorry dimension cache
+    instead of one query per row."""
+
+    def to_representation(self, data):
+        self.context['lorry_types'] = {
+            lorry_id: info.types_id for lorry_id, info in lorry_cache.lorries.lookup().items()
+        }
+        return super().to_representation(data)
+
 class TransactionSerializer(serializers.ModelSerializer):
     # Computed lorry type via lookup (no FK relation on model)
     lorry_types_id = serializers.SerializerMethodField()
@@ -19,8 +30,12 @@ class TransactionSerializer(serializers.ModelSerializer):
             'delivery_time',
             'lorry_types_id',
         )
+        list_serializer_class = TransactionListSerializer
 
     def get_lorry_types_id(self, obj):
+        lorry_types = self.context.get('lorry_types')
+        if lorry_types is not None:
+            return lorry_types.get(obj.lorry_id)
         try:
             l = Lorry.objects.get(lorry_id=obj.lorry_id)
             return l.types_id
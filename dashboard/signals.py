@@ -0,0 +1,61 @@
+"""Model signal hooks run when deliveries are written."""
+
+import logging
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import caching, columnar, live, lorry_cache, rollups
+from .models import Lorry, Transaction
+from .timeutils import parse_delivery_time
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender=Transaction)
+def set_delivery_at(sender, instance, **kwargs):
+    # Keep the typed, indexed copy in step with the raw DELIVERY_TIME string.
+    instance.delivery_at = parse_delivery_time(instance.delivery_time)
+    instance.delivery_at_invalid = True if instance.delivery_at is None else None
+
+
+@receiver(post_save, sender=Transaction)
+def update_rollups(sender, instance, created, **kwargs):
+    # Only new deliveries are folded in; edits, and deliveries whose update
+    # failed, need a rebuild_rollups run. The save itself has already
+    # succeeded, so a rollup failure must not fail the request.
+    if created and rollups.enabled():
+        try:
+            rollups.record([(instance.delivery_at, instance.lorry_id, instance.weight)])
+        except Exception:
+            logger.exception("Rollup update failed for delivery %s; run rebuild_rollups", instance.transaction_id)
+
+
+@receiver(post_save, sender=Transaction)
+def update_columnar_store(sender, instance, created, **kwargs):
+    if created and columnar.enabled():
+        columnar.record([(
+            instance.transaction_id, instance.delivery_at or instance.delivery_time, instance.lorry_id, instance.weight
+        )])
+
+
+@receiver(post_save, sender=Lorry)
+@receiver(post_delete, sender=Lorry)
+def invalidate_lorry_cache(sender, **kwargs):
+    lorry_cache.lorries.invalidate()
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=Lorry)
+@receiver(post_delete, sender=Lorry)
+def bump_data_version(sender, **kwargs):
+    # Cached aggregates/fragments are keyed by this version (see caching.py).
+    caching.bump_data_version()
+
+
+@receiver(post_save, sender=Transaction)
+def notify_live_feed(sender, instance, created, **kwargs):
+    # Registered after bump_data_version, so the publisher sees the new version.
+    if created:
+        live.publisher.notify()
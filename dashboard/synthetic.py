@@ -0,0 +1,92 @@
+"""Synthetic data shaped like ``guides/lories.csv`` and ``guides/deliveries.csv``.
+
+Used by the generate_synthetic and bench_dashboard commands. Lorry types,
+clients, makes and weights follow the proportions of the sample files;
+delivery times fall in the trial month and are mostly in the
+``deliveries.csv`` format, with an optional fraction of the other formats
+seen in the collection.
+"""
+
+from datetime import timedelta
+import random
+import uuid
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from .timeutils import TRIAL_START
+
+LORRY_COLUMNS = ["LORRY_ID", "TYPES_ID", "CLIENT_ID", "MAKE_ID"]
+DELIVERY_COLUMNS = ["Transaction_ID", "LORRY_ID", "WEIGHT", "DELIVERY_TIME"]
+
+TYPES = ["Tipper", "Compactor", "Dumper", "Lifter", "Open", "Roro", "Other"]
+TYPE_WEIGHTS = [15, 15, 15, 15, 15, 15, 10]
+CLIENT_MAKES = [
+    ("MBSP", "HINO"), ("MBSP", "ISUZU"), ("MBSP", "VOLVO"), ("INDUSTRY", "NISSAN"), ("PRIVATE", "MANN"),
+]
+CLIENT_MAKE_WEIGHTS = [21, 21, 22, 18, 18]
+WEIGHTS = [1500, 5000, 10000]
+WEIGHT_WEIGHTS = [1, 3, 1]
+
+DELIVERY_FORMAT = "%Y-%m-%dT%H:%M:%S"
+OUTLIER_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.000+00:00", "%Y-%m-%dT%H:%M:%SZ")
+
+
+def lorries(n: int = 100, seed: int = 7) -> List[List[str]]:
+    rng = random.Random(seed)
+    rows, seen = [], set()
+    while len(rows) < n:
+        lorry_id = f"P{''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(2))}_{rng.randrange(10000):04d}"
+        if lorry_id in seen:
+            continue
+        seen.add(lorry_id)
+        client, make = rng.choices(CLIENT_MAKES, CLIENT_MAKE_WEIGHTS)[0]
+        rows.append([lorry_id, rng.choices(TYPES, TYPE_WEIGHTS)[0], client, make])
+    return rows
+
+
+def delivery_times(n: int, seed: int = 7, outliers: float = 0.0, days: int = 31) -> Iterator[str]:
+    """DELIVERY_TIME strings spread over ``days`` from TRIAL_START."""
+    rng = random.Random(seed)
+    minutes = days * 24 * 60
+    for _ in range(n):
+        dt = TRIAL_START + timedelta(minutes=rng.randrange(minutes))
+        fmt = DELIVERY_FORMAT
+        if outliers and rng.random() < outliers:
+            fmt = rng.choice(OUTLIER_FORMATS)
+        yield dt.strftime(fmt)
+
+
+def deliveries(
+    n: int,
+    lorry_ids: Sequence[str],
+    seed: int = 7,
+    outliers: float = 0.0,
+    days: int = 31,
+) -> Iterator[List[str]]:
+    rng = random.Random(seed + 1)
+    for value in delivery_times(n, seed, outliers, days):
+        yield [
+            str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            rng.choice(lorry_ids),
+            str(rng.choices(WEIGHTS, WEIGHT_WEIGHTS)[0]),
+            value,
+        ]
+
+
+def dataset(
+    n: int, lorry_count: int = 100, seed: int = 7, outliers: float = 0.0, days: int = 31
+) -> Tuple[List[List[str]], Iterator[List[str]]]:
+    """(lorry rows, delivery row iterator) for ``n`` deliveries."""
+    lorry_rows = lorries(lorry_count, seed)
+    return lorry_rows, deliveries(n, [r[0] for r in lorry_rows], seed, outliers, days)
+
+
+def parse_sizes(value: Optional[str]) -> List[int]:
+    """'10k,100k,1M' -> [10000, 100000, 1000000]."""
+    sizes = []
+    for part in (value or "").split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        scale = {"k": 1_000, "m": 1_000_000}.get(part[-1], 1)
+        sizes.append(int(float(part.rstrip("km")) * scale))
+    return sizes
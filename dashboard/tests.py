@@ -1,3 +1,1611 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.db.models import Q
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from rest_framework.request import Request
+
+from . import ai_tools, bench, caching, charts, columnar, engine, export, gemini, hll, ingest, live, lorry_cache, metrics, mongo, nlq, pagination, pipeline, rollups, schema, synthetic, timeutils, views, warmup
+from .models import Lorry, Transaction
+from .serializers import TransactionSerializer
+from .signals import invalidate_lorry_cache, set_delivery_at, update_rollups
+
+
+LORRIES = [
+    SimpleNamespace(lorry_id='PSE_2077', types_id='Tipper', client_id='MBSP', make_id='VOLVO'),
+    SimpleNamespace(lorry_id='PKC_1001', types_id='Compactor', client_id='MBSP', make_id='HINO'),
+]
+
+
+def make_tx(transaction_id, lorry_id, weight, delivery_time):
+    return SimpleNamespace(
+        transaction_id=transaction_id, lorry_id=lorry_id, weight=weight, delivery_time=delivery_time
+    )
+
+
+TXS = [
+    make_tx('t1', 'PSE_2077', 1500, '2025-01-06T08:15:00'),
+    make_tx('t2', 'PSE_2077', 1200, '2025-01-06T08:45:00.000+00:00'),
+    make_tx('t3', 'PKC_1001', 900, '2025-01-07 09:10:00'),
+    make_tx('t4', 'PXX_0000', 300, '2025-01-20T23:59:00Z'),
+    make_tx('t5', 'PKC_1001', 700, 'not-a-date'),
+]
+
+
+class DashboardTestCase(SimpleTestCase):
+    def setUp(self):
+        # The lorry dimension and response caches are process-wide; start each test cold.
+        lorry_cache.lorries.invalidate()
+        cache.clear()
+        caching.clear_answers()
+
+
+class PipelineAggregationTests(DashboardTestCase):
+    """The Mongo pipeline backend must produce the same rows as python_aggregate."""
+
+    def _group_docs(self, period):
+        # Emulate the $group stage output for TXS.
+        fmt = pipeline.BUCKET_FORMATS[period]
+        lookup = {l.lorry_id: l.types_id for l in LORRIES}
+        acc = {}
+        for tx in TXS:
+            dt = views.parse_delivery_time(tx.delivery_time)
+            if dt is None:
+                continue
+            key = (dt.strftime(fmt), lookup.get(tx.lorry_id, 'Unknown'))
+            acc[key] = acc.get(key, 0.0) + float(tx.weight)
+        return [{'_id': {'period': p, 'type': t}, 'total_weight': w} for (p, t), w in acc.items()]
+
+    def test_rows_match_python_aggregate(self):
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            for period in ('hourly', 'daily', 'weekly', 'monthly'):
+                with self.subTest(period=period):
+                    expected = views.python_aggregate(TXS, period)
+                    grouped = pipeline.group_results(self._group_docs(period), period)
+                    self.assertEqual(views.build_aggregated_rows(grouped, period), expected)
+
+    def test_pipeline_matches_window_and_groups_by_bucket(self):
+        since, until = views.get_window('weekly')
+        stages = pipeline.build_pipeline(since, until, 'weekly')
+        self.assertIn({'DELIVERY_AT': {'$gte': since, '$lte': until}}, stages[0]['$match']['$or'])
+        self.assertEqual(stages[2]['$match']['_dt'], {'$gte': since, '$lte': until})
+        self.assertEqual(stages[3]['$lookup']['from'], 'lorries')
+        bucket = stages[4]['$group']['_id']['period']['$dateToString']
+        self.assertEqual(bucket['format'], '%G-W%V')
+
+    def test_latest_sorts_and_limits_on_the_index_before_projecting(self):
+        from datetime import datetime
+
+        since, until = views.get_window('monthly')
+        typed, legacy = pipeline.build_latest_pipelines(since, until, 2, ['PSE_2077'])
+        self.assertEqual(typed[:3], [
+            {'$match': {'DELIVERY_AT': {'$gte': since, '$lte': until}, 'LORRY_ID': {'$in': ['PSE_2077']}}},
+            {'$sort': {'DELIVERY_AT': -1}},
+            {'$limit': 2},
+        ])
+        self.assertEqual(legacy[0]['$match'], {'DELIVERY_AT': None, 'DELIVERY_AT_INVALID': None,
+                                               'LORRY_ID': {'$in': ['PSE_2077']}})
+        docs = [[{'Transaction_ID': 'a', '_dt': datetime(2025, 1, 20)}, {'Transaction_ID': 'b', '_dt': datetime(2025, 1, 10)}],
+                [{'Transaction_ID': 'old', '_dt': datetime(2025, 1, 15)}]]
+        with mock.patch.object(mongo, 'get_db', return_value=mock.Mock()), \
+                mock.patch.object(pipeline, '_run', side_effect=docs):
+            latest = pipeline.latest(since, until, 2)
+        self.assertEqual([d['Transaction_ID'] for d in latest], ['a', 'old'])
+
+    def test_falls_back_to_python_when_unconfigured(self):
+        since, until = views.get_window('daily')
+        with self.settings(DASHBOARD_AGGREGATION_BACKEND='mongo'), \
+                mock.patch.object(pipeline, 'aggregate', return_value=None), \
+                mock.patch.object(engine, 'window_entries',
+                                  return_value=[(views.parse_delivery_time(t.delivery_time), t) for t in TXS[:4]]), \
+                mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            rows = views.aggregate_window(since, until, 'daily')
+            self.assertEqual(rows, views.python_aggregate(TXS, 'daily'))
+
+
+class TypedDeliveryTimeTests(SimpleTestCase):
+    def test_typed_field_preferred_over_string(self):
+        typed = views.parse_delivery_time('2025-01-02T03:04:05+00:00')
+        tx = make_tx('t1', 'PSE_2077', 1, 'garbage')
+        tx.delivery_at = typed.replace(tzinfo=None)
+        self.assertEqual(timeutils.delivery_datetime(tx), typed)
+        tx.delivery_at = None
+        self.assertIsNone(timeutils.delivery_datetime(tx))
+
+    def test_window_uses_range_filter_and_parses_only_legacy_rows(self):
+        since, until = views.get_window('daily')
+        typed = make_tx('t1', 'PSE_2077', 1, '2025-01-03T00:00:00')
+        legacy_in = make_tx('t2', 'PSE_2077', 1, '2025-01-04T00:00:00')
+        legacy_out = make_tx('t3', 'PSE_2077', 1, '2024-12-31T00:00:00')
+        with mock.patch.object(timeutils.Transaction, 'objects') as objects, \
+                mock.patch.object(timeutils, 'logger'):
+            def filter_(**kwargs):
+                qs = mock.Mock()
+                if 'delivery_at__isnull' in kwargs:
+                    qs.order_by.return_value = [legacy_in, legacy_out]
+                else:
+                    self.assertEqual(kwargs, {'delivery_at__gte': since, 'delivery_at__lte': until})
+                    qs.order_by.return_value = [typed]
+                return qs
+            objects.filter.side_effect = filter_
+            self.assertEqual(timeutils.window_transactions(since, until), [typed, legacy_in])
+
+    def test_pre_save_sets_delivery_at(self):
+        tx = Transaction(transaction_id='t1', lorry_id='PSE_2077', weight=1.0,
+                         delivery_time='2025-01-05T06:07:00.000+00:00')
+        set_delivery_at(Transaction, tx)
+        self.assertEqual(tx.delivery_at, views.parse_delivery_time(tx.delivery_time))
+        self.assertIsNone(tx.delivery_at_invalid)
+        tx.delivery_time = 'not-a-date'
+        set_delivery_at(Transaction, tx)
+        self.assertEqual((tx.delivery_at, tx.delivery_at_invalid), (None, True))
+
+    def test_unparseable_rows_skipped_and_unbackfilled_rows_logged(self):
+        since, until = views.get_window('monthly')
+        pending = make_tx('pending', 'PSE_2077', 100, (until - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'))
+        calls = []
+
+        def filter_(**kwargs):
+            calls.append(kwargs)
+            qs = mock.Mock()
+            qs.filter.return_value = qs
+            qs.order_by.return_value = [pending] if 'delivery_at__isnull' in kwargs else []
+            return qs
+
+        with mock.patch.object(timeutils.Transaction, 'objects') as objects, \
+                mock.patch.object(timeutils, '_legacy_warned_at', float('-inf')):
+            objects.filter.side_effect = filter_
+            with self.assertLogs('dashboard.timeutils', 'WARNING') as logs:
+                entries = timeutils.window_entries(since, until)
+            self.assertEqual([tx for _, tx in entries], [pending])
+            self.assertIn('1 deliveries have no DELIVERY_AT', logs.output[0])
+            self.assertIn({'delivery_at__isnull': True, 'delivery_at_invalid__isnull': True}, calls)
+            with mock.patch.object(timeutils.logger, 'warning') as warning:
+                timeutils.window_entries(since, until)
+            warning.assert_not_called()  # throttled
+
+
+class RollupTests(DashboardTestCase):
+    def _entries(self):
+        return [(views.parse_delivery_time(tx.delivery_time), tx.lorry_id, tx.weight) for tx in TXS[:4]]
+
+    def test_updates_collapse_per_hour_type_and_client(self):
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            ops = rollups._updates(self._entries())
+        docs = {(op._filter['hour'].hour, op._filter['lorry_type']): op._doc for op in ops}
+        self.assertEqual(len(ops), 3)
+        tipper = docs[(8, 'Tipper')]
+        self.assertEqual(tipper['$inc'], {'weight': 2700.0, 'count': 2})
+        self.assertEqual(tipper['$addToSet'], {'lorries': {'$each': ['PSE_2077']}})
+
+    def test_aggregate_from_hours_matches_python_aggregate(self):
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            hour_docs = [
+                {'hour': op._filter['hour'], 'lorry_type': op._filter['lorry_type'],
+                 'weight': op._doc['$inc']['weight']}
+                for op in rollups._updates(self._entries())
+            ]
+            since, until = views.get_window('weekly')
+            for period in ('daily', 'weekly', 'monthly'):
+                with self.subTest(period=period), \
+                        mock.patch.object(rollups, '_hour_docs', return_value=hour_docs):
+                    grouped = rollups.aggregate(since, until, period)
+                    self.assertEqual(
+                        views.build_aggregated_rows(grouped, period), views.python_aggregate(TXS, period)
+                    )
+
+    def test_failed_rollup_update_does_not_fail_the_save(self):
+        tx = make_tx('t9', 'PSE_2077', 1500, '2025-01-06T08:15:00')
+        tx.delivery_at = views.parse_delivery_time(tx.delivery_time)
+        db = mock.MagicMock()
+        db[rollups.COLLECTION].bulk_write.side_effect = RuntimeError('primary stepped down')
+        with mock.patch('dashboard.models.Lorry.objects') as lorries, \
+                mock.patch.object(rollups, 'enabled', return_value=True), \
+                mock.patch.object(mongo, 'get_db', return_value=db), \
+                self.assertLogs('dashboard.signals', 'ERROR') as logs:
+            lorries.all.return_value = LORRIES
+            update_rollups(Transaction, tx, created=True)
+        self.assertIn('rebuild_rollups', logs.output[0])
+
+
+class HyperLogLogTests(SimpleTestCase):
+    def test_estimates_within_error_bound(self):
+        for n in (1, 100, 20_000):
+            with self.subTest(n=n):
+                sketch = hll.HyperLogLog()
+                for i in range(n):
+                    sketch.add(f'LORRY_{i}')
+                self.assertLessEqual(abs(sketch.estimate() - n), max(1, 3 * hll.STANDARD_ERROR * n))
+
+    def test_sparse_sketches_merge_to_the_union(self):
+        a = hll.sparse(f'L{i}' for i in range(0, 3000))
+        b = hll.sparse(f'L{i}' for i in range(2000, 5000))
+        merged = hll.HyperLogLog()
+        merged.update(a)
+        merged.update(b)
+        union = hll.HyperLogLog()
+        union.update(hll.sparse(f'L{i}' for i in range(5000)))
+        self.assertEqual(merged.registers, union.registers)
+        self.assertEqual(merged.sparse(), union.sparse())
+        other = hll.HyperLogLog()
+        other.update(b)
+        only_a = hll.HyperLogLog()
+        only_a.update(a)
+        only_a.merge(other)
+        self.assertEqual(only_a.registers, union.registers)
+
+    def test_rollup_updates_carry_sketch_registers(self):
+        entries = [(views.parse_delivery_time('2025-01-06T08:15:00'), f'L{i}', 10) for i in range(50)]
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = []
+            op, = rollups._updates(entries)
+        self.assertEqual(op._doc['$max'], {f'hll.{k}': r for k, r in hll.sparse(f'L{i}' for i in range(50)).items()})
+
+    def test_rollup_totals_switch_to_sketches_for_long_windows(self):
+        hours = [timeutils.TRIAL_START + timedelta(hours=h) for h in range(24 * 60)]
+        docs = [{'hour': hour, 'weight': 1.0, 'count': 2, 'lorries': [f'L{h % 400}', f'L{(h * 7) % 400}'],
+                 'hll': hll.sparse([f'L{h % 400}', f'L{(h * 7) % 400}'])} for h, hour in enumerate(hours)]
+        since, until = hours[0], hours[-1]
+
+        def hour_docs(since_, until_, projection, lorry_type=None, client_id=None):
+            return [{k: d[k] for k in projection if k in d} for d in docs if since_ <= d['hour'] <= until_]
+
+        with mock.patch.object(rollups, '_hour_docs', side_effect=hour_docs) as read:
+            with self.settings(DASHBOARD_DISTINCT_EXACT_HOURS=24 * 60):
+                exact = rollups.totals(since, until)
+                self.assertIn('lorries', read.call_args.args[2])
+            with self.settings(DASHBOARD_DISTINCT_EXACT_HOURS=24):
+                approx = rollups.totals(since, until)
+                projection = read.call_args.args[2]
+                self.assertIn('hll', projection)
+                self.assertNotIn('lorries', projection)
+        self.assertEqual(exact['unique_lorries'], 400)
+        self.assertEqual(approx['deliveries'], exact['deliveries'])
+        self.assertLessEqual(abs(approx['unique_lorries'] - 400), 3 * hll.STANDARD_ERROR * 400)
+
+
+class DashboardViewQueryTests(DashboardTestCase):
+    """dashboard_view loads deliveries and lorries in a single pass."""
+
+    def test_query_count(self):
+        typed = []
+        for tx in TXS[:4]:
+            tx = make_tx(tx.transaction_id, tx.lorry_id, tx.weight, tx.delivery_time)
+            tx.delivery_at = views.parse_delivery_time(tx.delivery_time)
+            typed.append(tx)
+        queries = []
+
+        def tx_filter(**kwargs):
+            queries.append(('deliveries', kwargs))
+            qs = mock.Mock()
+            qs.order_by.return_value = [] if 'delivery_at__isnull' in kwargs else typed
+            return qs
+
+        def lorry_all():
+            queries.append(('lorries', {}))
+            return LORRIES
+
+        request = RequestFactory().get('/', {'period': 'daily'})
+        with mock.patch.object(timeutils.Transaction, 'objects') as transactions, \
+                mock.patch.object(views.Lorry, 'objects') as lorries:
+            transactions.filter.side_effect = tx_filter
+            transactions.all.side_effect = AssertionError('full collection scan')
+            lorries.all.side_effect = lorry_all
+            response = views.dashboard_view(request)
+            self.assertEqual(response.status_code, 200)
+            # One typed range scan + one scan for unbackfilled rows + one lorry load.
+            self.assertEqual(len(queries), 3, queries)
+            self.assertEqual([q[0] for q in queries].count('lorries'), 1)
+            self.assertContains(response, 'PKC_1001')
+            # Same data version: served from the page cache.
+            views.dashboard_view(request)
+            self.assertEqual(len(queries), 3, queries)
+            # New data, warm lorry cache: only the two delivery scans remain.
+            caching.bump_data_version()
+            views.dashboard_view(request)
+            self.assertEqual(len(queries), 5, queries)
+
+    def test_latest_is_top_n_by_time(self):
+        snapshot = views.DashboardSnapshot.__new__(views.DashboardSnapshot)
+        snapshot.entries = [(views.parse_delivery_time(tx.delivery_time), tx) for tx in TXS[:4]]
+        snapshot.lorry_lookup = {l.lorry_id: l for l in LORRIES}
+        since, until = views.get_window('daily')
+        latest = snapshot.latest(since, until, n=2)
+        self.assertEqual([r['transaction_id'] for r in latest], ['t4', 't3'])
+        self.assertEqual(latest[0]['lorry_types_id'], 'Unknown')
+
+
+class FakeDeliveryQuerySet:
+    """Just enough of a queryset for CursorPagination: order_by, Q filters, slicing."""
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def order_by(self, *fields):
+        rows = self.rows
+        for field in reversed(fields):
+            rows = sorted(rows, key=lambda r: getattr(r, field.lstrip('-')), reverse=field.startswith('-'))
+        return FakeDeliveryQuerySet(rows)
+
+    def _match(self, q, row):
+        if not isinstance(q, Q):
+            lookup, value = q
+            field, op = lookup.rsplit('__', 1)
+            actual = getattr(row, field)
+            if op == 'isnull':
+                return (actual is None) == value
+            value = views.parse_delivery_time(value) if isinstance(value, str) else value
+            return actual < value if op == 'lt' else actual > value
+        results = [self._match(child, row) for child in q.children]
+        return (any(results) if q.connector == Q.OR else all(results)) != q.negated
+
+    def filter(self, q):
+        return FakeDeliveryQuerySet(r for r in self.rows if self._match(q, r))
+
+    def __getitem__(self, item):
+        return self.rows[item]
+
+
+class DeliveryPaginationTests(SimpleTestCase):
+    def test_pages_follow_delivery_at_across_string_formats(self):
+        times = ['2025-01-06T08:15:00+00:00', '2025-01-06T09:00:00Z', '2025-01-06T08:30:00+0000',
+                 '2025-01-06T08:20:00.000+00:00', '2025-01-06T09:00:00+00:00', '2025-01-06 10:00:00']
+        rows = []
+        for i, raw in enumerate(times):
+            tx = make_tx(f't{i}', 'PSE_2077', 100, raw)
+            tx.delivery_at = views.parse_delivery_time(raw)
+            rows.append(tx)
+        paginator = pagination.DeliveryCursorPagination()
+        paginator.page_size = 2
+        seen, url = [], '/api/transactions/'
+        while url:
+            request = Request(RequestFactory().get(url))
+            seen.extend(paginator.paginate_queryset(FakeDeliveryQuerySet(rows), request))
+            url = paginator.get_next_link()
+        expected = sorted(rows, key=lambda r: (r.delivery_at, r.transaction_id), reverse=True)
+        self.assertEqual([r.transaction_id for r in seen], [r.transaction_id for r in expected])
+
+
+class TransactionSerializerTests(DashboardTestCase):
+    def test_page_resolves_lorry_types_in_one_lookup(self):
+        txs = [Transaction(transaction_id=t.transaction_id, lorry_id=t.lorry_id, weight=t.weight,
+                           delivery_time=t.delivery_time) for t in TXS]
+        with mock.patch('dashboard.serializers.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            lorries.get.side_effect = AssertionError('per-row lookup')
+            data = TransactionSerializer(txs, many=True).data
+            TransactionSerializer(txs, many=True).data
+        self.assertEqual(lorries.all.call_count, 1)
+        self.assertEqual(
+            [row['lorry_types_id'] for row in data],
+            ['Tipper', 'Tipper', 'Compactor', None, 'Compactor'],
+        )
+
+
+class LorryCacheTests(SimpleTestCase):
+    def test_ttl_invalidation_and_counters(self):
+        cache = lorry_cache.LorryCache()
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            self.assertEqual(cache.get('PSE_2077').types_id, 'Tipper')
+            self.assertEqual(cache.lookup()['PKC_1001'].client_id, 'MBSP')
+            self.assertEqual((cache.misses, cache.hits), (1, 1))
+            cache.invalidate()
+            cache.lookup()
+            self.assertEqual(lorries.all.call_count, 2)
+            with self.settings(DASHBOARD_LORRY_CACHE_TTL=0):
+                cache.lookup()
+            self.assertEqual(lorries.all.call_count, 3)
+        self.assertEqual(cache.stats()['version'], 1)
+
+    def test_lorry_save_signal_invalidates(self):
+        version = lorry_cache.lorries.version
+        invalidate_lorry_cache(Lorry)
+        self.assertEqual(lorry_cache.lorries.version, version + 1)
+
+
+class BatchTimestampParserTests(SimpleTestCase):
+    VALUES = [
+        '2025-01-01T13:47:00',
+        '2025-01-01T13:47:00',
+        '2025-01-02T08:16:00.000+00:00',
+        '2025-01-03 09:10:00',
+        '2025-01-04T10:00:00Z',
+        '2025-01-05T11:00:00.000+0800',
+        1735689600000,
+        {'$date': '2025-01-06T00:00:00Z'},
+        None,
+        '',
+        'garbage',
+    ] + ['2025-01-%02dT06:30:00' % d for d in range(1, 29)]
+
+    def test_matches_per_value_parser(self):
+        expected = [timeutils.parse_delivery_time(v) for v in self.VALUES]
+        self.assertEqual(timeutils.parse_delivery_times(self.VALUES), expected)
+        self.assertEqual(timeutils.parse_delivery_times(iter(self.VALUES)), expected)
+
+    def test_numpy_output(self):
+        if timeutils.np is None:
+            self.skipTest('numpy not installed')
+        arr = timeutils.parse_delivery_times(self.VALUES, as_numpy=True)
+        self.assertEqual(str(arr.dtype), 'datetime64[ms]')
+        self.assertEqual(str(arr[0]), '2025-01-01T13:47:00.000')
+        self.assertEqual(str(arr[5]), '2025-01-05T03:00:00.000')
+        self.assertTrue(timeutils.np.isnat(arr[8]) and timeutils.np.isnat(arr[10]))
+
+
+class ColumnarStoreTests(DashboardTestCase):
+    def setUp(self):
+        super().setUp()
+        if columnar.np is None:
+            self.skipTest('numpy not installed')
+
+    def test_aggregate_matches_python_aggregate(self):
+        since, until = views.get_window('weekly')
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            store = columnar.ColumnarDeliveries(capacity=2)
+            self.assertEqual(store.append((tx.delivery_time, tx.lorry_id, tx.weight) for tx in TXS), 4)
+            for period in ('hourly', 'daily', 'weekly', 'monthly'):
+                with self.subTest(period=period):
+                    self.assertEqual(
+                        views.build_aggregated_rows(store.aggregate(since, until, period), period),
+                        views.python_aggregate(TXS, period),
+                    )
+        self.assertEqual(store.totals(since, until),
+                         {'deliveries': 4, 'weight_kg': 3900.0, 'unique_lorries': 3})
+        self.assertEqual(store.nbytes, 4 * 18)
+
+    def test_stale_store_served_while_reloading_in_background(self):
+        old, new = columnar.ColumnarDeliveries(), columnar.ColumnarDeliveries()
+        old.loaded_at -= 3600
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.addCleanup(columnar.invalidate)
+
+        def slow_load(skip=None):
+            release.wait(5)
+            return new
+
+        with mock.patch.object(columnar, '_store', old), \
+                mock.patch.object(columnar.ColumnarDeliveries, 'load', side_effect=slow_load) as load, \
+                self.settings(DASHBOARD_COLUMNAR_REFRESH=60):
+            self.assertIs(columnar.get_store(), old)  # does not wait for the reload
+            self.assertIs(columnar.get_store(), old)
+            refresher = columnar._refresher
+            release.set()
+            refresher.join(5)
+            self.assertIs(columnar.get_store(), new)
+        self.assertEqual(load.call_count, 1)
+
+    def test_rows_recorded_during_reload_are_replayed_into_the_new_store(self):
+        old = columnar.ColumnarDeliveries()
+        old.loaded_at -= 3600
+        self.addCleanup(columnar.invalidate)
+        saved = [(tx.transaction_id, tx.delivery_time, tx.lorry_id, tx.weight) for tx in TXS[:4]]
+
+        def load(skip=None):
+            # Both rows are saved mid-load; the reload's cursor has read the
+            # first one but not the second.
+            columnar.record(saved[:2])
+            store = columnar.ColumnarDeliveries()
+            store.append(row[1:] for row in saved[:1] + saved[2:] if row[0] not in skip)
+            return store
+
+        with mock.patch('dashboard.models.Lorry.objects') as lorries, \
+                mock.patch.object(columnar, '_store', old), \
+                mock.patch.object(columnar.ColumnarDeliveries, 'load', side_effect=load), \
+                self.settings(DASHBOARD_COLUMNAR_REFRESH=60):
+            lorries.all.return_value = LORRIES
+            columnar.get_store()
+            columnar._refresher.join(5)
+            store = columnar.get_store()
+        self.assertIsNot(store, old)
+        self.assertEqual(store.size, len(saved))
+        self.assertIsNone(columnar._pending)
+
+
+class EngineParityTests(DashboardTestCase):
+    """Every aggregation engine must answer like the Python engine on the same data."""
+
+    def setUp(self):
+        super().setUp()
+        lorry_rows, delivery_rows = synthetic.dataset(2000, lorry_count=40, outliers=0.05)
+        self.lorries = [SimpleNamespace(lorry_id=r[0], types_id=r[1], client_id=r[2], make_id=r[3])
+                        for r in lorry_rows]
+        txs = [make_tx(*row) for row in delivery_rows]
+        txs.append(make_tx('bad-weight', lorry_rows[0][0], 'n/a', '2025-01-10T10:00:00'))
+        txs.append(make_tx('bad-time', lorry_rows[0][0], 500, 'not-a-date'))
+        self.entries = [(views.parse_delivery_time(t.delivery_time), t) for t in txs]
+        patcher = mock.patch('dashboard.models.Lorry.objects')
+        patcher.start().all.return_value = self.lorries
+        self.addCleanup(patcher.stop)
+        self.rollup_ops = rollups._updates((dt, t.lorry_id, t.weight) for dt, t in self.entries)
+        for patcher in (mock.patch.object(engine, 'window_entries', side_effect=self._window_entries),
+                        mock.patch.object(engine, 'window_latest', side_effect=self._window_latest),
+                        mock.patch.object(rollups, '_hour_docs', side_effect=self._hour_docs)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.engines = [engine.ENGINES['python'], engine.ENGINES['rollup']]
+        if columnar.np is not None:
+            store = columnar.ColumnarDeliveries()
+            store.append((t.delivery_time, t.lorry_id, t.weight) for _, t in self.entries)
+            patcher = mock.patch.object(columnar, 'get_store', return_value=store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+            self.engines.append(engine.ENGINES['columnar'])
+
+    def _window_entries(self, since, until, lorry_ids=None):
+        return [(dt, t) for dt, t in self.entries
+                if dt and since <= dt <= until and (lorry_ids is None or t.lorry_id in lorry_ids)]
+
+    def _window_latest(self, since, until, n, lorry_ids=None):
+        return sorted(self._window_entries(since, until, lorry_ids), key=lambda e: e[0], reverse=True)[:n]
+
+    def _hour_docs(self, since, until, projection, lorry_type=None, client_id=None):
+        docs = []
+        for op in self.rollup_ops:
+            key = op._filter
+            if not rollups.hour_bucket(since) <= key['hour'] <= until:
+                continue
+            if lorry_type and key['lorry_type'] != lorry_type or client_id and key['client_id'] != client_id:
+                continue
+            docs.append(dict(key, weight=op._doc['$inc']['weight'], count=op._doc['$inc']['count'],
+                             lorries=op._doc['$addToSet']['lorries']['$each'],
+                             hll={k.split('.')[1]: r for k, r in op._doc['$max'].items()}))
+        return docs
+
+    def test_engines_agree(self):
+        # Rollups resolve to whole hours, so compare on hour-aligned windows.
+        day = views.parse_bound('2025-01-10'), views.parse_bound('2025-01-10', end=True)
+        for since, until in ((timeutils.TRIAL_START, timeutils.TRIAL_END), day):
+            for filters in ({}, {'lorry_type': 'Tipper'}, {'client_id': 'MBSP'}):
+                with self.subTest(since=since, **filters):
+                    self.assertEqual(engine.compare(self.engines, since, until, **filters), [])
+
+    def test_compare_reports_differences(self):
+        self.rollup_ops[0]._doc['$inc']['weight'] += 1000
+        problems = engine.compare(self.engines[:2], timeutils.TRIAL_START, timeutils.TRIAL_END, periods=('daily',))
+        self.assertTrue(problems)
+        self.assertTrue(all(p.startswith('rollup vs python') for p in problems))
+
+    def test_selected_engine_falls_back_to_python(self):
+        since, until = timeutils.TRIAL_START, timeutils.TRIAL_END
+        expected = engine.ENGINES['python'].totals(since, until)
+        self.assertEqual(expected['deliveries'], 2000)
+        with self.settings(DASHBOARD_AGGREGATION_BACKEND='rollup'):
+            self.assertIs(engine.get_engine(), engine.ENGINES['rollup'])
+            self.assertEqual(engine.totals(since, until), expected)
+            # Rollups hold no rows, so the feed comes from the Python engine.
+            self.assertEqual(len(engine.latest(since, until)), engine.LATEST_ROWS)
+        with self.settings(DASHBOARD_AGGREGATION_BACKEND='mongo'), \
+                mock.patch.object(mongo, 'get_db', return_value=None):
+            self.assertEqual(engine.totals(since, until), expected)
+        with self.settings(DASHBOARD_AGGREGATION_BACKEND='bogus'):
+            self.assertIs(engine.get_engine(), engine.python_engine)
+
+
+@override_settings(DASHBOARD_ALL_PERIODS=False)
+class ResponseCacheTests(DashboardTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(views, 'aggregate_window', return_value=[])
+        self.aggregate_window = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, path, view, **headers):
+        request = RequestFactory().get(path, {'period': 'weekly'}, HTTP_HX_REQUEST='true', **headers)
+        return view(request)
+
+    def test_fragment_cached_and_revalidated_with_etag(self):
+        first = self._get('/aggregated-table/', views.aggregated_table)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+        self.assertIn('Last-Modified', first)
+        self.assertEqual(first['HX-Push-Url'], '/?period=weekly')
+
+        again = self._get('/aggregated-table/', views.aggregated_table)
+        self.assertEqual(again.content, first.content)
+        self.assertEqual(self.aggregate_window.call_count, 1)
+
+        revalidated = self._get('/aggregated-table/', views.aggregated_table,
+                                HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['HX-Push-Url'], '/?period=weekly')
+
+        caching.bump_data_version()
+        changed = self._get('/aggregated-table/', views.aggregated_table,
+                            HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertEqual(self.aggregate_window.call_count, 2)
+
+    def test_version_read_from_database_sees_other_processes(self):
+        from datetime import datetime, timezone as dt_timezone
+
+        state = {'meta': {'_id': 'data_version', 'version': 3, 'modified': 1.7e9}, 'count': 10,
+                 'newest': datetime(2025, 1, 20, 8, 0, tzinfo=dt_timezone.utc)}
+        db = {name: mock.MagicMock() for name in ('dashboard_meta', 'deliveries', 'lorries')}
+        db['dashboard_meta'].find_one.side_effect = lambda *a, **k: dict(state['meta'])
+        db['deliveries'].find_one.side_effect = lambda *a, **k: {'DELIVERY_AT': state['newest']}
+        db['deliveries'].estimated_document_count.side_effect = lambda: state['count']
+        db['lorries'].estimated_document_count.return_value = 2
+
+        with mock.patch.object(mongo, 'get_db', return_value=db), \
+                mock.patch.dict(caching._observed, {'version': None, 'checked': 0.0}):
+            first = self._get('/aggregated-table/', views.aggregated_table)
+            # Another process (e.g. ingest_csv) writes; this process's cache never hears of it.
+            state['count'] = 12
+            state['meta'] = dict(state['meta'], version=4, modified=1.8e9)
+            with self.settings(DASHBOARD_DATA_VERSION_TTL=60):
+                cached = self._get('/aggregated-table/', views.aggregated_table, HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(cached.status_code, 304)
+            with self.settings(DASHBOARD_DATA_VERSION_TTL=0):
+                changed = self._get('/aggregated-table/', views.aggregated_table, HTTP_IF_NONE_MATCH=first['ETag'])
+                self.assertEqual(changed.status_code, 200)
+                self.assertNotEqual(changed['ETag'], first['ETag'])
+                self.assertEqual(caching.data_version()[1], 1.8e9)
+                # Rows written straight into Mongo (no counter bump) still change the version.
+                version = caching.data_version()
+                state['newest'] += timedelta(hours=1)
+                self.assertNotEqual(caching.data_version(), version)
+                caching.bump_data_version()
+        db['dashboard_meta'].update_one.assert_called_once_with(
+            {'_id': 'data_version'}, {'$inc': {'version': 1}, '$set': {'modified': mock.ANY}}, upsert=True
+        )
+
+    def test_api_shares_rows_with_fragment(self):
+        before = caching.stats().get('aggregated:rows', {'hits': 0, 'misses': 0})
+        self._get('/aggregated-table/', views.aggregated_table)
+        response = self._get('/api/aggregated/', views.AggregatedDataAPIView.as_view())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.aggregate_window.call_count, 1)
+        after = caching.stats()['aggregated:rows']
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 1))
+
+
+class ChartPayloadTests(DashboardTestCase):
+    def test_pivot_is_dense_matrix_with_totals(self):
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            rows = views.python_aggregate(TXS, 'daily')
+        data = charts.pivot(rows, 'daily')
+        self.assertEqual(data['periods'], ['2025-01-20', '2025-01-07', '2025-01-06'])
+        self.assertEqual(data['types'], ['Compactor', 'Tipper', 'Unknown'])
+        self.assertEqual(data['weights'], [0, 0, 300, 900, 0, 0, 0, 2700, 0])
+        self.assertEqual(data['period_totals'], [300, 900, 2700])
+        self.assertEqual(data['type_totals'], [900, 2700, 300])
+        self.assertEqual(data['total'], 3900)
+        self.assertEqual(data['composition']['labels'][0], 'Leachate (9%)')
+        self.assertEqual(sum(data['composition']['shares']), 1.0)
+        self.assertEqual(data['composition']['weights'][2], round(0.45 * 3900))
+
+    def test_endpoint_gzips_caches_and_revalidates(self):
+        since, until = views.get_window('hourly')
+        grouped = {since.replace(hour=h): {t: 1000.0 + h for t in synthetic.TYPES} for h in range(24)}
+        rows = views.build_aggregated_rows(grouped, 'hourly')
+        with self.settings(DASHBOARD_ALL_PERIODS=False), \
+                mock.patch.object(views, 'aggregate_window', return_value=rows) as aggregate:
+            factory = RequestFactory()
+            plain = views.chart_data(factory.get('/api/chart/', {'period': 'hourly'}))
+            request = factory.get('/api/chart/', {'period': 'hourly'}, HTTP_ACCEPT_ENCODING='gzip, br')
+            zipped = views.chart_data(request)
+            self.assertEqual(aggregate.call_count, 1)
+            self.assertEqual(zipped['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', zipped['Vary'])
+            self.assertFalse(plain.has_header('Content-Encoding'))
+            self.assertEqual(gzip.decompress(zipped.content), plain.content)
+            data = json.loads(plain.content)
+            self.assertEqual(len(data['weights']), 24 * len(synthetic.TYPES))
+            self.assertEqual(data['periods'][0], '2025-01-25 23:00')
+            # Much smaller than the same rows as one object per (period, type).
+            row_json = json.dumps([{'period': r['period_display'], 'lorry_type': r['lorry__lorry_type'],
+                                    'total_weight': r['total_weight']} for r in rows])
+            self.assertLess(len(plain.content), len(row_json) / 2)
+            self.assertLess(len(zipped.content), len(plain.content) / 2)
+
+            self.assertTrue(zipped['ETag'].startswith('W/'))
+            again = views.chart_data(factory.get('/api/chart/', {'period': 'hourly'},
+                                                 HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=zipped['ETag']))
+            self.assertEqual(again.status_code, 304)
+            self.assertIn('Accept-Encoding', again['Vary'])
+
+    def test_bad_range_is_rejected(self):
+        response = views.chart_data(RequestFactory().get('/api/chart/', {'since': 'soon'}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_fragment_points_charts_at_the_payload(self):
+        with mock.patch.object(views, 'cached_aggregate', return_value=[]):
+            response = views.aggregated_table(RequestFactory().get(
+                '/aggregated-table/', {'period': 'weekly', 'lorry_type': 'Tipper'}, HTTP_HX_REQUEST='true'))
+        self.assertContains(response, 'data-src="/api/chart/?period=weekly&amp;lorry_type=Tipper"')
+
+
+class AllPeriodsWarmupTests(DashboardTestCase):
+    def setUp(self):
+        super().setUp()
+        entries = [(views.parse_delivery_time(tx.delivery_time), tx) for tx in TXS[:4]]
+        entries.append((views.parse_delivery_time('2025-01-25T09:30:00Z'), make_tx('t6', 'PSE_2077', 400, '')))
+        self.entries = entries
+        lorries = mock.patch('dashboard.models.Lorry.objects')
+        lorries.start().all.return_value = LORRIES
+        self.addCleanup(lorries.stop)
+
+        def window(since, until, lorry_ids=None):
+            return [(dt, tx) for dt, tx in entries if since <= dt <= until
+                    and (lorry_ids is None or tx.lorry_id in lorry_ids)]
+        self.window = window
+        patcher = mock.patch.object(engine, 'window_entries', side_effect=window)
+        self.scans = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(warmup._set, status=warmup.IDLE)
+
+    def test_one_pass_serves_every_period(self):
+        for period in engine.PERIODS:
+            with self.subTest(period=period):
+                since, until = views.get_window(period)
+                expected = views.aggregate_window(since, until, period, lorry_type='Tipper')
+                self.scans.reset_mock()
+                self.assertEqual(views.cached_aggregate(since, until, period, lorry_type='Tipper'), expected)
+                caching.bump_data_version()
+        self.scans.reset_mock()
+        for period in engine.PERIODS:
+            views.cached_aggregate(*views.get_window(period), period)
+        self.assertEqual(self.scans.call_count, 1)
+        hourly = views.cached_aggregate(*views.get_window('hourly'), 'hourly')
+        self.assertEqual([r['period_display'] for r in hourly], ['2025-01-25 09:00'])
+
+    def test_prewarm_fills_caches_and_reports_readiness(self):
+        self.assertEqual(warmup.readiness_view(None).status_code, 503)
+        with mock.patch.object(views, 'window_entries', side_effect=self.window) as page_scans:
+            state = warmup.prewarm()
+            self.assertEqual(state['status'], warmup.READY)
+            self.assertIn('page:weekly', state['steps'])
+            self.scans.reset_mock()
+            page_scans.reset_mock()
+            factory = RequestFactory()
+            for period in engine.PERIODS:
+                views.aggregated_table(factory.get('/aggregated-table/', {'period': period}, HTTP_HX_REQUEST='true'))
+                views.dashboard_view(factory.get('/', {'period': period}))
+            self.assertEqual((self.scans.call_count, page_scans.call_count), (0, 0))
+        response = warmup.readiness_view(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.content)['ready'])
+
+    def test_failed_warmup_is_not_ready(self):
+        with self.assertLogs('dashboard.warmup', 'ERROR'), \
+                mock.patch.object(lorry_cache.lorries, 'lookup', side_effect=RuntimeError('db down')):
+            state = warmup.prewarm()
+        self.assertEqual((state['status'], state['error']), (warmup.FAILED, 'db down'))
+        self.assertEqual(warmup.readiness_view(None).status_code, 503)
+
+    def test_forked_worker_restarts_warmup(self):
+        self.addCleanup(setattr, warmup, '_pid', None)
+        parent = warmup.os.getpid() + 1
+        with mock.patch.object(warmup, '_pid', parent):
+            warmup._set(status=warmup.WARMING)
+            warmup._after_fork_in_child()  # inherited state is dropped
+            self.assertEqual(warmup.state(), {'status': warmup.IDLE})
+            release = threading.Event()
+            self.addCleanup(release.set)
+
+            def fake_prewarm():
+                release.wait(5)
+                warmup._set(status=warmup.READY)
+
+            with self.settings(DASHBOARD_PREWARM=True), \
+                    mock.patch.object(warmup, '_serving', return_value=True), \
+                    mock.patch.object(warmup, 'prewarm', side_effect=fake_prewarm) as prewarm:
+                self.assertEqual(warmup.readiness_view(None).status_code, 503)  # starts it here
+                release.set()
+                warmup._thread.join(5)
+                self.assertEqual(warmup._pid, warmup.os.getpid())
+                self.assertEqual(warmup.readiness_view(None).status_code, 200)
+                response = warmup.warmup_middleware(lambda request: HttpResponse('ok'))(None)
+            self.assertEqual(response.content, b'ok')
+            prewarm.assert_called_once_with()
+
+    def test_starts_only_when_serving(self):
+        with self.settings(DASHBOARD_PREWARM=False):
+            warmup.start()
+            self.assertEqual(warmup.state()['status'], warmup.DISABLED)
+        with mock.patch.object(warmup.sys, 'argv', ['manage.py', 'migrate']):
+            self.assertFalse(warmup._serving())
+        with mock.patch.object(warmup.sys, 'argv', ['manage.py', 'runserver', '--noreload']):
+            self.assertTrue(warmup._serving())
+        with mock.patch.object(warmup.sys, 'argv', ['/venv/bin/gunicorn', 'iswmc_dashboard.wsgi']):
+            self.assertTrue(warmup._serving())
+
+
+class MongoClientPoolTests(SimpleTestCase):
+    DATABASES = {'default': {'CLIENT': {'host': 'mongodb://db.invalid:27017'}, 'NAME': 'iswmc'}}
+
+    def setUp(self):
+        mongo.close()
+        patcher = mock.patch.dict('django.conf.settings.DATABASES', self.DATABASES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(mongo.close)
+
+    def test_client_shared_within_process_and_recreated_after_fork(self):
+        client = mongo.get_client()
+        self.assertIs(mongo.get_client(), client)
+        self.assertEqual(mongo.get_db().name, 'iswmc')
+        self.assertEqual(client.max_pool_size, 20)
+        with mock.patch.object(mongo.os, 'getpid', return_value=-1):
+            child = mongo.get_client()
+        self.assertIsNot(child, client)
+
+    def test_pool_stats_track_checkouts(self):
+        stats = mongo._PoolStats()
+        for _ in range(2):
+            stats.connection_check_out_started(None)
+            stats.connection_checked_out(None)
+        stats.connection_checked_in(None)
+        stats.connection_check_out_failed(None)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['checkouts'], 2)
+        self.assertEqual(snapshot['checked_out'], 1)
+        self.assertEqual(snapshot['checkout_failures'], 1)
+        self.assertGreaterEqual(snapshot['wait_seconds_max'], 0.0)
+
+
+class SchemaProfileTests(SimpleTestCase):
+    GROUPS = [
+        {'_id': {'k': '_id', 't': 'objectId'}, 'n': 3},
+        {'_id': {'k': 'WEIGHT', 't': 'double'}, 'n': 2},
+        {'_id': {'k': 'WEIGHT', 't': 'string'}, 'n': 1},
+    ]
+
+    def setUp(self):
+        schema.invalidate()
+        self.addCleanup(schema.invalidate)
+        self.db = mock.MagicMock()
+        self.db.__getitem__.return_value.aggregate.side_effect = lambda *a, **kw: iter(self.GROUPS)
+        patcher = mock.patch.object(mongo, 'get_db', return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_samples_types_server_side_and_caches(self):
+        d = ai_tools.describe_collection('deliveries', sample=3)
+        self.assertEqual(d['fields']['WEIGHT'], {'double': 2, 'string': 1})
+        self.assertEqual(d['sampled'], 3)
+        stages = self.db.__getitem__.return_value.aggregate.call_args[0][0]
+        self.assertEqual(stages[0], {'$sample': {'size': 3}})
+        self.assertIn('$type', stages[1]['$project']['f']['$map']['in']['t'])
+        ai_tools.describe_collection('deliveries', sample=3)
+        self.assertEqual(self.db.__getitem__.return_value.aggregate.call_count, 1)
+
+    def test_incremental_merges_new_sample(self):
+        schema.profile('deliveries', sample=3)
+        prof = schema.profile('deliveries', sample=3, incremental=True, refresh=True)
+        self.assertEqual(prof.sampled, 6)
+        self.assertEqual(prof.fields['WEIGHT'], {'double': 4, 'string': 2})
+
+
+class AsyncChatTests(SimpleTestCase):
+    def ask(self, question='totals today'):
+        request = RequestFactory().post('/chat/', {'question': question})
+        return async_to_sync(views.dashboard_chat)(request)
+
+    def test_slow_model_falls_back_to_local_tools(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with self.settings(DASHBOARD_CHAT_TIMEOUT=0.05), \
+                mock.patch.object(gemini, '_vertex_available', return_value=True), \
+                mock.patch.object(gemini, '_vertex_call', side_effect=lambda q, deadline: release.wait(5) and 'late'), \
+                mock.patch('dashboard.nlq.answer_question', return_value='local answer'):
+            response = self.ask()
+        self.assertIn(b'local answer', response.content)
+        self.assertTrue(views.dashboard_chat.csrf_exempt)
+
+    def test_busy_model_slots_skip_straight_to_local_tools(self):
+        with mock.patch.object(gemini, '_vertex_available', return_value=True), \
+                mock.patch.object(gemini, '_model_slots', threading.BoundedSemaphore(1)) as slots, \
+                mock.patch.object(gemini, '_vertex_call') as vertex_call, \
+                mock.patch('dashboard.nlq.answer_question', return_value='local answer'):
+            slots.acquire()
+            response = self.ask()
+        vertex_call.assert_not_called()
+        self.assertIn(b'local answer', response.content)
+
+    def test_model_answer_used_within_deadline(self):
+        with mock.patch.object(gemini, '_vertex_available', return_value=True), \
+                mock.patch.object(gemini, '_vertex_call', return_value='<p>model</p>') as vertex_call, \
+                self.settings(DASHBOARD_CHAT_TIMEOUT=8):
+            response = self.ask()
+        self.assertIn(b'<p>model</p>', response.content)
+        _, deadline = vertex_call.call_args[0]
+        self.assertLessEqual(deadline - gemini.time.monotonic(), 8)
+
+
+class VertexRuntimeTests(SimpleTestCase):
+    def fake_sdk(self):
+        """Stand-ins for vertexai and vertexai.generative_models."""
+        calls = {'init': 0, 'model': 0, 'declarations': 0}
+
+        def init(**kwargs):
+            calls['init'] += 1
+
+        def declaration(**kwargs):
+            calls['declarations'] += 1
+            return kwargs
+
+        class GenerativeModel:
+            def __init__(self, name):
+                calls['model'] += 1
+
+            def generate_content(self, contents, tools):
+                return SimpleNamespace(candidates=[], text='<b>hi</b>')
+
+        vertexai = SimpleNamespace(init=init)
+        models = SimpleNamespace(GenerativeModel=GenerativeModel, FunctionDeclaration=declaration, Tool=SimpleNamespace)
+        return {'vertexai': vertexai, 'vertexai.generative_models': models}, calls
+
+    def test_runtime_built_once_across_threads_and_calls(self):
+        modules, calls = self.fake_sdk()
+        with mock.patch.dict('sys.modules', modules), \
+                mock.patch.object(gemini, '_vertex_available', return_value=True), \
+                mock.patch.object(gemini, '_runtime', None), \
+                mock.patch.object(gemini, '_runtime_error', None), \
+                mock.patch.dict(gemini._timings, {'calls': 0, 'model_seconds_total': 0.0}):
+            threads = [threading.Thread(target=gemini._vertex_call, args=('hello',)) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(gemini._vertex_call('hello'), '&lt;b&gt;hi&lt;/b&gt;')
+            timings = gemini.vertex_timings()
+        self.assertEqual(calls, {'init': 1, 'model': 1, 'declarations': 5})
+        self.assertEqual(timings['calls'], 5)
+        self.assertTrue(timings['initialized'])
+
+    def test_missing_sdk_is_not_retried(self):
+        with mock.patch.dict('sys.modules', {'vertexai': None}), \
+                mock.patch.object(gemini, '_vertex_available', return_value=True), \
+                mock.patch.object(gemini, '_runtime', None), \
+                mock.patch.object(gemini, '_runtime_error', None), \
+                mock.patch.object(gemini, '_build_runtime', wraps=gemini._build_runtime) as build:
+            self.assertIsNone(gemini._vertex_call('hello'))
+            self.assertIsNone(gemini._vertex_call('hello'))
+        build.assert_called_once()
+
+
+class AsgiRoutingTests(SimpleTestCase):
+    def test_sync_views_run_concurrently_and_chat_on_the_event_loop(self):
+        from iswmc_dashboard import asgi
+
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wsgi_app(environ, start_response):
+            barrier.wait()  # raises if the two requests were serialised
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO'].encode()]
+
+        async def chat_app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'chat'})
+
+        async def request(path):
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request'}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+                     'http_version': '1.1', 'headers': []}
+            await asgi.application(scope, receive, send)
+            return b''.join(m.get('body', b'') for m in sent)
+
+        async def run():
+            return await asyncio.gather(request('/'), request('/ready'), request('/chat/'))
+
+        with mock.patch.object(asgi.sync_application, 'wsgi_application', wsgi_app), \
+                mock.patch.object(asgi, 'django_application', chat_app):
+            self.assertEqual(async_to_sync(run)(), [b'/', b'/ready', b'chat'])
+
+    def test_wsgi_adapter_passes_the_request_and_closes_the_response(self):
+        from iswmc_dashboard import asgi
+
+        seen, closed = {}, threading.Event()
+
+        class Body(list):
+            close = closed.set
+
+        def wsgi_app(environ, start_response):
+            seen.update(environ, body=environ['wsgi.input'].read())
+            start_response('201 Created', [('Content-Type', 'text/plain')])
+            return Body([b'ok', b''])
+
+        messages = [{'type': 'http.request', 'body': b'a=', 'more_body': True},
+                    {'type': 'http.request', 'body': b'1'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/app/api/', 'root_path': '/app',
+                 'query_string': b'page=2', 'http_version': '1.1', 'client': ('203.0.113.9', 5000),
+                 'headers': [(b'content-type', b'text/plain'), (b'x-tag', b'a'), (b'x-tag', b'b')]}
+        async_to_sync(asgi.ThreadedWsgiToAsgi(wsgi_app))(scope, receive, send)
+        self.assertEqual((seen['SCRIPT_NAME'], seen['PATH_INFO'], seen['QUERY_STRING']), ('/app', '/api/', 'page=2'))
+        self.assertEqual((seen['CONTENT_TYPE'], seen['HTTP_X_TAG'], seen['REMOTE_ADDR']), ('text/plain', 'a,b', '203.0.113.9'))
+        self.assertEqual(seen['body'], b'a=1')
+        self.assertEqual(sent[0]['status'], 201)
+        self.assertEqual([m.get('body') for m in sent[1:]], [b'ok', None])
+        self.assertTrue(closed.is_set())
+
+
+class AnswerCacheTests(DashboardTestCase):
+    TOTALS = {'deliveries': 3, 'weight_kg': 3000.0, 'weight_tons': 3.0, 'unique_lorries': 2}
+
+    def test_nlq_and_gemini_share_answers_until_data_changes(self):
+        with mock.patch.object(ai_tools, '_totals', return_value=self.TOTALS) as compute:
+            first = nlq.answer_question('Totals monthly')
+            self.assertEqual(nlq.answer_question('totals for the month'), first)
+            self.assertIs(ai_tools.totals('monthly'), ai_tools.totals('MONTHLY'))
+            self.assertEqual(compute.call_count, 1)
+            caching.bump_data_version()
+            ai_tools.totals('monthly')
+            self.assertEqual(compute.call_count, 2)
+
+    def test_least_recently_used_answer_evicted(self):
+        with self.settings(DASHBOARD_ANSWER_CACHE_SIZE=2), \
+                mock.patch.object(ai_tools, '_totals', return_value=self.TOTALS) as compute:
+            ai_tools.totals('daily')
+            ai_tools.totals('weekly')
+            ai_tools.totals('daily')
+            ai_tools.totals('monthly')  # evicts weekly
+            ai_tools.totals('daily')
+            self.assertEqual(compute.call_count, 3)
+            ai_tools.totals('weekly')
+            self.assertEqual(compute.call_count, 4)
+
+    def test_answer_expires_without_version_change(self):
+        with mock.patch.object(ai_tools, '_totals', return_value=self.TOTALS) as compute, \
+                mock.patch.object(caching.time, 'monotonic', side_effect=[100.0, 130.0, 170.0]):
+            ai_tools.totals('monthly')
+            ai_tools.totals('monthly')
+            self.assertEqual(compute.call_count, 1)
+            ai_tools.totals('monthly')
+            self.assertEqual(compute.call_count, 2)
+
+
+class GeminiToolCallTests(SimpleTestCase):
+    def turn(self, *calls, text=''):
+        parts = [SimpleNamespace(function_call=SimpleNamespace(name=name, args=args)) for name, args in calls]
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))], text=text)
+
+    def run_model(self, responses, tools, deadline=None):
+        model = mock.Mock()
+        model.generate_content.side_effect = responses
+        runtime = SimpleNamespace(model=model, tool='tool')
+        with mock.patch.object(gemini, 'get_runtime', return_value=runtime), \
+                mock.patch.dict(gemini.TOOLS, tools):
+            return gemini._vertex_call('totals monthly and by lorry type', deadline), model
+
+    def test_calls_in_one_turn_run_concurrently_and_return_together(self):
+        both_running = threading.Barrier(2, timeout=5)
+
+        def tool(label):
+            def run(args):
+                both_running.wait()
+                return {'tool': label, 'period': args['period']}, f'<p>{label}</p>'
+            return run
+
+        responses = [
+            self.turn(('totals', {'period': 'monthly'}), ('by_lorry_type', {'period': 'monthly'})),
+            self.turn(text='Summary'),
+        ]
+        html, model = self.run_model(responses, {'totals': tool('totals'), 'by_lorry_type': tool('types')})
+        self.assertEqual(html, "<p>totals</p><p>types</p><div class='mt-1'>Summary</div>")
+        self.assertEqual(model.generate_content.call_count, 2)
+        follow_up = model.generate_content.call_args_list[1][0][0][-1]
+        self.assertEqual(
+            [p['function_response']['name'] for p in follow_up['parts']], ['totals', 'by_lorry_type']
+        )
+
+    def test_turns_are_capped(self):
+        responses = [self.turn(('totals', {'period': 'daily'})) for _ in range(5)]
+        with self.settings(DASHBOARD_GEMINI_MAX_TURNS=2):
+            html, model = self.run_model(responses, {'totals': lambda args: ({}, '<p>t</p>')})
+        self.assertEqual(model.generate_content.call_count, 2)
+        self.assertEqual(html, '<p>t</p>')
+
+    def test_no_turn_started_past_the_chat_deadline(self):
+        import time
+
+        turns = iter([self.turn(('totals', {'period': 'daily'})), self.turn(text='Summary')])
+
+        def slow_turn(*args, **kwargs):
+            time.sleep(0.1)
+            return next(turns)
+
+        # The chat timeout is far shorter than DASHBOARD_GEMINI_MAX_SECONDS:
+        # a second 0.1s turn would not fit, so the tool results come back now.
+        html, model = self.run_model(slow_turn, {'totals': lambda args: ({}, '<p>t</p>')},
+                                     deadline=time.monotonic() + 0.15)
+        self.assertEqual(model.generate_content.call_count, 1)
+        self.assertEqual(html, '<p>t</p>')
+
+
+class FakeExportQuerySet:
+    """Records filters and serves typed or legacy rows like a values_list queryset."""
+
+    def __init__(self, typed, legacy, filters=None, log=None):
+        self.typed, self.legacy = typed, legacy
+        self.filters = filters or {}
+        self.log = log if log is not None else []
+
+    def filter(self, **kwargs):
+        return FakeExportQuerySet(self.typed, self.legacy, {**self.filters, **kwargs}, self.log)
+
+    def order_by(self, *fields):
+        return self
+
+    def values_list(self, *fields):
+        return self
+
+    def iterator(self, chunk_size):
+        self.log.append((self.filters, chunk_size))
+        return iter(self.legacy if self.filters.get('delivery_at__isnull') else self.typed)
+
+
+class ExportTests(DashboardTestCase):
+    def export(self, query):
+        from datetime import datetime, timezone
+        at = datetime(2025, 1, 6, 8, 15, tzinfo=timezone.utc)
+        typed = [('t1', at, '2025-01-06T08:15:00', 'PSE_2077', 1500.0)]
+        legacy = [
+            ('t3', None, '2025-01-07 09:10:00', 'PSE_2077', 900.0),
+            ('t5', None, 'not-a-date', 'PSE_2077', 700.0),
+            ('t6', None, '2025-02-07 09:10:00', 'PSE_2077', 100.0),
+        ]
+        queryset = FakeExportQuerySet(typed, legacy)
+        with self.settings(DASHBOARD_EXPORT_BATCH_SIZE=2), \
+                mock.patch.object(export.Transaction, 'objects', queryset), \
+                mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            response = views.export_deliveries(RequestFactory().get('/api/export/deliveries/', query))
+            body = b''.join(getattr(response, 'streaming_content', [])).decode()
+        return response, body, queryset.log
+
+    def test_csv_streams_filtered_window_with_lorry_type(self):
+        response, body, log = self.export({'since': '2025-01-01', 'until': '2025-01-31', 'lorry_type': 'Tipper'})
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('deliveries_20250101_20250131.csv', response['Content-Disposition'])
+        lines = body.strip().splitlines()
+        self.assertEqual(lines[0], ','.join(export.COLUMNS))
+        self.assertEqual([l.split(',')[0] for l in lines[1:]], ['t1', 't3'])
+        self.assertIn('Tipper,MBSP', lines[1])
+        typed_filters, chunk = log[0]
+        self.assertEqual(typed_filters['lorry_id__in'], ['PSE_2077'])
+        self.assertIn('delivery_at__gte', typed_filters)
+        self.assertEqual(chunk, 2)
+
+    def test_ndjson_and_bad_params(self):
+        import json
+        _, body, _ = self.export({'format': 'ndjson', 'client_id': 'MBSP'})
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([r['transaction_id'] for r in rows], ['t1', 't3', 't5', 't6'])
+        self.assertEqual(rows[2]['delivery_at'], '')
+        self.assertEqual(rows[0]['lorry_type'], 'Tipper')
+        self.assertEqual(self.export({'format': 'xml'})[0].status_code, 400)
+        self.assertEqual(self.export({'since': 'yesterday'})[0].status_code, 400)
+
+
+class IngestTests(DashboardTestCase):
+    HEADER = ['Transaction_ID', 'LORRY_ID', 'WEIGHT', 'DELIVERY_TIME']
+
+    def test_rows_validated_and_delivery_time_normalized(self):
+        rows = [
+            ['t1', 'PSE_2077', '1500', '2025-01-06T16:15:00+08:00'],
+            ['t2', 'PSE_2077', 'heavy', '2025-01-06T08:15:00'],
+            ['t3', '', '1500', '2025-01-06T08:15:00'],
+            ['t4', 'PSE_2077', '900', 'not-a-date'],
+            ['t5'],
+        ]
+        docs, rejects = ingest.parse_deliveries(self.HEADER, 2, rows)
+        self.assertEqual([d['Transaction_ID'] for d in docs], ['t1'])
+        self.assertEqual(docs[0]['DELIVERY_TIME'], '2025-01-06T08:15:00')
+        self.assertEqual(docs[0]['DELIVERY_AT'].isoformat(), '2025-01-06T08:15:00+00:00')
+        self.assertEqual(
+            [(line, reason) for line, reason, _ in rejects],
+            [(3, 'invalid WEIGHT'), (4, 'missing Transaction_ID or LORRY_ID'), (6, 'missing columns'),
+             (5, 'invalid DELIVERY_TIME')],
+        )
+
+    def test_command_upserts_in_batches_and_folds_in_only_new_rows(self):
+        import io
+        import os
+        import tempfile
+        from django.core.management import call_command
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write(','.join(self.HEADER) + '\n')
+            for i in range(5):
+                f.write(f't{i},PSE_2077,100,2025-01-06T08:1{i}:00\n')
+            f.write('bad,PSE_2077,x,2025-01-06T08:00:00\n')
+        self.addCleanup(os.unlink, f.name)
+        db = mock.MagicMock()
+        # First batch: both new; second: one existing; third: new.
+        db['deliveries'].bulk_write.side_effect = [
+            SimpleNamespace(matched_count=0, upserted_ids={0: 'a', 1: 'b'}),
+            SimpleNamespace(matched_count=1, upserted_ids={1: 'c'}),
+            SimpleNamespace(matched_count=0, upserted_ids={0: 'd'}),
+        ]
+        db['dashboard_meta'].find_one.return_value = None
+        db['deliveries'].estimated_document_count.return_value = 0
+        out = io.StringIO()
+        version = caching.data_version()
+        with self.settings(DASHBOARD_AGGREGATION_BACKEND='rollup', DASHBOARD_PREWARM=True), \
+                mock.patch.object(mongo, 'get_db', return_value=db), \
+                mock.patch.object(rollups, 'record') as record, \
+                mock.patch.object(warmup, 'prewarm', return_value={'status': 'ready', 'seconds': 0.5}) as prewarm:
+            call_command('ingest_csv', f.name, '--batch-size', '2', stdout=out)
+        prewarm.assert_called_once_with()
+        self.assertIn('Cache warm-up ready', out.getvalue())
+        self.assertEqual(db['deliveries'].bulk_write.call_count, 3)
+        ops, = db['deliveries'].bulk_write.call_args_list[0][0]
+        self.assertEqual(ops[0]._filter, {'Transaction_ID': 't0'})
+        self.assertTrue(ops[0]._upsert)
+        self.assertFalse(db['deliveries'].bulk_write.call_args_list[0][1]['ordered'])
+        folded = [entry[1:] for call in record.call_args_list for entry in call[0][0]]
+        self.assertEqual(len(folded), 4)
+        self.assertIn('Upserted 5 rows (4 new)', out.getvalue())
+        self.assertIn('1 rejected', out.getvalue())
+        self.assertNotEqual(caching.data_version(), version)
+
+
+class BenchmarkTests(SimpleTestCase):
+    def test_synthetic_rows_match_csv_schema_and_parse(self):
+        lorry_rows, delivery_rows = synthetic.dataset(500, lorry_count=20, outliers=0.1)
+        delivery_rows = list(delivery_rows)
+        self.assertEqual(len({r[0] for r in lorry_rows}), 20)
+        self.assertEqual(synthetic.parse_sizes('10k, 1M,2.5k'), [10_000, 1_000_000, 2_500])
+        docs, rejects = ingest.parse_deliveries(synthetic.DELIVERY_COLUMNS, 2, delivery_rows)
+        self.assertEqual((len(docs), rejects), (500, []))
+        self.assertTrue(all(timeutils.TRIAL_START <= d['DELIVERY_AT'] <= timeutils.TRIAL_END for d in docs))
+        self.assertEqual(list(synthetic.dataset(5)[1]), list(synthetic.dataset(5)[1]))
+
+    def test_measure_reports_latency_rss_and_commands(self):
+        def work():
+            bench.commands.started(SimpleNamespace(command_name='find'))
+            bench.commands.started(SimpleNamespace(command_name='hello'))
+        no_db = mock.MagicMock()
+        no_db.return_value.__enter__.return_value.captured_queries = []
+        with mock.patch.object(bench, 'CaptureQueriesContext', no_db):
+            result = bench.measure(work, repeat=2)
+        self.assertEqual(result['latency_ms']['runs'], 2)
+        self.assertEqual(result['mongo_commands'], 1)
+        self.assertEqual(result['orm_queries'], 0)
+        self.assertGreater(result['peak_rss_mb'], 0)
+
+    def test_refuses_non_bench_database(self):
+        from django.core.management import CommandError, call_command
+        with self.assertRaises(CommandError):
+            call_command('bench_dashboard', '--sizes', '10k')
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+    def _request(self, name='dashboard'):
+        request = RequestFactory().get('/')
+        request.resolver_match = SimpleNamespace(url_name=name, view_name=name)
+        return request
+
+    def test_server_timing_header_sums_spans_per_request(self):
+        def view(request):
+            # Django calls process_view once the URL is resolved.
+            middleware.process_view(request, view, (), {})
+            for _ in range(2):
+                with metrics.span('db'):
+                    pass
+            with metrics.span('render'):
+                pass
+            return HttpResponse('ok')
+
+        middleware = metrics.MetricsMiddleware(view)
+        request = self._request()
+        header = middleware(request)['Server-Timing']
+        self.assertEqual([part.split(';')[0] for part in header.split(', ')], ['db', 'render', 'total'])
+        snapshot = metrics.registry.snapshot()
+        self.assertEqual(snapshot[('dashboard', 'db')]['count'], 2)
+        self.assertEqual(snapshot[('dashboard', 'total')]['count'], 1)
+
+    def test_async_middleware_and_spans_outside_requests(self):
+        async def view(request):
+            middleware.process_view(request, view, (), {})
+            with metrics.span('ai'):
+                pass
+            return HttpResponse('ok')
+
+        middleware = metrics.MetricsMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = self._request('dashboard_chat')
+        response = async_to_sync(middleware)(request)
+        self.assertTrue(response['Server-Timing'].startswith('ai;dur='))
+        with metrics.span('db'):
+            pass
+        self.assertIn(('-', 'db'), metrics.registry.snapshot())
+
+    @override_settings(DASHBOARD_METRICS_WINDOW=100)
+    def test_rolling_quantiles_and_prometheus_text(self):
+        for i in range(1, 201):
+            metrics.registry.observe('aggregated_api', 'db', i / 1000)
+        data = metrics.registry.snapshot()[('aggregated_api', 'db')]
+        # Only the last 100 samples (0.101..0.200) are kept for quantiles.
+        self.assertEqual(data['quantiles'], {0.5: 0.151, 0.95: 0.196, 0.99: 0.2})
+        self.assertEqual(data['count'], 200)
+        text = metrics.render_prometheus()
+        self.assertIn('dashboard_phase_seconds{endpoint="aggregated_api",phase="db",quantile="0.95"} 0.196000', text)
+        self.assertIn('dashboard_phase_seconds_count{endpoint="aggregated_api",phase="db"} 200', text)
+
+    def test_metrics_endpoint_is_local_only(self):
+        factory = RequestFactory()
+        response = metrics.metrics_view(factory.get('/metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'dashboard_mongo_pool{stat="checked_out"}', response.content)
+        remote = factory.get('/metrics', REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(metrics.metrics_view(remote).status_code, 403)
+
+    @override_settings(DASHBOARD_METRICS_TOKEN='s3cret')
+    def test_metrics_token_is_required_even_from_loopback(self):
+        factory = RequestFactory()
+        # What every request looks like behind a local nginx.
+        self.assertEqual(metrics.metrics_view(factory.get('/metrics')).status_code, 403)
+        wrong = factory.get('/metrics', HTTP_AUTHORIZATION='Bearer nope')
+        self.assertEqual(metrics.metrics_view(wrong).status_code, 403)
+        scraper = factory.get('/metrics', REMOTE_ADDR='203.0.113.9', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(metrics.metrics_view(scraper).status_code, 200)
+
+
+class DateRangeQueryTests(DashboardTestCase):
+    def test_request_scope_overrides_default_window(self):
+        since, until, filters = views.request_scope(
+            {'since': '2024-06-01', 'until': '2024-06-07', 'lorry_type': 'Tipper', 'client_id': ''}, 'daily'
+        )
+        self.assertEqual(since.isoformat(), '2024-06-01T00:00:00+00:00')
+        self.assertEqual(until.isoformat(), '2024-06-07T23:59:59.999999+00:00')
+        self.assertEqual(filters, {'lorry_type': 'Tipper'})
+        self.assertEqual(views.request_scope({}, 'weekly'), (*views.get_window('weekly'), {}))
+        for bad in ({'since': 'yesterday'}, {'since': '2025-01-10', 'until': '2025-01-02'}):
+            with self.subTest(params=bad), self.assertRaises(ValueError):
+                views.request_scope(bad, 'daily')
+
+    def test_window_entries_push_lorry_filter_into_both_queries(self):
+        since, until = views.get_window('daily')
+        calls = []
+
+        def filter_(**kwargs):
+            calls.append(kwargs)
+            qs = mock.Mock()
+            qs.filter.side_effect = lambda **more: calls.append(more) or qs
+            qs.order_by.return_value = []
+            return qs
+
+        with mock.patch.object(timeutils.Transaction, 'objects') as objects:
+            objects.filter.side_effect = filter_
+            self.assertEqual(timeutils.window_entries(since, until, ['PSE_2077']), [])
+            self.assertEqual(calls.count({'lorry_id__in': ['PSE_2077']}), 2)
+            calls.clear()
+            self.assertEqual(timeutils.window_entries(since, until, []), [])
+            self.assertNotIn({'lorry_id__in': []}, calls)  # no lorries match: nothing queried
+
+    def test_latest_reads_top_n_from_the_index_and_merges_legacy_rows(self):
+        since, until = views.get_window('monthly')
+        typed = [make_tx(f'n{i}', 'PSE_2077', 100, '') for i in range(3)]
+        for i, tx in enumerate(typed):
+            tx.delivery_at = until - timedelta(hours=2 * i + 1)
+        legacy = [make_tx('old-format', 'PKC_1001', 200, (until - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S'))]
+        queries = {}
+
+        def filter_(**kwargs):
+            qs = mock.MagicMock()
+            qs.filter.return_value = qs
+            if 'delivery_at__isnull' in kwargs:
+                qs.order_by.return_value = legacy
+            else:
+                queries['typed'] = qs
+                qs.order_by.return_value.__getitem__.return_value = typed
+            return qs
+
+        with mock.patch.object(timeutils.Transaction, 'objects') as objects, \
+                self.assertLogs('dashboard.timeutils', 'WARNING'), \
+                mock.patch.object(timeutils, '_legacy_warned_at', float('-inf')):
+            objects.filter.side_effect = filter_
+            top = timeutils.window_latest(since, until, 3)
+        queries['typed'].order_by.assert_called_once_with('-delivery_at')
+        queries['typed'].order_by.return_value.__getitem__.assert_called_once_with(slice(None, 3))
+        self.assertEqual([tx.transaction_id for _, tx in top], ['n0', 'old-format', 'n1'])
+
+    def test_backends_filter_in_the_database_query(self):
+        since, until = views.get_window('weekly')
+        stages = pipeline.build_pipeline(since, until, 'weekly', ['PKC_1001'])
+        self.assertEqual(stages[0]['$match']['LORRY_ID'], {'$in': ['PKC_1001']})
+        self.assertNotIn('LORRY_ID', pipeline.build_pipeline(since, until, 'weekly')[0]['$match'])
+
+        db = mock.MagicMock()
+        with mock.patch.object(mongo, 'get_db', return_value=db):
+            rollups.totals(since, until, lorry_type='Tipper', client_id='MBSP')
+            query = db[rollups.COLLECTION].find.call_args[0][0]
+            self.assertEqual((query['lorry_type'], query['client_id']), ('Tipper', 'MBSP'))
+            with mock.patch('dashboard.models.Lorry.objects') as lorries:
+                lorries.all.return_value = LORRIES
+                self.assertEqual(pipeline.aggregate(since, until, 'weekly', lorry_type='Roro'), {})
+            db['deliveries'].aggregate.assert_not_called()
+
+    def test_filtered_columnar_matches_filtered_python(self):
+        if columnar.np is None:
+            self.skipTest('numpy not installed')
+        since, until = views.get_window('weekly')
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            store = columnar.ColumnarDeliveries()
+            store.append((tx.delivery_time, tx.lorry_id, tx.weight) for tx in TXS)
+            ids = lorry_cache.lorries.matching_ids('Tipper')
+            tippers = [tx for tx in TXS if tx.lorry_id in ids]
+            self.assertEqual(
+                views.build_aggregated_rows(store.aggregate(since, until, 'daily', ids), 'daily'),
+                views.python_aggregate(tippers, 'daily'),
+            )
+            self.assertEqual(store.totals(since, until, ids)['unique_lorries'], 1)
+
+    def test_api_and_tools_key_caches_by_range_and_filters(self):
+        api = views.AggregatedDataAPIView.as_view()
+        with self.settings(DASHBOARD_ALL_PERIODS=False), \
+                mock.patch.object(views, 'aggregate_window', return_value=[]) as aggregate:
+            api(RequestFactory().get('/api/aggregated/', {'period': 'daily'})).render()
+            api(RequestFactory().get('/api/aggregated/', {
+                'period': 'daily', 'since': '2024-01-01', 'until': '2024-01-07', 'client_id': 'MBSP',
+            })).render()
+            self.assertEqual(aggregate.call_count, 2)
+            self.assertEqual(aggregate.call_args.kwargs, {'client_id': 'MBSP'})
+            self.assertEqual(aggregate.call_args.args[0].isoformat(), '2024-01-01T00:00:00+00:00')
+            bad = api(RequestFactory().get('/api/aggregated/', {'since': 'soon'}))
+            self.assertEqual(bad.status_code, 400)
+
+        with mock.patch.object(ai_tools, '_totals', return_value={}) as compute:
+            ai_tools.totals('daily')
+            ai_tools.totals('daily', since='2024-01-01', lorry_type='Tipper')
+            ai_tools.totals('daily', since='2024-01-01', lorry_type='Tipper')
+            self.assertEqual(compute.call_count, 2)
+            compute.assert_called_with('daily', '2024-01-01', None, 'Tipper', None)
+
+
+class LiveFeedTests(DashboardTestCase):
+    KPIS = {'kpi_total_deliveries': 10, 'kpi_total_weight_kg': 5000.0,
+            'kpi_total_weight_tons': 5.0, 'kpi_unique_lorries': 1}
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(live.Publisher, '_run', lambda self: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = live.Publisher()
+
+    def _entries(self, txs):
+        return [(views.parse_delivery_time(tx.delivery_time), tx) for tx in txs]
+
+    def test_update_pushes_kpi_deltas_rows_and_buckets(self):
+        self.publisher._kpis = dict(self.KPIS)
+        self.publisher._lorries = {'PSE_2077'}
+        with mock.patch('dashboard.models.Lorry.objects') as lorries:
+            lorries.all.return_value = LORRIES
+            events = dict(self.publisher._update(self._entries(TXS[:3])))
+        self.assertEqual(self.publisher._kpis['kpi_total_deliveries'], 13)
+        self.assertEqual(self.publisher._kpis['kpi_unique_lorries'], 2)
+        self.assertIn('+3', events['kpis'])
+        self.assertIn('8,600', events['kpis'])
+        latest = events['latest']
+        self.assertLess(latest.index('2025-01-07 09:10'), latest.index('2025-01-06T08:15'))  # newest first
+        buckets = json.loads(events['buckets'])
+        self.assertIn(['2025-01-06', 'Tipper', 2700.0], buckets['daily'])
+        self.assertEqual(buckets['hourly'], [])  # outside today's window
+
+    def test_new_entries_range_scan_from_cursor_without_repeats(self):
+        seen, new = TXS[0], TXS[1]
+        for tx in (seen, new):
+            tx.delivery_at = views.parse_delivery_time('2025-01-06T08:45:00')
+        self.publisher._cursor = seen.delivery_at
+        self.publisher._at_cursor = {seen.transaction_id}
+        with mock.patch.object(live.Transaction, 'objects') as objects:
+            qs = objects.filter.return_value.filter.return_value
+            qs.order_by.return_value = [seen, new]
+            self.assertEqual([tx for _, tx in self.publisher._new_entries()], [new])
+            objects.filter.return_value.filter.assert_called_with(delivery_at__gte=seen.delivery_at)
+            self.assertEqual(self.publisher._new_entries(), [])
+            self.publisher._has_new()
+            objects.filter.return_value.filter.assert_called_with(delivery_at__gt=seen.delivery_at)
+        for tx in (seen, new):
+            del tx.delivery_at
+
+    def test_one_computation_shared_by_all_screens(self):
+        first = self.publisher.subscribe()
+        second = self.publisher.subscribe()
+        with mock.patch.object(self.publisher, '_load_baseline') as baseline, \
+                mock.patch.object(self.publisher, '_has_new', side_effect=[False, True]) as probe, \
+                mock.patch.object(self.publisher, '_new_entries', return_value=['e']) as fetch, \
+                mock.patch.object(self.publisher, '_update', return_value=[('kpis', '<div>1</div>')]):
+            self.assertIsNone(self.publisher.poll())  # baseline only
+            self.publisher._kpis = dict(self.KPIS)
+            self.assertIsNone(self.publisher.poll())  # same data version, nothing past the cursor
+            # Inserted by another process (e.g. ingest_csv) before the version is re-read.
+            earlier = self.publisher.poll()
+            caching.bump_data_version()
+            seq = self.publisher.poll()
+        baseline.assert_called_once()
+        self.assertEqual(probe.call_count, 2)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(self.publisher.wait(first, 0),
+                         [(earlier, [('kpis', '<div>1</div>')]), (seq, [('kpis', '<div>1</div>')])])
+        self.assertEqual(self.publisher.wait(second, 0), self.publisher.wait(first, 0))
+        # Reconnects resume from the backlog only with an id from this process.
+        self.assertEqual(self.publisher.subscribe(self.publisher.event_id(first)), first)
+        self.assertEqual(self.publisher.subscribe(f'other-{first}'), seq)
+        self.assertEqual(
+            live.format_event(self.publisher.event_id(seq), 'kpis', 'a\nb'),
+            f'id: {self.publisher.token}-{seq}\nevent: kpis\ndata: a\ndata: b\n\n',
+        )
+
+    def test_wsgi_and_asgi_streams(self):
+        with mock.patch.object(live, 'publisher', self.publisher), \
+                self.settings(DASHBOARD_LIVE_HEARTBEAT_SECONDS=0.01):
+            response = live.live_feed(RequestFactory().get('/live/'))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            stream = iter(response.streaming_content)
+            self.assertEqual(next(stream), b'retry: 5000\n\n')
+            self.assertEqual(next(stream), b': keep-alive\n\n')
+            threading.Timer(0.05, self.publisher.publish, [[('latest', '<tr></tr>')]]).start()
+            chunk = next(stream)
+            while chunk == b': keep-alive\n\n':
+                chunk = next(stream)
+            self.assertIn(b'event: latest', chunk)
+            response.close()
+            self.assertEqual(self.publisher.subscribers, 0)
+
+            sent = []
+            messages = iter([{'type': 'http.request'}])
+
+            async def receive():
+                try:
+                    return next(messages)
+                except StopIteration:
+                    await asyncio.sleep(0.2)
+                    return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 2:
+                    self.publisher.publish([('kpis', '<div></div>')])
+
+            async def inner(scope, receive, send):
+                raise AssertionError('not routed to Django')
+
+            app = live.asgi_router(inner)
+            async_to_sync(app)({'type': 'http', 'path': '/live/', 'headers': []}, receive, send)
+        bodies = b''.join(m.get('body', b'') for m in sent)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn(b'event: kpis', bodies)
+        self.assertEqual(self.publisher.subscribers, 0)
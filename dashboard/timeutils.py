@@ -1,11 +1,27 @@
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
+import heapq
+from itertools import islice
+import logging
 import re
+import time
 
 from django.utils import timezone
-from django.utils.dateparse import parse_datetime
+from django.utils.dateparse import parse_date, parse_datetime
 
-from .models import Lorry
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from . import lorry_cache, metrics
+from .models import Transaction
+
+logger = logging.getLogger(__name__)
+
+LEGACY_WARNING_SECONDS = 300
+_legacy_warned_at = float("-inf")
 
 # Fixed MVP window and "now"
 TRIAL_START = timezone.make_aware(datetime(2025, 1, 1, 0, 0, 0), timezone.utc)
@@ -68,6 +84,246 @@ def parse_delivery_time(value):
     return dt
 
 
+def _fast_iso(value):
+    dt = datetime.fromisoformat(value)
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def _fast_iso_z(value):
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return _fast_iso(value)
+
+
+def _fast_compact_offset(value):
+    # e.g. 2025-01-01T08:16:00.000+0000
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+
+# Single-format parsers tried on a sample to pick the batch's fast path.
+FAST_PARSERS = (_fast_iso, _fast_iso_z, _fast_compact_offset)
+
+# Bound on distinct strings remembered per batch / across outlier calls.
+MEMO_SIZE = 65536
+
+_parse_memo = lru_cache(maxsize=4096)(parse_delivery_time)
+
+
+def _parse_outlier(value):
+    # Strings repeat a lot in outlier-heavy data; memoise them (bounded).
+    if isinstance(value, str):
+        return _parse_memo(value)
+    return parse_delivery_time(value)
+
+
+def _detect_fast_parser(values, sample_size=64):
+    sample = [v for v in islice(values, sample_size) if isinstance(v, str) and v]
+    best, best_hits = None, 0
+    for parser in FAST_PARSERS:
+        hits = 0
+        for v in sample:
+            try:
+                parser(v)
+                hits += 1
+            except (TypeError, ValueError):
+                pass
+        if hits > best_hits:
+            best, best_hits = parser, hits
+        if hits == len(sample):
+            break
+    return best
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MS = timedelta(milliseconds=1)
+_NAT = -(2 ** 63)  # numpy's NaT as int64
+
+
+def _epoch_ms(dt):
+    return (dt - _EPOCH) // _MS if dt is not None else _NAT
+
+
+def parse_delivery_times(values, as_numpy=False):
+    """Parse many DELIVERY_TIME values at once.
+
+    The dominant string format is detected once from a sample and the rest
+    are parsed on that single fast path; only values it rejects go through
+    parse_delivery_time's fallback chain. Repeated strings are parsed once
+    (bounded memo).
+    Returns a list aligned with ``values`` (None where unparseable), or with
+    ``as_numpy=True`` a ``datetime64[ms]`` array with NaT for those rows.
+    """
+    if as_numpy and np is None:
+        raise ImportError("numpy is required for as_numpy=True")
+    values = values if isinstance(values, (list, tuple)) else list(values)
+    fast = _detect_fast_parser(values)
+    memo = {}
+    out = []
+    ms = []
+    for v in values:
+        if v.__class__ is not str:
+            dt = _parse_outlier(v)
+            out.append(dt)
+            if as_numpy:
+                ms.append(_epoch_ms(dt))
+            continue
+        hit = memo.get(v)
+        if hit is None:
+            dt = None
+            if fast is not None:
+                try:
+                    dt = fast(v)
+                except ValueError:
+                    dt = _parse_outlier(v)
+            else:
+                dt = _parse_outlier(v)
+            hit = (dt, _epoch_ms(dt) if as_numpy else None)
+            if len(memo) < MEMO_SIZE:
+                memo[v] = hit
+        out.append(hit[0])
+        if as_numpy:
+            ms.append(hit[1])
+    if not as_numpy:
+        return out
+    return np.array(ms, dtype=np.int64).view('datetime64[ms]')
+
+
+def delivery_datetime(tx):
+    """Delivery time of a transaction as an aware UTC datetime.
+
+    Uses the typed DELIVERY_AT field when it has been backfilled and only
+    falls back to parsing the raw DELIVERY_TIME string otherwise.
+    """
+    dt = getattr(tx, 'delivery_at', None)
+    if dt is not None:
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt, timezone.utc)
+        return dt
+    return parse_delivery_time(tx.delivery_time)
+
+
+def _legacy_entries(since, until, lorry_ids=None):
+    """(datetime, transaction) pairs within [since, until] for rows not yet
+    backfilled, parsed in Python. Rows flagged DELIVERY_AT_INVALID are
+    skipped; any others cost a scan on every call, so their presence is
+    logged (at most every LEGACY_WARNING_SECONDS)."""
+    global _legacy_warned_at
+    legacy = Transaction.objects.filter(delivery_at__isnull=True, delivery_at_invalid__isnull=True)
+    if lorry_ids is not None:
+        legacy = legacy.filter(lorry_id__in=lorry_ids)
+    with metrics.span("db"):
+        legacy = list(legacy.order_by())
+    if legacy and time.monotonic() - _legacy_warned_at >= LEGACY_WARNING_SECONDS:
+        _legacy_warned_at = time.monotonic()
+        logger.warning(
+            "%d deliveries have no DELIVERY_AT and are parsed on every query; run backfill_delivery_at",
+            len(legacy),
+        )
+    with metrics.span("parse"):
+        return [
+            (dt, tx)
+            for dt, tx in zip(parse_delivery_times([tx.delivery_time for tx in legacy]), legacy)
+            if dt and since <= dt <= until
+        ]
+
+
+def window_entries(since, until, lorry_ids=None):
+    """(delivery datetime, transaction) pairs within [since, until].
+
+    Backfilled rows are selected with an index range scan on DELIVERY_AT;
+    rows without the typed field are parsed and filtered in Python. Each
+    timestamp is parsed once and returned alongside its transaction.
+    ``lorry_ids`` (see ``LorryCache.matching_ids``) restricts both queries
+    to those lorries.
+    """
+    if lorry_ids is not None and not lorry_ids:
+        return []
+    typed = Transaction.objects.filter(delivery_at__gte=since, delivery_at__lte=until)
+    if lorry_ids is not None:
+        typed = typed.filter(lorry_id__in=lorry_ids)
+    with metrics.span("db"):
+        typed = list(typed.order_by())
+    with metrics.span("parse"):
+        entries = [(delivery_datetime(tx), tx) for tx in typed]
+    entries.extend(_legacy_entries(since, until, lorry_ids))
+    return entries
+
+
+def window_latest(since, until, n, lorry_ids=None):
+    """The ``n`` newest (datetime, transaction) pairs within [since, until],
+    newest first.
+
+    Backfilled rows come from a sorted, limited scan of DELIVERY_AT_1, so
+    only ``n`` of them are read; rows without the typed field are parsed as
+    in ``window_entries`` and merged in.
+    """
+    if lorry_ids is not None and not lorry_ids:
+        return []
+    typed = Transaction.objects.filter(delivery_at__gte=since, delivery_at__lte=until)
+    if lorry_ids is not None:
+        typed = typed.filter(lorry_id__in=lorry_ids)
+    with metrics.span("db"):
+        typed = list(typed.order_by('-delivery_at')[:n])
+    entries = [(delivery_datetime(tx), tx) for tx in typed]
+    entries.extend(_legacy_entries(since, until, lorry_ids))
+    return heapq.nlargest(n, entries, key=lambda e: e[0])
+
+
+def window_transactions(since, until, lorry_ids=None):
+    """Transactions delivered within [since, until]."""
+    return [tx for _, tx in window_entries(since, until, lorry_ids)]
+
+
+def parse_bound(value, end=False):
+    """Parse a since/until query value (ISO date or datetime; naive = UTC).
+
+    A bare date as an upper bound means the end of that day. Returns None for
+    an empty value and raises ValueError for an unparseable one.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        dt = parse_datetime(value)
+        if dt is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f"invalid date/time: {value!r}")
+            dt = datetime.combine(day, datetime.max.time() if end else datetime.min.time())
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.utc)
+    return dt
+
+
+def get_window(period):
+    """Return (since, until) bounds based on the selected period.
+    - hourly: start of "today" to NOW
+    - daily/weekly/monthly: from TRIAL_START to NOW (capped by TRIAL_END)
+    """
+    end = min(NOW, TRIAL_END)
+    if period == 'hourly':
+        return end.replace(hour=0, minute=0, second=0, microsecond=0), end
+    return TRIAL_START, end
+
+
+def kpi_window():
+    """Window of the KPI tiles: the trial month to date."""
+    return TRIAL_START, min(NOW, TRIAL_END)
+
+
+def resolve_window(period, since=None, until=None):
+    """The period's default window, overridden by explicit ``since``/``until``
+    (datetimes or query values, see parse_bound). Raises ValueError for bad
+    bounds."""
+    default_since, default_until = get_window(period)
+    since = parse_bound(since) or default_since
+    until = parse_bound(until, end=True) or default_until
+    if since > until:
+        raise ValueError('since must not be after until')
+    return since, until
+
+
 def get_period_key(dt, period):
     if period == 'hourly':
         return dt.replace(minute=0, second=0, microsecond=0)
@@ -79,11 +335,15 @@ def get_period_key(dt, period):
         return dt.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-def python_aggregate(transactions, period):
-    lorry_lookup = {l.lorry_id: l for l in Lorry.objects.all()}
+def group_entries(entries, period, lorry_lookup=None):
+    """{period key: {lorry type: weight}} for (datetime, transaction) pairs.
+
+    Rows with no parseable time or weight are skipped.
+    """
+    if lorry_lookup is None:
+        lorry_lookup = lorry_cache.lorries.lookup()
     agg = defaultdict(lambda: defaultdict(float))
-    for tx in transactions:
-        dt = parse_delivery_time(tx.delivery_time)
+    for dt, tx in entries:
         if dt is None:
             continue
         key = get_period_key(dt, period)
@@ -94,6 +354,32 @@ def python_aggregate(transactions, period):
         except Exception:
             continue
         agg[key][lorry_type] += weight_val
+    return agg
+
+
+def regroup(hourly, period, since=None, until=None):
+    """Fold an hourly {hour: {lorry type: weight}} mapping into ``period``
+    buckets, keeping hours within [since, until].
+
+    Exact for windows that start on an hour boundary and end where the
+    hourly pass ended.
+    """
+    agg = defaultdict(lambda: defaultdict(float))
+    for hour, types in hourly.items():
+        if (since is not None and hour < since) or (until is not None and hour > until):
+            continue
+        bucket = agg[get_period_key(hour, period)]
+        for lorry_type, weight in types.items():
+            bucket[lorry_type] += weight
+    return agg
+
+
+def python_aggregate(transactions, period):
+    return grouped_rows(group_entries(((delivery_datetime(tx), tx) for tx in transactions), period))
+
+
+def grouped_rows(agg):
+    """Flatten a {period: {lorry_type: weight}} mapping into rows."""
     rows = []
     for period_val, lorry_dict in agg.items():
         for lorry_type, total_weight in lorry_dict.items():
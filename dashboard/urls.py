@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import live, metrics, views, warmup
 from rest_framework.routers import DefaultRouter
 from .views import LorryViewSet, TransactionViewSet, AggregatedDataAPIView
 
@@ -7,6 +7,7 @@ urlpatterns = [
     path('', views.dashboard_view, name='dashboard'),
     path('aggregated-table/', views.aggregated_table, name='aggregated_table'),
     path('chat/', views.dashboard_chat, name='dashboard_chat'),
+    path('live/', live.live_feed, name='live_feed'),  # live.PATH
 ]
 
 router = DefaultRouter()
@@ -16,4 +17,8 @@ router.register(r'api/transactions', TransactionViewSet, basename='transaction')
 urlpatterns += router.urls
 urlpatterns += [
     path('api/aggregated/', AggregatedDataAPIView.as_view(), name='aggregated_api'),
+    path('api/chart/', views.chart_data, name='chart_api'),
+    path('api/export/deliveries/', views.export_deliveries, name='export_deliveries'),
+    path('metrics', metrics.metrics_view, name='metrics'),
+    path('ready', warmup.readiness_view, name='readiness'),
 ]
\ No newline at end of file
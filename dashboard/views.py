@@ -1,136 +1,66 @@
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from .models import Transaction
 from django.db.models import Sum
-from django.utils import timezone
 from datetime import timedelta
 from django.db.models.functions import Trunc
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
 from rest_framework import viewsets
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .models import Lorry, Transaction
 from .serializers import LorrySerializer, TransactionSerializer
-from django.views.decorators.csrf import csrf_exempt
+from .pagination import DeliveryCursorPagination
+from . import caching, charts, engine, export, lorry_cache, metrics
+from .timeutils import (
+    NOW, delivery_datetime, get_window, group_entries, kpi_window, parse_bound,
+    parse_delivery_time, regroup, resolve_window, window_entries,
+)
 from django.utils.html import escape
 import itertools
-from collections import defaultdict
 from datetime import datetime
-from django.utils.dateparse import parse_datetime
-import re
 
-TRIAL_START = timezone.make_aware(datetime(2025, 1, 1, 0, 0, 0), timezone.utc)
-TRIAL_END = timezone.make_aware(datetime(2025, 1, 31, 23, 59, 59), timezone.utc)
-# Fixed "today" for MVP scenarios; adjust in production
-NOW = timezone.make_aware(datetime(2025, 1, 25, 16, 0, 0), timezone.utc)
 try:
     from .gemini import _vertex_available as _ai_vertex_available
 except Exception:
     def _ai_vertex_available():
         return False
 
-def get_window(period: str):
-    """Return (since, until) bounds based on the selected period.
-    - hourly: start of "today" to NOW
-    - daily/weekly/monthly: from TRIAL_START to NOW (capped by TRIAL_END)
+def request_scope(params, period):
+    """(since, until, filters) for a request.
+
+    ``since``/``until`` (see parse_bound) override the period's default
+    window; ``filters`` holds the non-empty ``lorry_type``/``client_id``
+    values. Raises ValueError for bad bounds.
     """
-    end = min(NOW, TRIAL_END)
-    if period == 'hourly':
-        start = end.replace(hour=0, minute=0, second=0, microsecond=0)
-        return start, end
-    # default to month-to-date for other granularities
-    return TRIAL_START, end
-
-def parse_delivery_time(value):
-    """Parse DELIVERY_TIME coming from MongoDB.
-    Handles Python datetime, ISO strings, epoch numbers, and {'$date': ...} dicts.
-    Returns timezone-aware UTC datetime or None.
+    since, until = resolve_window(period, params.get('since'), params.get('until'))
+    filters = {k: params[k] for k in ('lorry_type', 'client_id') if params.get(k)}
+    return since, until, filters
+
+def filters_key(filters):
+    return tuple(sorted(filters.items()))
+
+def chart_url(params, period):
+    """URL of the chart payload for the same period, range and filters."""
+    query = params.copy()
+    query['period'] = period
+    return f"{reverse('chart_api')}?{query.urlencode()}"
+
+def python_aggregate(transactions, period, lorry_lookup=None):
+    return aggregate_entries(((delivery_datetime(tx), tx) for tx in transactions), period, lorry_lookup)
+
+def aggregate_entries(entries, period, lorry_lookup=None):
+    """Group already-parsed (datetime, transaction) pairs into template rows."""
+    with metrics.span('aggregate'):
+        return build_aggregated_rows(group_entries(entries, period, lorry_lookup), period)
+
+def build_aggregated_rows(agg, period):
+    """Turn a {period: {lorry_type: weight}} mapping into template rows
+    with display labels and period banding.
     """
-    if value is None or value == "":
-        return None
-    # Already a datetime
-    if isinstance(value, datetime):
-        dt = value
-        if timezone.is_naive(dt):
-            dt = timezone.make_aware(dt, timezone.utc)
-        return dt
-    # Djongo/pymongo can sometimes give {'$date': ...}
-    if isinstance(value, dict) and '$date' in value:
-        value = value['$date']
-    # Epoch seconds or milliseconds
-    if isinstance(value, (int, float)):
-        # Heuristic: if too large, assume ms
-        ts = value / 1000.0 if value > 1e12 else float(value)
-        try:
-            return datetime.fromtimestamp(ts, tz=timezone.utc)
-        except Exception:
-            return None
-    # Coerce to string for the parsers below
-    if not isinstance(value, str):
-        value = str(value)
-    # Fast path: Python's ISO 8601 parser (supports '+HH:MM' offsets and milliseconds)
-    try:
-        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
-    except Exception:
-        dt = None
-    # Normalize timezone like +HH:MM -> +HHMM and retry if needed
-    if dt is None:
-        try:
-            normalized = re.sub(r"([+-]\d{2}):(\d{2})$", r"\1\2", value)
-            dt = datetime.strptime(normalized, '%Y-%m-%dT%H:%M:%S.%f%z')
-        except Exception:
-            dt = None
-    # Try Django's parser
-    if dt is None:
-        try:
-            dt = parse_datetime(value)
-        except Exception:
-            dt = None
-    # Try a few explicit formats
-    if dt is None:
-        for fmt in (
-            '%Y-%m-%d %H:%M:%S',
-            '%Y-%m-%dT%H:%M:%S',
-            '%Y-%m-%d %H:%M:%S%z',
-        ):
-            try:
-                dt = datetime.strptime(value, fmt)
-                break
-            except Exception:
-                continue
-    if dt is None:
-        return None
-    if timezone.is_naive(dt):
-        dt = timezone.make_aware(dt, timezone.utc)
-    return dt
-
-def get_period_key(dt, period):
-    if period == 'hourly':
-        return dt.replace(minute=0, second=0, microsecond=0)
-    elif period == 'weekly':
-        # ISO week: (year, week number)
-        return f"{dt.isocalendar()[0]}-W{dt.isocalendar()[1]:02d}"
-    elif period == 'monthly':
-        return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    else:  # daily
-        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
-
-def python_aggregate(transactions, period):
-    from .models import Lorry
-    lorry_lookup = {l.lorry_id: l for l in Lorry.objects.all()}
-    agg = defaultdict(lambda: defaultdict(float))
-    for tx in transactions:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt is None:
-            continue
-        key = get_period_key(dt, period)
-        lorry = lorry_lookup.get(tx.lorry_id)
-        lorry_type = lorry.types_id if lorry else 'Unknown'
-        try:
-            weight_val = float(tx.weight)
-        except Exception:
-            continue
-        agg[key][lorry_type] += weight_val
     rows = []
     for period_val, lorry_dict in agg.items():
         # Build a human-readable label for the period
@@ -173,76 +103,176 @@ def python_aggregate(transactions, period):
         r['group_border'] = 'border-t-4 border-blue-300' if is_new_group else ''
     return rows
 
+def aggregate_window(since, until, period, txs=None, **filters):
+    """Aggregated rows for the window from the configured engine.
+
+    DASHBOARD_AGGREGATION_BACKEND picks the engine (see engine.py); if it is
+    unavailable the Python engine answers instead. ``filters`` (lorry_type,
+    client_id) are applied in the engine's query. Given ``txs``, the
+    already-fetched window is grouped in-process.
+    """
+    if txs is not None:
+        return python_aggregate(txs, period)
+    return build_aggregated_rows(engine.by_period(since, until, period, **filters), period)
+
+class DashboardSnapshot:
+    """Deliveries for one dashboard render, fetched and parsed once.
+
+    Loads the union of the requested windows in a single pass (each
+    timestamp parsed once), then serves the aggregate table, the KPI tiles
+    and the latest feed from memory with lorries from the dimension cache.
+    This is how the Python engine serves a page.
+    """
+
+    def __init__(self, *windows, lorry_ids=None):
+        since = min(w[0] for w in windows)
+        until = max(w[1] for w in windows)
+        self.entries = window_entries(since, until, lorry_ids)
+        self.lorry_lookup = lorry_cache.lorries.lookup()
+
+    def between(self, since, until):
+        return [e for e in self.entries if since <= e[0] <= until]
+
+    def aggregate(self, since, until, period):
+        return aggregate_entries(self.between(since, until), period, self.lorry_lookup)
+
+    def latest(self, since, until, n=20):
+        """Top-n most recent deliveries, enriched with lorry type (no DB FK)."""
+        return engine.latest_rows(self.between(since, until), self.lorry_lookup, n)
+
+    def kpis(self, since, until):
+        return kpi_context(engine.summarize(self.between(since, until)))
+
+def kpi_context(summary):
+    """KPI tile context for an engine ``totals`` result."""
+    weight_kg = summary['weight_kg']
+    return {
+        'kpi_total_deliveries': summary['deliveries'],
+        'kpi_total_weight_kg': weight_kg,
+        'kpi_total_weight_tons': weight_kg / 1000.0 if weight_kg else 0.0,
+        'kpi_unique_lorries': summary['unique_lorries'],
+    }
+
+def all_periods_window():
+    """Union of the default windows of every period."""
+    windows = [get_window(p) for p in engine.PERIODS]
+    return min(w[0] for w in windows), max(w[1] for w in windows)
+
+def aggregate_all_periods(**filters):
+    """{period: rows} for every period's default window from one pass.
+
+    The engine groups the union window by hour once; daily, weekly and
+    monthly buckets are folded from the hours. Default windows start at
+    midnight and share their end, so the result matches aggregate_window.
+    """
+    since, until = all_periods_window()
+    hourly = engine.by_period(since, until, 'hourly', **filters)
+    with metrics.span('aggregate'):
+        return {
+            period: build_aggregated_rows(regroup(hourly, period, *get_window(period)), period)
+            for period in engine.PERIODS
+        }
+
+def cached_all_periods(**filters):
+    """aggregate_all_periods, cached as one entry per filters and data version."""
+    since, until = all_periods_window()
+    return caching.cached('rows', 'aggregated_all', 'all', since, until,
+                          lambda: aggregate_all_periods(**filters), filters=filters_key(filters))
+
+def cached_aggregate(since, until, period, **filters):
+    """aggregate_window rows, cached per window, filters and data version.
+
+    With DASHBOARD_ALL_PERIODS (the default), a period's default window is
+    served from the shared all-periods entry, so switching the period does
+    not rescan deliveries.
+    """
+    if getattr(settings, 'DASHBOARD_ALL_PERIODS', True) and (since, until) == get_window(period):
+        return cached_all_periods(**filters)[period]
+    return caching.cached('rows', 'aggregated', period, since, until,
+                          lambda: aggregate_window(since, until, period, **filters),
+                          filters=filters_key(filters))
+
 def dashboard_view(request):
     period = request.GET.get('period', 'daily')  # default granularity
-    since, until = get_window(period)
-    qs = Transaction.objects.all()
-    # Filter in Python due to string dates
-    txs = []
-    for tx in qs:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt and since <= dt <= until:
-            txs.append(tx)
-    aggregated = python_aggregate(txs, period)
-    latest_transactions = sorted(
-        txs, key=lambda t: parse_delivery_time(t.delivery_time) or TRIAL_START, reverse=True
-    )[:20]
-    # Enrich latest transactions with lorry type via lookup (no DB FK)
-    lorry_lookup = {l.lorry_id: l for l in Lorry.objects.all()}
-    enriched_latest = []
-    for t in latest_transactions:
-        l = lorry_lookup.get(t.lorry_id)
-        enriched_latest.append({
-            'transaction_id': t.transaction_id,
-            'lorry_id': t.lorry_id,
-            'lorry_types_id': getattr(l, 'types_id', 'Unknown') if l else 'Unknown',
-            'weight': t.weight,
-            'delivery_time': t.delivery_time,
-        })
-    # KPI calculations (always month-to-date regardless of selected period)
-    kpi_since, kpi_until = TRIAL_START, min(NOW, TRIAL_END)
-    kpi_txs = []
-    for tx in qs:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt and kpi_since <= dt <= kpi_until:
-            kpi_txs.append(tx)
-    total_deliveries = len(kpi_txs)
-    total_weight_kg = sum((float(getattr(t, 'weight', 0) or 0) for t in kpi_txs), 0.0)
-    unique_lorries = len({t.lorry_id for t in kpi_txs})
-
-    context = {
-        'transactions': enriched_latest,
-        'aggregated': aggregated,
-        'period': period,
-        'now': NOW,
-        'now_display': NOW.strftime('%d %b %Y, %I:%M %p UTC'),
-        'ai_backend': 'Gemini' if _ai_vertex_available() else 'Local NLQ',
+    try:
+        since, until, filters = request_scope(request.GET, period)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    # KPIs cover the trial month to date unless an explicit range is given.
+    if request.GET.get('since') or request.GET.get('until'):
+        kpi_since, kpi_until = since, until
+    else:
+        kpi_since, kpi_until = kpi_window()
+    key = filters_key(filters) + (('kpi', kpi_since.isoformat(), kpi_until.isoformat()),)
+    etag, modified = caching.etag_for('dashboard', period, since, until, key)
+    response = caching.not_modified(request, etag, modified)
+    if response is not None:
+        return response
+
+    def build():
+        if engine.get_engine() is engine.python_engine:
+            # One window fetch serves the table, the feed and the KPIs.
+            snapshot = DashboardSnapshot(
+                (since, until), (kpi_since, kpi_until),
+                lorry_ids=lorry_cache.lorries.matching_ids(**filters),
+            )
+            transactions = snapshot.latest(since, until)
+            aggregated = snapshot.aggregate(since, until, period)
+            kpis = snapshot.kpis(kpi_since, kpi_until)
+        else:
+            transactions = engine.latest(since, until, **filters)
+            aggregated = cached_aggregate(since, until, period, **filters)
+            kpis = kpi_context(engine.totals(kpi_since, kpi_until, **filters))
+        context = {
+            'transactions': transactions,
+            'aggregated': aggregated,
+            'chart_url': chart_url(request.GET, period),
+            'period': period,
+            'since': request.GET.get('since', ''),
+            'until': request.GET.get('until', ''),
+            'lorry_type': filters.get('lorry_type', ''),
+            'client_id': filters.get('client_id', ''),
+            # The live feed covers the default, unfiltered view only.
+            'live': not (filters or request.GET.get('since') or request.GET.get('until')),
+            'now': NOW,
+            'now_display': NOW.strftime('%d %b %Y, %I:%M %p UTC'),
+            'ai_backend': 'Gemini' if _ai_vertex_available() else 'Local NLQ',
+        }
         # Summary KPIs for the trial month
-        'kpi_total_deliveries': total_deliveries,
-        'kpi_total_weight_kg': total_weight_kg,
-        'kpi_total_weight_tons': total_weight_kg / 1000.0 if total_weight_kg else 0.0,
-        'kpi_unique_lorries': unique_lorries,
-    }
-    return render(request, 'dashboard/index.html', context)
+        context.update(kpis)
+        with metrics.span('render'):
+            return render_to_string('dashboard/index.html', context, request)
+
+    html = caching.cached('page', 'dashboard', period, since, until, build, filters=key)
+    return caching.stamp(HttpResponse(html), etag, modified)
 
 def aggregated_table(request):
     period = request.GET.get('period', 'daily')
     # If this endpoint is opened directly in the browser (not an HTMX request),
     # push users back to the full page with the selected period so layout/scripts load.
+    query = request.GET.copy()
+    query['period'] = period
     if not request.headers.get('HX-Request'):
-        return redirect(f'/?period={period}')
-    since, until = get_window(period)
-    qs = Transaction.objects.all()
-    txs = []
-    for tx in qs:
-        dt = parse_delivery_time(tx.delivery_time)
-        if dt and since <= dt <= until:
-            txs.append(tx)
-    aggregated = python_aggregate(txs, period)
-    html = render_to_string('dashboard/_aggregated_table.html', {'aggregated': aggregated, 'period': period})
-    response = HttpResponse(html)
-    # Ask HTMX to push the root URL with the period param, not the partial URL
-    response["HX-Push-Url"] = f"/?period={period}"
+        return redirect(f'/?{query.urlencode()}')
+    try:
+        since, until, filters = request_scope(request.GET, period)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    key = filters_key(filters)
+    etag, modified = caching.etag_for('aggregated_table', period, since, until, key)
+    response = caching.not_modified(request, etag, modified)
+    if response is None:
+        def build():
+            aggregated = cached_aggregate(since, until, period, **filters)
+            with metrics.span('render'):
+                return render_to_string(
+                    'dashboard/_aggregated_table.html',
+                    {'aggregated': aggregated, 'period': period, 'chart_url': chart_url(request.GET, period)},
+                )
+        html = caching.cached('fragment', 'aggregated_table', period, since, until, build, filters=key)
+        response = caching.stamp(HttpResponse(html), etag, modified)
+    # Ask HTMX to push the root URL with the query params, not the partial URL
+    response["HX-Push-Url"] = f"/?{query.urlencode()}"
     return response
 
 class LorryViewSet(viewsets.ReadOnlyModelViewSet):
@@ -250,33 +280,87 @@ class LorryViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = LorrySerializer
 
 class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
-    # No FK relation on Transaction; use plain queryset
-    queryset = Transaction.objects.all()
+    # No FK relation on Transaction; use plain queryset. Paged on DELIVERY_AT,
+    # so rows are listed once backfill_delivery_at has typed them.
+    queryset = Transaction.objects.filter(delivery_at__isnull=False)
     serializer_class = TransactionSerializer
+    pagination_class = DeliveryCursorPagination
 
 class AggregatedDataAPIView(APIView):
     def get(self, request):
         period = request.GET.get('period', 'daily')
-        since, until = get_window(period)
-        qs = Transaction.objects.all()
-        txs = []
-        for tx in qs:
-            dt = parse_delivery_time(tx.delivery_time)
-            if dt and since <= dt <= until:
-                txs.append(tx)
-        aggregated = python_aggregate(txs, period)
-        return Response(aggregated)
-
-@csrf_exempt  # For demo; in production, use proper CSRF handling!
-def dashboard_chat(request):
+        try:
+            since, until, filters = request_scope(request.GET, period)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
+        etag, modified = caching.etag_for('aggregated_api', period, since, until, filters_key(filters))
+        response = caching.not_modified(request, etag, modified)
+        if response is not None:
+            return response
+        return caching.stamp(Response(cached_aggregate(since, until, period, **filters)), etag, modified)
+
+def chart_data(request):
+    """Chart payload (see charts.py) for the period, range and filters.
+
+    Shares the cached aggregate rows with the table; the encoded and
+    gzipped bodies are cached per data version and revalidated by ETag.
+    """
+    period = request.GET.get('period', 'daily')
+    try:
+        since, until, filters = request_scope(request.GET, period)
+    except ValueError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+    key = filters_key(filters)
+    etag, modified = caching.etag_for('chart', period, since, until, key)
+    response = caching.not_modified(request, etag, modified)
+    if response is not None:
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    def build():
+        rows = cached_aggregate(since, until, period, **filters)
+        with metrics.span('render'):
+            return charts.encode(charts.pivot(rows, period))
+
+    body, gzipped = caching.cached('payload', 'chart', period, since, until, build, filters=key)
+    response = caching.stamp(charts.response(request, body, gzipped), etag, modified)
+    if response.has_header('Content-Encoding'):
+        # A different representation of the same data (as GZipMiddleware).
+        response['ETag'] = f'W/{etag}'
+    return response
+
+def export_deliveries(request):
+    """Stream deliveries as CSV (default) or NDJSON.
+
+    Query params: format=csv|ndjson, since, until, lorry_type, client_id.
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest('format must be csv or ndjson')
+    try:
+        since = parse_bound(request.GET.get('since'))
+        until = parse_bound(request.GET.get('until'), end=True)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    batches = export.rows(
+        since, until,
+        lorry_type=request.GET.get('lorry_type') or None,
+        client_id=request.GET.get('client_id') or None,
+    )
+    response = StreamingHttpResponse(export.stream(fmt, batches), content_type=export.FORMATS[fmt])
+    stamp = '_'.join(d.strftime('%Y%m%d') for d in (since, until) if d) or 'all'
+    response['Content-Disposition'] = f'attachment; filename="deliveries_{stamp}.{fmt}"'
+    return response
+
+async def dashboard_chat(request):
     if request.method == 'POST':
         question = request.POST.get('question', '').strip()
         if not question:
             return HttpResponse('<span class="text-red-600">Please enter a question.</span>')
-        # Placeholder for Gemini call
         try:
-            from .gemini import ask_gemini
-            answer = ask_gemini(question)
+            from .gemini import ask_gemini_async
+            with metrics.span('ai'):
+                answer = await ask_gemini_async(question)
         except Exception as e:
             answer = f"<span class=\"text-red-600\">[Error contacting AI: {escape(str(e))}]</span>"
         # Render NLQ/AI HTML as-is; question stays escaped
@@ -285,3 +369,8 @@ def dashboard_chat(request):
             f'<div><strong>A:</strong> {answer}</div>'
         )
     return HttpResponse('<span class="text-red-600">Invalid request.</span>')
+
+
+# For demo; in production, use proper CSRF handling! (csrf_exempt() wraps
+# views in a sync function in Django 3.2, so mark the async view directly.)
+dashboard_chat.csrf_exempt = True
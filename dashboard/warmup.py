@@ -0,0 +1,166 @@
+"""Background cache warm-up, so the first visitor after a deploy or an
+ingest does not pay for cold caches.
+
+``start()`` (called from ``DashboardConfig.ready`` when
+``DASHBOARD_PREWARM`` is set) runs ``prewarm`` in a daemon thread; the
+ingest_csv command runs it in-process after loading. A warm-up loads the
+lorry dimension and, if selected, the columnar store, builds the
+all-periods aggregate entry (see views.cached_all_periods) and renders the
+default dashboard page for every period into the response cache. Warm
+entries are keyed by data version, so they serve every worker sharing the
+cache until the next write.
+
+``/ready`` reports the state: 200 once a warm-up has finished (or when
+warm-up is disabled), 503 while it runs or after it failed.
+
+A process forked after ``start()`` (``gunicorn --preload`` loads the app in
+the master) inherits no running thread and caches that belong to the
+master, so the fork resets the state, and the worker's first request (or
+``/ready`` probe) starts its own warm-up; see ``ensure_started``.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.http import HttpRequest, JsonResponse, QueryDict
+from django.utils.decorators import sync_and_async_middleware
+
+from . import caching, columnar, engine, lorry_cache
+
+logger = logging.getLogger(__name__)
+
+IDLE, WARMING, READY, FAILED, DISABLED = "idle", "warming", "ready", "failed", "disabled"
+
+_lock = threading.Lock()
+_state: Dict = {"status": IDLE}
+_thread: Optional[threading.Thread] = None
+# Process that started the current warm-up.
+_pid: Optional[int] = None
+
+
+def enabled() -> bool:
+    return bool(getattr(settings, "DASHBOARD_PREWARM", False))
+
+
+def state() -> Dict:
+    with _lock:
+        return dict(_state)
+
+
+def _set(**values) -> None:
+    with _lock:
+        _state.update(values)
+
+
+def _page_request(period: str) -> HttpRequest:
+    request = HttpRequest()
+    request.method = "GET"
+    request.GET = QueryDict(f"period={period}")
+    return request
+
+
+def prewarm() -> Dict:
+    """Warm the caches for the default, unfiltered dashboard; returns the state."""
+    from . import views
+
+    started = time.time()
+    _set(status=WARMING, started_at=started, finished_at=None, seconds=None, error=None, steps={})
+    steps = {}
+
+    def step(name, fn):
+        t0 = time.perf_counter()
+        fn()
+        steps[name] = round(time.perf_counter() - t0, 3)
+
+    try:
+        step("lorries", lorry_cache.lorries.lookup)
+        if columnar.enabled():
+            step("columnar", columnar.get_store)
+        for period in engine.PERIODS:
+            # The first period builds the shared all-periods entry.
+            step(f"rows:{period}", lambda: views.cached_aggregate(*views.get_window(period), period))
+        for period in engine.PERIODS:
+            step(f"page:{period}", lambda: views.dashboard_view(_page_request(period)))
+    except Exception as e:
+        logger.exception("Dashboard warm-up failed")
+        result = {"status": FAILED, "error": str(e)}
+    else:
+        result = {"status": READY, "version": caching.data_version()[0]}
+    finished = time.time()
+    _set(steps=steps, finished_at=finished, seconds=round(finished - started, 3), **result)
+    return state()
+
+
+def _serving() -> bool:
+    """False for management commands other than runserver (and for the
+    runserver autoreloader's parent process)."""
+    if os.path.basename(sys.argv[0]) != "manage.py":
+        return True
+    if sys.argv[1:2] != ["runserver"]:
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+
+
+def start() -> None:
+    """Warm up in a background thread if enabled and serving requests."""
+    global _thread, _pid
+    if not enabled():
+        _set(status=DISABLED)
+        return
+    if not _serving():
+        return
+    with _lock:
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        _state["status"] = WARMING
+        _thread = threading.Thread(target=prewarm, name="dashboard-warmup", daemon=True)
+        _thread.start()
+
+
+def ensure_started() -> None:
+    """Start warm-up in this process if it was started in a parent before
+    the fork. A pid comparison, so cheap enough to run on every request."""
+    if _pid is not None and _pid != os.getpid():
+        start()
+
+
+@sync_and_async_middleware
+def warmup_middleware(get_response):
+    """Runs ``ensure_started`` ahead of each request."""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            ensure_started()
+            return await get_response(request)
+    else:
+        def middleware(request):
+            ensure_started()
+            return get_response(request)
+    return middleware
+
+
+def readiness_view(request):
+    ensure_started()
+    current = state()
+    ready = current["status"] in (READY, DISABLED)
+    return JsonResponse(dict(current, ready=ready), status=200 if ready else 503)
+
+
+def _after_fork_in_child() -> None:
+    global _lock, _thread
+    # The lock may have been held by the parent's warm-up thread.
+    _lock = threading.Lock()
+    _thread = None
+    if _pid is not None:
+        _state.clear()
+        _state["status"] = IDLE
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
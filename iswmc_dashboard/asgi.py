@@ -3,14 +3,137 @@ ASGI config for iswm_dashboard project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Only the async views (``ASYNC_PATHS``) and the SSE live feed run on the event
+loop. Under ASGI, Django 3.2 runs every sync view with
+``thread_sensitive=True``, i.e. on one shared thread per process, so the
+dashboard, fragments, API, exports and ``/ready`` go through the WSGI
+handler on a thread pool instead, keeping WSGI's per-request concurrency.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
+import sys
+from collections import defaultdict
+from tempfile import SpooledTemporaryFile
 
+from asgiref.sync import async_to_sync, sync_to_async
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iswmc_dashboard.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+
+# The SSE live feed is served natively (see dashboard/live.py).
+from dashboard.live import asgi_router  # noqa: E402
+
+ASYNC_PATHS = ('/chat/',)
+
+
+def wsgi_environ(scope, body):
+    """Build the WSGI environ for an ASGI HTTP scope and its request body."""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope.get('query_string', b'').decode('ascii'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    headers = defaultdict(list)
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name in ('content-length', 'content-type'):
+            key = name.upper().replace('-', '_')
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        headers[key].append(value.decode('latin1'))
+    environ.update((key, ','.join(values)) for key, values in headers.items())
+    return environ
+
+
+class ThreadedWsgiToAsgi:
+    """Serve a WSGI application over ASGI, each request on a pool thread.
+
+    asgiref's WsgiToAsgi is thread-sensitive, i.e. serialises every request
+    on one thread; this runs them on the loop's default executor instead.
+    """
+
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError('WSGI adapter received a non-HTTP scope')
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] != 'http.request':
+                    return  # client disconnected before sending the body
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await sync_to_async(self.run, thread_sensitive=False)(scope, body, async_to_sync(send))
+
+    def run(self, scope, body, send):
+        """Run the WSGI application and stream its response through ``send``."""
+        start = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start['message'] = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                            for name, value in response_headers],
+            }
+
+        def send_start():
+            if not start.get('sent'):
+                start['sent'] = True
+                send(start['message'])
+
+        response = self.wsgi_application(wsgi_environ(scope, body), start_response)
+        try:
+            for chunk in response:
+                send_start()
+                if chunk:
+                    send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_start()
+            send({'type': 'http.response.body'})
+        finally:
+            # Fires request_finished, which closes Django's DB connections.
+            if hasattr(response, 'close'):
+                response.close()
+
+
+sync_application = ThreadedWsgiToAsgi(WSGIHandler())
+
+
+async def split_application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] not in ASYNC_PATHS:
+        return await sync_application(scope, receive, send)
+    return await django_application(scope, receive, send)
+
+
+application = asgi_router(split_application)
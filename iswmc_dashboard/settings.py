@@ -49,6 +49,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so Server-Timing covers the whole middleware stack.
+    'dashboard.metrics.MetricsMiddleware',
+    # Restarts cache warm-up in workers forked after startup (gunicorn --preload).
+    'dashboard.warmup.warmup_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -142,6 +146,99 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Dashboard aggregation backend:
+# - "python": load the window's deliveries and group them in-process (default)
+# - "mongo": run the window match, lorry lookup and period grouping as a
+#   MongoDB aggregation pipeline
+# - "rollup": sum the hourly delivery_rollups collection (maintained on save;
+#   run `manage.py rebuild_rollups` once before switching)
+# - "columnar": vectorised aggregation over an in-memory column store
+#   (requires numpy; reloaded every DASHBOARD_COLUMNAR_REFRESH seconds)
+# All fall back to "python" if their backend is unavailable.
+DASHBOARD_AGGREGATION_BACKEND = os.getenv("DASHBOARD_AGGREGATION_BACKEND", "python")
+DASHBOARD_COLUMNAR_REFRESH = int(os.getenv("DASHBOARD_COLUMNAR_REFRESH", "300"))
+
+# Cache for aggregate rows and rendered fragments (keyed by data version).
+# Local memory by default; point it at a shared backend, e.g.
+# DASHBOARD_CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache
+# DASHBOARD_CACHE_LOCATION=/var/tmp/iswmc_cache, when running several workers.
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("DASHBOARD_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("DASHBOARD_CACHE_LOCATION", "iswmc-dashboard"),
+    }
+}
+# Seconds each process reuses the data version read from MongoDB (see
+# dashboard/caching.py); writes from other processes show up within this.
+DASHBOARD_DATA_VERSION_TTL = float(os.getenv("DASHBOARD_DATA_VERSION_TTL", "2"))
+DASHBOARD_RESPONSE_CACHE_TTL = int(os.getenv("DASHBOARD_RESPONSE_CACHE_TTL", "300"))
+# Chat tool results kept per process (LRU), keyed by tool, period and data version.
+DASHBOARD_ANSWER_CACHE_SIZE = int(os.getenv("DASHBOARD_ANSWER_CACHE_SIZE", "256"))
+# Seconds before a cached chat answer is recomputed even if the version is unchanged.
+DASHBOARD_ANSWER_CACHE_TTL = float(os.getenv("DASHBOARD_ANSWER_CACHE_TTL", "60"))
+
+# Seconds the in-process lorry dimension cache is trusted before reloading;
+# saves/deletes through Django invalidate it immediately.
+DASHBOARD_LORRY_CACHE_TTL = int(os.getenv("DASHBOARD_LORRY_CACHE_TTL", "300"))
+
+# Rows fetched per cursor batch (and written per chunk) by /api/export/deliveries/.
+DASHBOARD_EXPORT_BATCH_SIZE = int(os.getenv("DASHBOARD_EXPORT_BATCH_SIZE", "2000"))
+
+# Shared PyMongo client used by pipeline/rollups/ai_tools (dashboard/mongo.py).
+# Size the pool for concurrent requests per worker; waitQueueTimeoutMS bounds
+# how long a request waits for a free connection.
+DASHBOARD_MONGO_MAX_POOL_SIZE = int(os.getenv("DASHBOARD_MONGO_MAX_POOL_SIZE", "20"))
+DASHBOARD_MONGO_MIN_POOL_SIZE = int(os.getenv("DASHBOARD_MONGO_MIN_POOL_SIZE", "0"))
+DASHBOARD_MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("DASHBOARD_MONGO_CONNECT_TIMEOUT_MS", "5000"))
+DASHBOARD_MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("DASHBOARD_MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+DASHBOARD_MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("DASHBOARD_MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+
+# Chat schema profiles ($sample-based, see dashboard/schema.py): cache age in
+# seconds and the server-side time limit for one sample.
+DASHBOARD_SCHEMA_CACHE_TTL = int(os.getenv("DASHBOARD_SCHEMA_CACHE_TTL", "600"))
+DASHBOARD_SCHEMA_MAX_TIME_MS = int(os.getenv("DASHBOARD_SCHEMA_MAX_TIME_MS", "2000"))
+
+# Async chat (/chat/): seconds to wait for Gemini before answering with the
+# local NLQ tools, concurrent Gemini calls per process, and threads for
+# local tool (ORM) work.
+DASHBOARD_CHAT_TIMEOUT = float(os.getenv("DASHBOARD_CHAT_TIMEOUT", "8"))
+DASHBOARD_CHAT_MAX_MODEL_CALLS = int(os.getenv("DASHBOARD_CHAT_MAX_MODEL_CALLS", "4"))
+DASHBOARD_CHAT_TOOL_WORKERS = int(os.getenv("DASHBOARD_CHAT_TOOL_WORKERS", "4"))
+# Build the Vertex AI model/tool declarations at startup instead of on the
+# first question (only when GOOGLE_CLOUD_PROJECT and GEMINI_LOCATION are set).
+DASHBOARD_VERTEX_EAGER_INIT = os.getenv("DASHBOARD_VERTEX_EAGER_INIT", "False").lower() in ("1", "true", "yes")
+# Gemini function calling: model turns per question and overall time budget
+# (tool calls within a turn run concurrently on the chat tool pool).
+DASHBOARD_GEMINI_MAX_TURNS = int(os.getenv("DASHBOARD_GEMINI_MAX_TURNS", "3"))
+DASHBOARD_GEMINI_MAX_SECONDS = float(os.getenv("DASHBOARD_GEMINI_MAX_SECONDS", "20"))
+
+# Request phase metrics (dashboard/metrics.py): samples kept per
+# (endpoint, phase) for the /metrics quantiles. With DASHBOARD_METRICS_TOKEN
+# set, /metrics requires "Authorization: Bearer <token>"; otherwise it is
+# served to INTERNAL_IPS and loopback only unless DASHBOARD_METRICS_PUBLIC is
+# set. Behind a reverse proxy every client looks like the proxy (usually
+# loopback), so set the token there.
+DASHBOARD_METRICS_WINDOW = int(os.getenv("DASHBOARD_METRICS_WINDOW", "1024"))
+DASHBOARD_METRICS_TOKEN = os.getenv("DASHBOARD_METRICS_TOKEN", "")
+DASHBOARD_METRICS_PUBLIC = os.getenv("DASHBOARD_METRICS_PUBLIC", "False").lower() in ("1", "true", "yes")
+
+# SSE live feed (/live/, dashboard/live.py): how often the shared publisher
+# checks the data version for writes from other processes, the keep-alive
+# interval and how many updates are kept for reconnecting screens.
+DASHBOARD_LIVE_POLL_SECONDS = float(os.getenv("DASHBOARD_LIVE_POLL_SECONDS", "2"))
+DASHBOARD_LIVE_HEARTBEAT_SECONDS = float(os.getenv("DASHBOARD_LIVE_HEARTBEAT_SECONDS", "15"))
+DASHBOARD_LIVE_BACKLOG = int(os.getenv("DASHBOARD_LIVE_BACKLOG", "100"))
+
+# Aggregation warm-up (dashboard/warmup.py): build every period's default
+# aggregates from one hourly pass and cache them together, and warm the
+# caches in the background at startup and after ingest_csv.
+DASHBOARD_ALL_PERIODS = os.getenv("DASHBOARD_ALL_PERIODS", "True").lower() in ("1", "true", "yes")
+DASHBOARD_PREWARM = os.getenv("DASHBOARD_PREWARM", "True").lower() in ("1", "true", "yes")
+
+# Rollup unique-lorry counts (dashboard/rollups.py): exact for windows up to
+# this many hours, merged HyperLogLog sketches (~1.6% standard error) beyond.
+DASHBOARD_DISTINCT_EXACT_HOURS = int(os.getenv("DASHBOARD_DISTINCT_EXACT_HOURS", "744"))
+
 # Tailwind CSS settings
 TAILWIND_APP_NAME = "theme"
 